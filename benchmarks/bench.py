@@ -0,0 +1,262 @@
+"""
+Benchmarks of the three legged OAuth flow and protected resources
+
+Every iteration drives a full flow through Flask's test client, without any
+network involved, timing each phase separately:
+
+    request_token -> authorize -> access_token -> protected (x N)
+                                                -> protected_realm (x N)
+
+Each combination of backend and signature method is run in turn, results
+are written as JSON to compare between runs, e.g.
+
+    python benchmarks/bench.py -o before.json
+    ... upgrade ...
+    python benchmarks/bench.py -o after.json --compare before.json
+
+Backends are "memory", the dict based TokenStore of the tests and a baseline
+for what the extension itself costs, and "sqlalchemy", SQLAlchemyStore on an
+in-memory SQLite database. The latter stands in for the SQLAlchemy backend of
+examples/demoprovider, which logs users in through OpenID and binds its
+models to a SQLite file when imported; the tables and queries are the same.
+RSA-SHA1 requires PyCrypto, the sqlalchemy backend SQLAlchemy.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+from urlparse import urlparse, parse_qsl
+
+# Run from a checkout, the extension and its test helpers being importable
+# without installing anything
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from flask import Flask, request
+from oauthlib.oauth1.rfc5849 import Client
+from oauthlib.oauth1.rfc5849 import SIGNATURE_HMAC, SIGNATURE_RSA
+from oauthlib.oauth1.rfc5849 import SIGNATURE_PLAINTEXT
+from flask_oauthprovider import OAuthProvider
+
+from tests.helpers import MemoryStore, sqlalchemy_store, rsa_keypair
+
+CLIENT_KEY = u'benchmarkclientkeyxx'
+CLIENT_SECRET = u'benchmarkclientsecretxxxxxxxxx'
+CALLBACK = u'http://client.local/callback'
+RESOURCE_OWNER = u'benchmark-owner'
+BASE_URL = u'http://localhost'
+
+PHASES = (u'request_token', u'authorize', u'access_token', u'protected',
+          u'protected_realm')
+METHODS = {u'hmac': SIGNATURE_HMAC, u'rsa': SIGNATURE_RSA,
+           u'plaintext': SIGNATURE_PLAINTEXT}
+
+
+BACKENDS = {u'memory': MemoryStore, u'sqlalchemy': sqlalchemy_store}
+
+
+class BenchmarkProvider(OAuthProvider):
+    """Authorizes every request token on behalf of a single user."""
+
+    @property
+    def enforce_ssl(self):
+        return False
+
+    @property
+    def realms(self):
+        return [u'secret', u'trolling']
+
+    def authorize(self):
+        return self.authorized(request.args.get(u'oauth_token'))
+
+    def register(self):
+        return u''
+
+    def current_resource_owner(self):
+        return RESOURCE_OWNER
+
+
+def create_app(store):
+    app = Flask(__name__)
+    provider = BenchmarkProvider(app, store=store)
+
+    @app.route(u'/protected')
+    @provider.require_oauth()
+    def protected():
+        return u'protected'
+
+    @app.route(u'/protected_realm')
+    @provider.require_oauth(realm=u'secret')
+    def protected_realm():
+        return u'protected realm'
+
+    return app
+
+
+class Flow(object):
+    """Runs the OAuth flow through a test client, timing every request."""
+
+    def __init__(self, app, method, rsa_key=None):
+        self.client = app.test_client()
+        self.method = method
+        self.rsa_key = rsa_key
+        self.timings = dict((phase, []) for phase in PHASES)
+
+    def credentials(self, **kwargs):
+        if self.method == SIGNATURE_RSA:
+            kwargs[u'rsa_key'] = self.rsa_key
+        else:
+            kwargs[u'client_secret'] = CLIENT_SECRET
+        return Client(CLIENT_KEY, signature_method=self.method, **kwargs)
+
+    def call(self, phase, oauth_client, path, http_method=u'GET',
+            realm=None):
+        if oauth_client is not None:
+            uri, headers, _ = oauth_client.sign(BASE_URL + path,
+                    http_method=http_method, realm=realm)
+        else:
+            headers = {}
+        open_url = getattr(self.client, http_method.lower())
+        start = timeit.default_timer()
+        response = open_url(path, headers=headers)
+        self.timings[phase].append(timeit.default_timer() - start)
+        if response.status_code not in (200, 302):
+            raise RuntimeError(u'%s failed with %d: %s' % (phase,
+                    response.status_code, response.data))
+        return response
+
+    def run(self, protected_calls):
+        response = self.call(u'request_token',
+                self.credentials(callback_uri=CALLBACK),
+                u'/request_token', u'POST', realm=u'secret')
+        data = dict(parse_qsl(response.data))
+        request_token = data[u'oauth_token'].decode(u'utf-8')
+        request_secret = data[u'oauth_token_secret'].decode(u'utf-8')
+
+        response = self.call(u'authorize', None,
+                u'/authorize?oauth_token=' + request_token)
+        location = urlparse(response.headers[u'Location'])
+        verifier = dict(parse_qsl(location.query))[u'oauth_verifier']
+
+        response = self.call(u'access_token', self.credentials(
+                resource_owner_key=request_token,
+                resource_owner_secret=request_secret,
+                verifier=verifier.decode(u'utf-8')),
+                u'/access_token', u'POST')
+        data = dict(parse_qsl(response.data))
+        access = self.credentials(
+                resource_owner_key=data[u'oauth_token'].decode(u'utf-8'),
+                resource_owner_secret=data[u'oauth_token_secret'].decode(u'utf-8'))
+
+        for _ in range(protected_calls):
+            self.call(u'protected', access, u'/protected')
+            self.call(u'protected_realm', access, u'/protected_realm')
+
+
+def percentile(timings, fraction):
+    """Nearest rank percentile of sorted timings."""
+    index = int(round(fraction * (len(timings) - 1)))
+    return timings[index]
+
+
+def summarize(backend, method, timings):
+    results = []
+    for phase in PHASES:
+        samples = sorted(timings[phase])
+        if not samples:
+            continue
+        total = sum(samples)
+        results.append({
+            u'backend': backend,
+            u'signature_method': method,
+            u'phase': phase,
+            u'requests': len(samples),
+            u'requests_per_second': len(samples) / total if total else None,
+            u'p50_ms': percentile(samples, 0.5) * 1000,
+            u'p99_ms': percentile(samples, 0.99) * 1000,
+        })
+    return results
+
+
+def benchmark(backend, method, iterations, warmup, protected_calls):
+    keypair = rsa_keypair() if method == u'rsa' else (None, None)
+    store = BACKENDS[backend]()
+    store.save_client(CLIENT_KEY, secret=CLIENT_SECRET, pubkey=keypair[1],
+            callbacks=[CALLBACK])
+    app = create_app(store)
+
+    Flow(app, METHODS[method], keypair[0]).run(protected_calls)
+    for _ in range(warmup - 1):
+        Flow(app, METHODS[method], keypair[0]).run(protected_calls)
+
+    flow = Flow(app, METHODS[method], keypair[0])
+    for _ in range(iterations):
+        flow.run(protected_calls)
+    return summarize(backend, method, flow.timings)
+
+
+def compare(results, baseline):
+    """Relative change in p50 and p99 latency against a previous run."""
+    previous = dict(((r[u'backend'], r[u'signature_method'], r[u'phase']), r)
+                    for r in baseline[u'results'])
+    changes = []
+    for result in results:
+        key = (result[u'backend'], result[u'signature_method'],
+               result[u'phase'])
+        if key not in previous:
+            continue
+        change = dict(zip((u'backend', u'signature_method', u'phase'), key))
+        for stat in (u'p50_ms', u'p99_ms'):
+            before = previous[key][stat]
+            change[stat] = (result[stat] - before) / before if before else None
+        changes.append(change)
+    return changes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(u'\n')[0])
+    parser.add_argument(u'-n', u'--iterations', type=int, default=200,
+            help=u'full flows per backend and signature method')
+    parser.add_argument(u'--warmup', type=int, default=10,
+            help=u'untimed flows run first')
+    parser.add_argument(u'--protected-calls', type=int, default=5,
+            help=u'protected resource requests per access token')
+    parser.add_argument(u'-b', u'--backend', action=u'append',
+            choices=sorted(BACKENDS), help=u'default all')
+    parser.add_argument(u'-m', u'--method', action=u'append',
+            choices=sorted(METHODS), help=u'default all')
+    parser.add_argument(u'-o', u'--output', help=u'default stdout')
+    parser.add_argument(u'--compare', metavar=u'BASELINE',
+            help=u'results of a previous run to compare against')
+    args = parser.parse_args(argv)
+
+    results = []
+    for backend in args.backend or sorted(BACKENDS):
+        for method in args.method or sorted(METHODS):
+            results.extend(benchmark(backend, method, args.iterations,
+                    args.warmup, args.protected_calls))
+
+    report = {
+        u'python': platform.python_version(),
+        u'platform': platform.platform(),
+        u'iterations': args.iterations,
+        u'protected_calls': args.protected_calls,
+        u'results': results,
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            report[u'compared_to'] = args.compare
+            report[u'changes'] = compare(results, json.load(f))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, u'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + u'\n')
+
+
+if __name__ == u'__main__':
+    main()
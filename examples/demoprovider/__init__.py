@@ -1,6 +1,5 @@
 from flask import Flask, request
 from provider import ExampleProvider
-from models import AccessToken
 
 app = Flask(__name__)
 app.config.update(
@@ -17,14 +16,14 @@ import login
 @app.route("/protected")
 @provider.require_oauth()
 def protected_view():
-    token = request.oauth.resource_owner_key
-    user = AccessToken.query.filter_by(token=token).one().resource_owner
+    user = provider.get_resource_owner(request.oauth.client_key,
+            request.oauth.resource_owner_key)
     return user.name
 
 
 @app.route("/protected_realm")
 @provider.require_oauth(realm="secret")
 def protected_realm_view():
-    token = request.oauth.resource_owner_key
-    user = AccessToken.query.filter_by(token=token).one().resource_owner
+    user = provider.get_resource_owner(request.oauth.client_key,
+            request.oauth.resource_owner_key)
     return user.email
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, create_engine
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -82,9 +83,8 @@ class Nonce(Base):
 
     id = Column(Integer, primary_key=True)
     nonce = Column(String)
-    timestamp = Column(Integer)
+    timestamp = Column(Integer, index=True)
 
-    # TODO: TTL
     client_id = Column(Integer, ForeignKey("clients.id"))
     client = relationship("Client", backref=backref("nonces", order_by=id))
 
@@ -111,8 +111,9 @@ class RequestToken(Base):
     realm = Column(String)
     secret = Column(String)
     callback = Column(String)
+    created_at = Column(DateTime)
+    expires_at = Column(DateTime, index=True)
 
-    # TODO: TTL
     client_id = Column(Integer, ForeignKey("clients.id"))
     client = relationship("Client", backref=backref("requestTokens", order_by=id))
 
@@ -137,8 +138,9 @@ class AccessToken(Base):
     token = Column(String)
     realm = Column(String)
     secret = Column(String)
+    created_at = Column(DateTime)
+    expires_at = Column(DateTime, index=True)
 
-    # TODO: TTL
     client_id = Column(Integer, ForeignKey("clients.id"))
     client = relationship("Client", order_by=id)
 
@@ -1,7 +1,8 @@
 from flask import request, render_template, g
-from flask.ext.oauthprovider import OAuthProvider
-from sqlalchemy.orm.exc import NoResultFound
-from models import ResourceOwner, Client, Nonce, Callback
+from flask.ext.oauthprovider import OAuthProvider, Record
+from sqlalchemy import bindparam
+from sqlalchemy.orm import joinedload
+from models import ResourceOwner, Client, Callback
 from models import RequestToken, AccessToken, db_session
 from utils import require_openid
 
@@ -16,6 +17,40 @@ class ExampleProvider(OAuthProvider):
     def realms(self):
         return [u"secret", u"trolling"]
 
+    @property
+    def client_cache_size(self):
+        return 1000
+
+    @property
+    def nonce_cache_size(self):
+        return 100000
+
+    @property
+    def nonce_cache_path(self):
+        # Shared by every worker process, next to the database, so replays
+        # sent to another worker are caught as well
+        return "flask-oauthprovider.nonces"
+
+    @property
+    def write_batch_size(self):
+        return 100
+
+    @property
+    def request_token_lifetime(self):
+        return 3600
+
+    @property
+    def verifier_lifetime(self):
+        return 600
+
+    @property
+    def access_token_lifetime(self):
+        return 30 * 24 * 3600
+
+    @property
+    def reaper_interval(self):
+        return 60
+
     @require_openid
     def authorize(self):
         if request.method == u"POST":
@@ -51,57 +86,68 @@ class ExampleProvider(OAuthProvider):
             client.resource_owner = g.user
             db_session.add(client)
             db_session.commit()
+            self.invalidate_client(client_key)
             return render_template(u"client.html", **info)
         else:
             clients = g.user.clients
             return render_template(u"register.html", clients=clients)
 
-    def validate_timestamp_and_nonce(self, client_key, timestamp, nonce,
-            request_token=None, access_token=None):
-        filters = [
-            Nonce.nonce == nonce,
-            Nonce.timestamp == timestamp,
-            Client.id == Nonce.client_id,
-            Client.client_key == client_key
-        ]
-        if request_token:
-            filters.extend([
-                RequestToken.id == Nonce.request_token_id,
-                RequestToken.token == request_token
-            ])
-        if access_token:
-            filters.extend([
-                AccessToken.id == Nonce.access_token_id,
-                AccessToken.token == access_token
-            ])
-        try:
-            db_session.query(Nonce, Client, ResourceOwner).filter(*filters).one()
-            return False
-        except NoResultFound:
-            return True
+    def load_client(self, client_key):
+        # Clients are cached across requests and thus sessions, load
+        # everything needed up front and detach it from this session.
+        client = Client.query.options(joinedload(Client.callbacks)).filter_by(
+                client_key=client_key).first()
+        if client is not None:
+            db_session.expunge(client)
+        return client
+
+    def load_request_token(self, client_key, request_token):
+        token = self.pending_write((u"request_token", request_token))
+        if token is not None:
+            if client_key:
+                client = self.get_client(client_key)
+                if client is None or token.client_id != client.id:
+                    return None
+            return token
+
+        query = RequestToken.query.filter_by(token=request_token)
+        if client_key:
+            query = query.join(RequestToken.client).filter(
+                Client.client_key == client_key)
+        return query.first()
+
+    def load_access_token(self, client_key, access_token):
+        token = self.pending_write((u"access_token", access_token))
+        if token is not None:
+            client = self.get_client(client_key)
+            if client is None or token.client_id != client.id:
+                return None
+            return token
+
+        return AccessToken.query.join(AccessToken.client).filter(
+            Client.client_key == client_key,
+            AccessToken.token == access_token
+        ).first()
+
+    def load_resource_owner(self, token):
+        return ResourceOwner.query.get(token.resource_owner_id)
 
     def validate_redirect_uri(self, client_key, redirect_uri=None):
-        try:
-            client = Client.query.filter_by(client_key=client_key).one()
-            if redirect_uri in (x.callback for x in client.callbacks):
-                return True
+        client = self.get_client(client_key)
+        if client is None:
+            return False
 
-            elif len(client.callbacks) == 1 and redirect_uri is None:
-                return True
+        if redirect_uri in (x.callback for x in client.callbacks):
+            return True
 
-            else:
-                return False
+        elif len(client.callbacks) == 1 and redirect_uri is None:
+            return True
 
-        except NoResultFound:
+        else:
             return False
 
     def validate_client_key(self, client_key):
-        try:
-            Client.query.filter_by(client_key=client_key).one()
-            return True
-
-        except NoResultFound:
-            return False
+        return self.get_client(client_key) is not None
 
     def validate_requested_realm(self, client_key, realm):
         return True
@@ -112,15 +158,8 @@ class ExampleProvider(OAuthProvider):
             return True
 
         # insert other check, ie on uri here
-
-        try:
-            token = db_session.query(AccessToken, Client).filter(
-                    Client.client_key == client_key,
-                    AccessToken.token == access_token).one().AccessToken
-            return token.realm in required_realm
-
-        except NoResultFound:
-            return False
+        return super(ExampleProvider, self).validate_realm(client_key,
+                access_token, uri=uri, required_realm=required_realm)
 
     @property
     def dummy_client(self):
@@ -132,120 +171,118 @@ class ExampleProvider(OAuthProvider):
 
     def validate_request_token(self, client_key, resource_owner_key):
         # TODO: make client_key optional
-        if client_key:
-            db_session.query(RequestToken, Client).filter(
-                RequestToken.token == resource_owner_key,
-                Client.client_key == client_key).one()
-        else:
-            RequestToken.query.filter_by(token=resource_owner_key).one()
-        try:
-            return True
-
-        except NoResultFound:
-            return False
+        return self.get_request_token(client_key, resource_owner_key) is not None
 
     def validate_access_token(self, client_key, resource_owner_key):
-        try:
-            db_session.query(AccessToken, Client).filter(
-                Client.client_key == client_key,
-                Client.id == AccessToken.client_id,
-                AccessToken.token == resource_owner_key
-            ).one()
-            return True
-
-        except NoResultFound:
-            return False
+        return self.get_access_token(client_key, resource_owner_key) is not None
 
     def validate_verifier(self, client_key, resource_owner_key, verifier):
-        try:
-            db_session.query(RequestToken, Client).filter(
-                Client.client_key == client_key,
-                RequestToken.token == resource_owner_key,
-                RequestToken.verifier == verifier
-            ).one()
-            return True
-        except NoResultFound:
-            return False
+        token = self.get_request_token(client_key, resource_owner_key)
+        return token is not None and token.verifier == verifier
 
     def get_callback(self, request_token):
-        return RequestToken.query.filter_by(token=request_token).one().callback
+        return self.get_request_token(None, request_token).callback
 
     def get_realm(self, client_key, request_token):
-        return db_session.query(RequestToken, Client).filter(
-                    Client.client_key == client_key,
-                    RequestToken.token == request_token
-        ).one().RequestToken.realm
+        return self.get_request_token(client_key, request_token).realm
 
     def get_client_secret(self, client_key):
-        try:
-            return Client.query.filter_by(client_key=client_key).one().secret
-
-        except NoResultFound:
-            return None
+        client = self.get_client(client_key)
+        return client.secret if client else None
 
     def get_rsa_key(self, client_key):
-        try:
-            return Client.query.filter_by(client_key=client_key).one().pubkey
-
-        except NoResultFound:
-            return None
+        client = self.get_client(client_key)
+        return client.pubkey if client else None
 
     def get_request_token_secret(self, client_key, resource_owner_key):
-        try:
-            query = db_session.query(RequestToken, Client).filter(
-                RequestToken.token == resource_owner_key,
-                Client.client_key == client_key
-            ).one()
-            return query.RequestToken.secret
-
-        except NoResultFound:
-            return None
+        token = self.get_request_token(client_key, resource_owner_key)
+        return token.secret if token else None
 
     def get_access_token_secret(self, client_key, resource_owner_key):
-        try:
-            query = db_session.query(AccessToken, Client).filter(
-                AccessToken.token == resource_owner_key,
-                Client.client_key == client_key
-            ).one()
-            return query.AccessToken.secret
-
-        except NoResultFound:
-            return None
+        token = self.get_access_token(client_key, resource_owner_key)
+        return token.secret if token else None
 
     def save_request_token(self, client_key, request_token, callback,
-            realm=None, secret=None):
-        token = RequestToken(request_token, callback, secret=secret, realm=realm)
-        token.client = Client.query.filter_by(client_key=client_key).one()
-        db_session.add(token)
-        db_session.commit()
+            realm=None, secret=None, created_at=None, expires_at=None):
+        token = Record(token=request_token, callback=callback, secret=secret,
+                realm=realm, verifier=None, resource_owner_id=None,
+                client_id=self.get_client(client_key).id,
+                created_at=created_at, expires_at=expires_at)
+        self.write_behind(u"request_token", token,
+                key=(u"request_token", request_token))
 
     def save_access_token(self, client_key, access_token, request_token,
-            realm=None, secret=None):
-        token = AccessToken(access_token, secret=secret, realm=realm)
-        token.client = Client.query.filter_by(client_key=client_key).one()
-        req_token = RequestToken.query.filter_by(token=request_token).one()
-        token.resource_owner = req_token.resource_owner
-        token.realm = req_token.realm
-        db_session.add(token)
-        db_session.commit()
-
-    def save_timestamp_and_nonce(self, client_key, timestamp, nonce,
-            request_token=None, access_token=None):
-        nonce = Nonce(nonce, timestamp)
-        nonce.client = Client.query.filter_by(client_key=client_key).one()
-
-        if request_token:
-            nonce.token = RequestToken.query.filter_by(token=request_token).one()
-
-        if access_token:
-            nonce.token = AccessToken.query.filter_by(token=access_token).one()
-
-        db_session.add(nonce)
-        db_session.commit()
-
-    def save_verifier(self, request_token, verifier):
-        token = RequestToken.query.filter_by(token=request_token).one()
-        token.verifier = verifier
-        token.resource_owner = g.user
-        db_session.add(token)
+            realm=None, secret=None, created_at=None, expires_at=None):
+        req_token = self.get_request_token(client_key, request_token)
+        token = Record(token=access_token, secret=secret,
+                realm=req_token.realm,
+                resource_owner_id=req_token.resource_owner_id,
+                client_id=self.get_client(client_key).id,
+                created_at=created_at, expires_at=expires_at)
+        self.write_behind(u"access_token", token,
+                key=(u"access_token", access_token))
+
+    def save_verifier(self, request_token, verifier, created_at=None,
+            expires_at=None):
+        req_token = self.get_request_token(None, request_token)
+        if req_token is None:
+            raise ValueError(u"Unknown request token.")
+        if req_token.expires_at and expires_at:
+            expires_at = min(req_token.expires_at, expires_at)
+        token = Record(token=request_token, callback=req_token.callback,
+                secret=req_token.secret, realm=req_token.realm,
+                verifier=verifier, resource_owner_id=g.user.id,
+                client_id=req_token.client_id,
+                created_at=req_token.created_at,
+                expires_at=expires_at or req_token.expires_at)
+        self.write_behind(u"verifier", token,
+                key=(u"request_token", request_token))
+
+    def flush_writes(self, writes):
+        # Called from a background thread, which has a session of its own
+        rows = dict((kind, []) for kind in
+                (u"request_token", u"verifier", u"access_token"))
+        for kind, token in writes:
+            rows[kind].append(vars(token))
+
+        requests = RequestToken.__table__
+        try:
+            if rows[u"request_token"]:
+                db_session.execute(requests.insert(), rows[u"request_token"])
+            if rows[u"verifier"]:
+                db_session.execute(requests.update().where(
+                    requests.c.token == bindparam(u"_token")).values(
+                        verifier=bindparam(u"_verifier"),
+                        resource_owner_id=bindparam(u"_resource_owner_id"),
+                        expires_at=bindparam(u"_expires_at")),
+                    [dict((u"_" + name, row[name]) for name in
+                        (u"token", u"verifier", u"resource_owner_id",
+                         u"expires_at"))
+                     for row in rows[u"verifier"]])
+            if rows[u"access_token"]:
+                db_session.execute(AccessToken.__table__.insert(),
+                        rows[u"access_token"])
+            db_session.commit()
+        except Exception:
+            # A failed statement aborts the transaction, on PostgreSQL every
+            # later batch would fail along with it
+            db_session.rollback()
+            raise
+        finally:
+            db_session.remove()
+
+    def purge_expired(self, kind, before, limit):
+        # Called from a background thread, which has a session of its own
+        model = {u"request_token": RequestToken,
+                 u"access_token": AccessToken}[kind]
+        # Selected apart from the delete, as MySQL refuses a LIMIT within
+        # the subquery of an IN
+        expired = [row.id for row in db_session.query(model.id).filter(
+                model.expires_at < before).limit(limit)]
+        count = 0
+        if expired:
+            count = model.query.filter(model.id.in_(expired)).delete(
+                    synchronize_session=False)
         db_session.commit()
+        db_session.remove()
+        return count
@@ -1,6 +1,5 @@
 from flask import Flask, request
 from provider import ExampleProvider
-from models import AccessToken, ResourceOwner as User
 
 app = Flask(__name__)
 app.config.update(
@@ -20,16 +19,14 @@ def callback():
 @app.route("/protected")
 @provider.require_oauth()
 def protected_view():
-    token = request.oauth.resource_owner_key
-    access_token = AccessToken.get_collection().find_one({'token':token})
-    user = User.find_one({'_id':access_token['resource_owner_id']})
+    user = provider.get_resource_owner(request.oauth.client_key,
+            request.oauth.resource_owner_key)
     return user['name']
 
 
 @app.route("/protected_realm")
 @provider.require_oauth(realm="secret")
 def protected_realm_view():
-    token = request.oauth.resource_owner_key
-    access_token = AccessToken.get_collection().find_one({'token':token})
-    user = User.find_one({'_id':access_token['resource_owner_id']})
+    user = provider.get_resource_owner(request.oauth.client_key,
+            request.oauth.resource_owner_key)
     return user['email']
@@ -1,8 +1,14 @@
 import pymongo
 
+client = None
+
 
 def get_connection():
-    return pymongo.MongoClient().demo_oauth_provider
+    # MongoClient keeps a connection pool, create it once per process
+    global client
+    if client is None:
+        client = pymongo.MongoClient()
+    return client.demo_oauth_provider
 
 
 class Model(dict):
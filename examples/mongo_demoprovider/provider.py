@@ -20,6 +20,10 @@ class ExampleProvider(OAuthProvider):
     def nonce_length(self):
         return 20, 40
 
+    @property
+    def client_cache_size(self):
+        return 1000
+
     @require_openid
     def authorize(self):
         if request.method == u"POST":
@@ -54,6 +58,7 @@ class ExampleProvider(OAuthProvider):
             client['callbacks'].append(callback)
             client['resource_owner_id'] = g.user['_id']
             client_id = Client.insert(client)
+            self.invalidate_client(client_key)
             g.user.client_ids.append(client_id)
             User.get_collection().save(g.user)
             return render_template(u"client.html", **info)
@@ -63,40 +68,57 @@ class ExampleProvider(OAuthProvider):
             return render_template(u"register.html", clients=clients)
             
     
+    def load_client(self, client_key):
+        return Client.find_one({'client_key':client_key})
+
+    def load_request_token(self, client_key, request_token):
+        if client_key:
+            client = self.get_client(client_key)
+            if client is None:
+                return None
+            return RequestToken.find_one(
+                {'token':request_token, 'client_id': client['_id']})
+        else:
+            return RequestToken.find_one({'token':request_token})
+
+    def load_access_token(self, client_key, access_token):
+        client = self.get_client(client_key)
+        if client is None:
+            return None
+        return AccessToken.find_one(
+            {'token':access_token, 'client_id': client['_id']})
+
+    def load_resource_owner(self, token):
+        return User.find_one({'_id':token['resource_owner_id']})
+
     def validate_timestamp_and_nonce(self, client_key, timestamp, nonce,
             request_token=None, access_token=None):
-        
-        token = True
-        req_token = True
-        client = Client.find_one({'client_key':client_key})
-        
-        if client:
-            nonce = Nonce.find_one({'nonce':nonce, 'timestamp':timestamp,
-                'client_id':client['_id']})
-            
-            if nonce:
-                if request_token:
-                    req_token = RequestToken.find_one(
-                        {'_id':nonce['request_token_id'], 'token':request_token})
-                    
-                if access_token:
-                    token = RequestToken.find_one(
-                        {'_id':nonce['request_token_id'], 'token':access_token})
-                
-        return token and req_token and nonce != None
+        client = self.get_client(client_key)
+        if client is None:
+            return True
+
+        query = {'nonce':nonce, 'timestamp':timestamp,
+                 'client_id':client['_id']}
+        if request_token:
+            token = self.get_request_token(client_key, request_token)
+            query['request_token_id'] = token and token['_id']
+        if access_token:
+            token = self.get_access_token(client_key, access_token)
+            query['access_token_id'] = token and token['_id']
+
+        return Nonce.find_one(query) is None
 
     def validate_redirect_uri(self, client_key, redirect_uri=None):
-        client = Client.find_one({'client_key':client_key})
-        
+        client = self.get_client(client_key)
+
         return client != None and (
             len(client['callbacks']) == 1 and redirect_uri is None
             or redirect_uri in (x for x in client['callbacks']))
-        
-        
+
+
     def validate_client_key(self, client_key):
-        return (
-            Client.find_one({'client_key':client_key}) != None)
-        
+        return self.get_client(client_key) != None
+
 
     def validate_requested_realm(self, client_key, realm):
         return True
@@ -108,17 +130,8 @@ class ExampleProvider(OAuthProvider):
             return True
 
         # insert other check, ie on uri here
-
-        client = Client.find_one({'client_key':client_key})
-        
-        if client:
-            token = AccessToken.find_one(
-                {'token':access_token, 'client_id': client['_id']})
-            
-            if token:
-                return token['realm'] in required_realm
-        
-        return False
+        return super(ExampleProvider, self).validate_realm(client_key,
+                access_token, uri=uri, required_realm=required_realm)
 
     @property
     def dummy_client(self):
@@ -130,51 +143,22 @@ class ExampleProvider(OAuthProvider):
 
     def validate_request_token(self, client_key, resource_owner_key):
         # TODO: make client_key optional
-        token = None
-        
-        if client_key:
-            client = Client.find_one({'client_key':client_key})
-        
-            if client:
-                token = RequestToken.find_one(
-                    {'token':access_token, 'client_id': client['_id']})
-            
-        else:
-            token = RequestToken.find_one(
-                    {'token':resource_owner_key})
-        
-        return token != None
+        return self.get_request_token(client_key, resource_owner_key) != None
 
 
     def validate_access_token(self, client_key, resource_owner_key):
+        return self.get_access_token(client_key, resource_owner_key) != None
 
-        token = None
-        client = Client.find_one({'client_key':client_key})
-    
-        if client:
-            token = AccessToken.find_one(
-                {'token':resource_owner_key, 'client_id': client['_id']})
-        
-        return token != None
-        
 
     def validate_verifier(self, client_key, resource_owner_key, verifier):
-        token = None
-        client = Client.find_one({'client_key':client_key})
-    
-        if client:
-            token = RequestToken.find_one(
-                {'token':resource_owner_key,
-                 'client_id': client['_id'], 
-                 'verifier':verifier})
-        
-        return token != None
-        
-        
+        token = self.get_request_token(client_key, resource_owner_key)
+
+        return token != None and token.get('verifier') == verifier
+
+
     def get_callback(self, request_token):
-        token = RequestToken.find_one(
-                {'token':request_token})
-                
+        token = self.get_request_token(None, request_token)
+
         if token:
             return token.get('callback')
         else:
@@ -182,21 +166,17 @@ class ExampleProvider(OAuthProvider):
 
 
     def get_realm(self, client_key, request_token):
-        client = Client.find_one({'client_key':client_key})
-        
-        if client:
-            token = RequestToken.find_one(
-                {'token':request_token, 'client_id': client['_id']})
-            
-            if token:
-                return token.get('realm')
-                
+        token = self.get_request_token(client_key, request_token)
+
+        if token:
+            return token.get('realm')
+
         return None
-        
+
 
     def get_client_secret(self, client_key):
-            client = Client.find_one({'client_key':client_key})
-            
+            client = self.get_client(client_key)
+
             if client:
                 return client.get('secret')
             else:
@@ -204,88 +184,78 @@ class ExampleProvider(OAuthProvider):
 
 
     def get_rsa_key(self, client_key):
-            client = Client.find_one({'client_key':client_key})
-            
+            client = self.get_client(client_key)
+
             if client:
                 return client.get('pubkey')
             else:
                 return None
 
     def get_request_token_secret(self, client_key, resource_owner_key):
-        client = Client.find_one({'client_key':client_key})
-    
-        if client:
-            token = RequestToken.find_one(
-                {'token':resource_owner_key,
-                 'client_id': client['_id']})
-                 
-            if token:
-                return token.get('secret')
-                     
+        token = self.get_request_token(client_key, resource_owner_key)
+
+        if token:
+            return token.get('secret')
+
         return None
-        
+
 
     def get_access_token_secret(self, client_key, resource_owner_key):
-        client = Client.find_one({'client_key':client_key})
-    
-        if client:
-            token = AccessToken.find_one(
-                {'token':resource_owner_key,
-                 'client_id': client['_id']})
-                 
-            if token:
-                return token.get('secret')
-                     
+        token = self.get_access_token(client_key, resource_owner_key)
+
+        if token:
+            return token.get('secret')
+
         return None
 
     def save_request_token(self, client_key, request_token, callback,
             realm=None, secret=None):
-        client = Client.find_one({'client_key':client_key})
-        
+        client = self.get_client(client_key)
+
         if client:
             token = RequestToken(
                 request_token, callback, secret=secret, realm=realm)
             token.client_id = client['_id']
-        
+
             RequestToken.insert(token)
 
     def save_access_token(self, client_key, access_token, request_token,
             realm=None, secret=None):
-        client = Client.find_one({'client_key':client_key})
-        
+        client = self.get_client(client_key)
+
         if client:
             token = AccessToken(access_token, secret=secret, realm=realm)
             token.client_id = client['_id']
-            
-            req_token = RequestToken.find_one({'token':request_token})
-            
+
+            req_token = self.get_request_token(client_key, request_token)
+
             if req_token:
                 token['resource_owner_id'] = req_token['resource_owner_id']
                 token['realm'] = req_token['realm']
-            
+
                 AccessToken.insert(token)
 
     def save_timestamp_and_nonce(self, client_key, timestamp, nonce,
             request_token=None, access_token=None):
-        
-        client = Client.find_one({'client_key':client_key})
-        
+
+        client = self.get_client(client_key)
+
         if client:
             nonce = Nonce(nonce, timestamp)
             nonce.client_id = client['_id']
 
             if request_token:
-                req_token = RequestToken.find_one({'token':request_token})
+                req_token = self.get_request_token(client_key, request_token)
                 nonce.request_token_id = req_token['_id']
 
             if access_token:
-                token = AccessToken.find_one({'token':access_token})
+                token = self.get_access_token(client_key, access_token)
                 nonce.access_token_id = token['_id']
 
             Nonce.insert(nonce)
 
     def save_verifier(self, request_token, verifier):
-        token = RequestToken.find_one({'token':request_token})
+        token = self.get_request_token(None, request_token)
         token['verifier'] = verifier
         token['resource_owner_id'] = g.user['_id']
         RequestToken.get_collection().save(token)
@@ -1,12 +1,1946 @@
 # -*- coding: utf-8 -*-
-from oauthlib.oauth1.rfc5849 import Server
+from oauthlib.oauth1.rfc5849 import Server, signature
+from oauthlib.oauth1.rfc5849 import SIGNATURE_HMAC, SIGNATURE_RSA
+from oauthlib.oauth1.rfc5849 import CONTENT_TYPE_FORM_URLENCODED
 from oauthlib.oauth1.rfc5849.signature import collect_parameters
 from oauthlib.common import add_params_to_uri, encode_params_utf8
-from oauthlib.common import generate_token, urlencode
-from flask import Response, request, redirect
-from werkzeug.exceptions import Unauthorized, BadRequest
-from functools import wraps
+from oauthlib.common import generate_token, urlencode, safe_string_equals
+from oauthlib.common import Request, UNICODE_ASCII_CHARACTER_SET
+from flask import Response, request, redirect, _request_ctx_stack
+from flask.signals import Namespace, signals_available
+from werkzeug.exceptions import HTTPException, Unauthorized, BadRequest
+from werkzeug.exceptions import ServiceUnavailable
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial, wraps
+from multiprocessing.pool import ThreadPool
+from threading import Condition, Lock, Thread
+from threading import current_thread, local
 from urlparse import urlparse
+import atexit
+import binascii
+import bisect
+import calendar
+import hashlib
+import heapq
+import hmac
+import json
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import time
+import timeit
+
+log = logging.getLogger('flask_oauthprovider')
+
+oauth_signals = Namespace()
+
+# Sent with the phase name and its duration in seconds after each stage of
+# verify_request and each provider hook called through call_hook, i.e.
+# phase=u'validate_client_key'. Stages include the hooks they call.
+phase_timed = oauth_signals.signal(u'oauth-phase-timed')
+
+# Sent after each request to a view protected by require_oauth with its
+# endpoint, signature_method, duration in seconds and outcome: u'valid',
+# u'unauthorized', u'replay', u'bad_request', u'rate_limited' or u'error'.
+request_handled = oauth_signals.signal(u'oauth-request-handled')
+
+# Sent with the (kind, record) writes passed to write_behind which could
+# not be flushed, even after retrying, and were dropped.
+writes_dropped = oauth_signals.signal(u'oauth-writes-dropped')
+
+
+class OAuthParameters(object):
+    """Used as a parameter container since plain object()s can't"""
+    pass
+
+
+class Record(object):
+    """A plain record of attributes, i.e. a token not yet written to storage."""
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+    def __repr__(self):
+        return "<Record %r>" % self.__dict__
+
+
+class LookupContext(object):
+    """Records looked up while serving a single request.
+
+    A single verify_request calls a handful of validators and getters which
+    all need the same client and token, as do the save_* hooks invoked
+    afterwards. Records are memoized here by kind and key so that each is
+    only loaded from storage once per request, misses included.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.pending = {}
+
+    def get(self, kind, key, loader):
+        """Return the memoized record or load it using loader(*key)."""
+        try:
+            return self.records[(kind, key)]
+        except KeyError:
+            pending = self.pending.pop((kind, key), None)
+            if pending is not None:
+                record = pending.get()
+            else:
+                record = loader(*key)
+            self.records[(kind, key)] = record
+            return record
+
+    def prefetch(self, kind, key, loader, pool):
+        """Start loading a record on a PrefetchPool unless already known."""
+        if (kind, key) not in self.records and (kind, key) not in self.pending:
+            self.pending[(kind, key)] = pool.submit(loader, *key)
+
+    def forget(self, kind, key):
+        """Drop a memoized record, i.e. after it has been changed."""
+        self.records.pop((kind, key), None)
+        self.pending.pop((kind, key), None)
+
+
+class PrefetchPool(object):
+    """A process wide pool of threads loading records ahead of validators.
+
+    The client and token lookups of a request do not depend on each other,
+    loading them concurrently costs about one storage round trip instead
+    of one per record. Loaders run outside of the request context.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.pool = None
+        self.pid = None
+        self.lock = Lock()
+
+    def submit(self, func, *args):
+        """Run func(*args) on the pool, returns an AsyncResult."""
+        # Threads do not survive a fork, each worker needs its own
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pool = ThreadPool(self.size)
+        return self.pool.apply_async(func, args)
+
+
+class ClientCache(object):
+    """A bounded, process wide cache of client records.
+
+    Client records are needed by every signed request but rarely change.
+    Entries expire ttl seconds after being loaded and the least recently
+    used entry is evicted once more than size clients are cached. Unknown
+    clients are never cached. Providers must invalidate a client whenever
+    its record changes, i.e. during registration.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.records = OrderedDict()
+        self.lock = Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, client_key, loader):
+        """Return the cached record or load it using loader(client_key)."""
+        now = time.time()
+        with self.lock:
+            entry = self.records.pop(client_key, None)
+            if entry is not None and entry[0] > now:
+                # Reinsert to mark as most recently used
+                self.records[client_key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+
+        record = loader(client_key)
+        with self.lock:
+            # Records loaded before an invalidation may already be stale
+            if record is not None and generation == self.generation:
+                self.records[client_key] = (now + self.ttl, record)
+                while len(self.records) > self.size:
+                    self.records.popitem(last=False)
+        return record
+
+    def invalidate(self, client_key=None):
+        """Forget a single client or, if no key is given, every client."""
+        with self.lock:
+            self.generation += 1
+            if client_key is None:
+                self.records.clear()
+            else:
+                self.records.pop(client_key, None)
+
+    def stats(self):
+        """Return hit and miss counters along with the current size."""
+        with self.lock:
+            return {u'hits': self.hits, u'misses': self.misses,
+                    u'size': len(self.records)}
+
+
+class NegativeCache(object):
+    """A bounded, process wide cache of lookups which found nothing.
+
+    Unknown client keys and tokens, i.e. sent by a broken client or when
+    brute forcing, are then answered without a storage round trip for ttl
+    seconds. Answering faster than a lookup would tell which keys are
+    missing, OAuthProvider waits as long as a lookup takes on average
+    before answering from this cache. The oldest entries are dropped once
+    more than size keys are cached.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.expires = OrderedDict()
+        self.lock = Lock()
+        self.generation = 0
+
+    def get(self, key, loader):
+        """Return None if key is known to be missing, else loader()."""
+        now = time.time()
+        with self.lock:
+            expires = self.expires.get(key)
+            if expires is not None:
+                if expires > now:
+                    return None
+                del self.expires[key]
+            generation = self.generation
+
+        record = loader()
+        with self.lock:
+            # Records created since the lookup started may be missed
+            if record is None and generation == self.generation:
+                self.expires[key] = now + self.ttl
+                while len(self.expires) > self.size:
+                    self.expires.popitem(last=False)
+        return record
+
+    def forget(self, key=None):
+        """Forget a single key or, if no key is given, every key."""
+        with self.lock:
+            self.generation += 1
+            if key is None:
+                self.expires.clear()
+            else:
+                self.expires.pop(key, None)
+
+
+class NonceCache(object):
+    """Remembers recently used nonces in memory to detect replayed requests.
+
+    Nonces are keyed by client key, timestamp and nonce and grouped in
+    buckets spanning granularity seconds of timestamps. Requests with a
+    timestamp older than lifetime seconds are rejected by oauthlib, so
+    whole buckets are dropped once they fall out of that window.
+
+    At most size nonces are kept. When full the oldest bucket is dropped
+    early and its timestamps are from then on treated as already used,
+    which errs on the side of rejecting rather than allowing a replay.
+
+    Nonces are only shared by threads of a single process.
+    """
+
+    def __init__(self, lifetime, size, granularity=10):
+        self.lifetime = lifetime
+        self.size = size
+        self.granularity = granularity
+        self.buckets = {}
+        self.bucket_order = []
+        self.floor = 0
+        self.count = 0
+        self.lock = Lock()
+
+    def add(self, client_key, timestamp, nonce):
+        """Record a nonce, returning False if it may have been used before."""
+        timestamp = int(timestamp)
+        key = (client_key, timestamp, nonce)
+        number = timestamp // self.granularity
+        oldest = time.time() - self.lifetime
+        if timestamp < oldest:
+            return False
+
+        with self.lock:
+            self.expire(oldest)
+            if timestamp < self.floor:
+                return False
+
+            bucket = self.buckets.get(number)
+            if bucket is None:
+                bucket = self.buckets[number] = set()
+                heapq.heappush(self.bucket_order, number)
+            elif key in bucket:
+                return False
+
+            bucket.add(key)
+            self.count += 1
+            while self.count > self.size:
+                self.drop_oldest()
+            return True
+
+    def expire(self, oldest):
+        """Drop buckets holding only timestamps older than oldest."""
+        while (self.bucket_order and
+               (self.bucket_order[0] + 1) * self.granularity <= oldest):
+            self.drop_oldest()
+
+    def drop_oldest(self):
+        number = heapq.heappop(self.bucket_order)
+        self.count -= len(self.buckets.pop(number))
+        self.floor = max(self.floor, (number + 1) * self.granularity)
+
+
+class SharedNonceCache(object):
+    """Remembers recently used nonces in a file shared by many processes.
+
+    Workers of a pre-forking server each have their own memory, so replays
+    sent to different workers go unnoticed by a NonceCache. This cache
+    instead memory maps a fixed size hash table from path, which every
+    process on the host opening the same path shares.
+
+    The table is split into stripes of stripe_size slots, each slot holding
+    a fingerprint of (client_key, timestamp, nonce) and its timestamp. A
+    nonce is hashed to a stripe and probed for linearly within it. Slots
+    whose timestamp has fallen out of the lifetime window are reused. Each
+    stripe is guarded by a byte range lock on the file, so inserts only
+    contend when they hash to the same stripe.
+
+    If every slot of a stripe holds a live nonce the new nonce is refused,
+    size should comfortably exceed the number of requests expected within
+    lifetime seconds.
+
+    The locks are taken through fcntl, imported on first use, so neither
+    this nor the other shared tables below are available on Windows.
+    """
+
+    slot = struct.Struct('<Qq')
+
+    def __init__(self, path, lifetime, size, stripe_size=64):
+        self.lifetime = lifetime
+        self.stripe_size = stripe_size
+        self.stripes = max(1, -(-size // stripe_size))
+        self.stripe_bytes = stripe_size * self.slot.size
+        length = self.stripes * self.stripe_bytes
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < length:
+            os.ftruncate(self.fd, length)
+        self.table = mmap.mmap(self.fd, length)
+
+        # Byte range locks are held per process, threads within a process
+        # are kept apart by a small set of ordinary locks.
+        self.locks = [Lock() for i in range(min(self.stripes, 64))]
+
+    def add(self, client_key, timestamp, nonce):
+        """Record a nonce, returning False if it may have been used before."""
+        import fcntl
+        timestamp = int(timestamp)
+        key = u'%s\0%d\0%s' % (client_key, timestamp, nonce)
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        fingerprint = struct.unpack('<Q', digest[:8])[0] or 1
+        stripe = struct.unpack('<I', digest[8:12])[0] % self.stripes
+        first = ord(digest[12:13]) % self.stripe_size
+        oldest = time.time() - self.lifetime
+        if timestamp < oldest:
+            return False
+
+        base = stripe * self.stripe_bytes
+        with self.locks[stripe % len(self.locks)]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.stripe_bytes, base)
+            try:
+                free = None
+                for i in range(self.stripe_size):
+                    offset = base + ((first + i) % self.stripe_size) * self.slot.size
+                    used, used_timestamp = self.slot.unpack_from(self.table, offset)
+                    if used == fingerprint and used_timestamp == timestamp:
+                        return False
+                    if used_timestamp < oldest and free is None:
+                        free = offset
+                    if not used:
+                        # Never used slots end the probe sequence
+                        break
+
+                if free is None:
+                    return False
+                self.slot.pack_into(self.table, free, fingerprint, timestamp)
+                return True
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.stripe_bytes, base)
+
+
+class BloomFilter(object):
+    """A Bloom filter of every client key and token, shared by processes.
+
+    A key which is not in the filter is certainly unknown and may be
+    rejected without a storage round trip, while keys in it are looked up
+    as usual. Removed keys are never removed from the filter, they only
+    increase the rate of false positives.
+
+    The filter is memory mapped from path so that keys issued by one worker
+    are seen by every other. It is only consulted once populated with all
+    existing keys, which populate does if nobody has done so before. Bits
+    are set under an exclusive lock on the file. Remove the file to rebuild
+    the filter, i.e. after many keys have been deleted.
+    """
+
+    header = 8
+
+    def __init__(self, path, capacity, error_rate):
+        import fcntl
+        self.bits = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, int(round(self.bits / float(capacity) *
+                                       math.log(2))))
+        length = self.header + (self.bits + 7) // 8
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            # A filter of another size is of no use, start over
+            if os.fstat(self.fd).st_size != length:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, length)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.map = mmap.mmap(self.fd, length)
+        self.lock = Lock()
+
+    @property
+    def ready(self):
+        return struct.unpack_from('B', self.map, 0)[0] == 1
+
+    def positions(self, kind, key):
+        key = u'%s\0%s' % (kind, key)
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        first, step = struct.unpack('<QQ', digest[:16])
+        return [(first + i * step) % self.bits for i in range(self.hashes)]
+
+    def may_contain(self, kind, key):
+        """Return False only if key is certainly not in a populated filter."""
+        if not self.ready:
+            return True
+        for position in self.positions(kind, key):
+            byte = struct.unpack_from('B', self.map,
+                    self.header + position // 8)[0]
+            if not byte & (1 << (position % 8)):
+                return False
+        return True
+
+    def add(self, kind, key):
+        self.update([(kind, key)])
+
+    def update(self, keys, ready=False):
+        """Add an iterable of (kind, key) tuples, optionally marking ready."""
+        import fcntl
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                for kind, key in keys:
+                    for position in self.positions(kind, key):
+                        offset = self.header + position // 8
+                        byte = struct.unpack_from('B', self.map, offset)[0]
+                        struct.pack_into('B', self.map, offset,
+                                byte | (1 << (position % 8)))
+                if ready:
+                    struct.pack_into('B', self.map, 0, 1)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def populate(self, keys):
+        """Add keys, an iterable of (kind, key), unless already populated."""
+        if not self.ready:
+            self.update(keys, ready=True)
+
+
+class LookupTimer(object):
+    """Moving averages of the time taken by storage lookups of each kind.
+
+    Keys the Bloom filter rejects or the negative cache knows to be missing
+    are answered after waiting as long as a lookup of their kind takes, so
+    whether a key exists can not be told from how quickly a request is
+    refused.
+    """
+
+    def __init__(self, weight=0.05):
+        self.weight = weight
+        self.averages = {}
+
+    def observe(self, kind, duration):
+        average = self.averages.get(kind)
+        if average is None:
+            self.averages[kind] = duration
+        else:
+            self.averages[kind] = average + self.weight * (duration - average)
+
+    def wait(self, kind):
+        average = self.averages.get(kind)
+        if average:
+            time.sleep(average)
+
+
+class RateLimited(HTTPException):
+    """429 Too Many Requests, telling the client when to retry."""
+
+    code = 429
+    description = u'Too many requests, retry later.'
+
+    def __init__(self, retry_after):
+        HTTPException.__init__(self)
+        self.retry_after = retry_after
+
+    def get_headers(self, environ=None):
+        headers = HTTPException.get_headers(self, environ)
+        headers.append((u'Retry-After', u'%d' % math.ceil(self.retry_after)))
+        return headers
+
+
+class TokenBuckets(object):
+    """Token buckets of a process, keyed by i.e. client and endpoint.
+
+    Each bucket holds up to burst tokens and is refilled with rate tokens
+    per second, a request taking one. The least recently used buckets are
+    dropped once more than size are kept, a dropped bucket is full again.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token, returning 0 or the seconds until one is available."""
+        now = time.time()
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (burst, now))
+            tokens, wait = take_token(tokens, last, now, rate, burst)
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+class SharedTokenBuckets(object):
+    """Token buckets shared by many processes through a file at path.
+
+    Like SharedNonceCache a fixed size hash table of slots is memory mapped
+    and split into stripes guarded by byte range locks. A slot holds a
+    fingerprint of the key, its tokens and when it was last used. Buckets
+    are placed in a free slot of their stripe or else replace its least
+    recently used bucket.
+    """
+
+    slot = struct.Struct('<Qdd')
+
+    def __init__(self, path, size, stripe_size=16):
+        self.stripe_size = stripe_size
+        self.stripes = max(1, -(-size // stripe_size))
+        self.stripe_bytes = stripe_size * self.slot.size
+        length = self.stripes * self.stripe_bytes
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < length:
+            os.ftruncate(self.fd, length)
+        self.table = mmap.mmap(self.fd, length)
+        self.locks = [Lock() for i in range(min(self.stripes, 64))]
+
+    def take(self, key, rate, burst):
+        """Take a token, returning 0 or the seconds until one is available."""
+        import fcntl
+        digest = hashlib.sha1(repr(key).encode('utf-8')).digest()
+        fingerprint = struct.unpack('<Q', digest[:8])[0] or 1
+        stripe = struct.unpack('<I', digest[8:12])[0] % self.stripes
+        now = time.time()
+
+        base = stripe * self.stripe_bytes
+        with self.locks[stripe % len(self.locks)]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.stripe_bytes, base)
+            try:
+                found = oldest = None
+                for i in range(self.stripe_size):
+                    offset = base + i * self.slot.size
+                    used, tokens, last = self.slot.unpack_from(self.table,
+                                                               offset)
+                    if used == fingerprint:
+                        found = offset
+                        break
+                    if oldest is None or last < oldest[1]:
+                        oldest = (offset, last)
+
+                if found is None:
+                    found, tokens, last = oldest[0], burst, now
+                tokens, wait = take_token(tokens, last, now, rate, burst)
+                self.slot.pack_into(self.table, found, fingerprint, tokens,
+                                    now)
+                return wait
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.stripe_bytes, base)
+
+
+def take_token(tokens, last, now, rate, burst):
+    """Refill a bucket and take a token, returns the tokens left and wait."""
+    tokens = min(burst, tokens + max(0, now - last) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class WriteBehindQueue(object):
+    """Collects writes and hands them to flush in batches.
+
+    A background thread calls flush(writes) with a list of (kind, record)
+    tuples once batch_size writes are queued or delay seconds after the
+    first write of a batch was queued, whichever comes first. flush should
+    persist the whole batch using a single transaction.
+
+    Writes queued with a key are readable through get(key) until they have
+    been flushed, so a token is valid as soon as it has been issued. Only
+    within this process though, other workers see a write once flushed.
+
+    A batch failing to flush is retried on its own after delay seconds,
+    doubling up to a minute, while its writes remain readable and those
+    queued meanwhile wait for the next batch. After retries failed attempts
+    it is split in halves flushed apart, halves failing in turn being split
+    further, so that only writes failing on their own, i.e. violating a
+    constraint, are dropped, logged and passed to dropped(writes). Tokens
+    in a dropped write have already been handed out and stop working.
+    Writes still queued when the interpreter exits are flushed once more
+    first.
+    """
+
+    def __init__(self, flush, batch_size, delay, retries=5, dropped=None):
+        self.flush_writes = flush
+        self.batch_size = batch_size
+        self.delay = delay
+        self.retries = retries
+        self.dropped = dropped
+        self.writes = []
+        self.overlay = {}
+        self.condition = Condition()
+        self.pid = None
+        self.thread = None
+        self.stopped = False
+        atexit.register(self.stop)
+
+    def put(self, kind, record, key=None):
+        """Queue a write, optionally readable by key until flushed."""
+        with self.condition:
+            self.writes.append((kind, record, key))
+            if key is not None:
+                self.overlay[key] = record
+
+            # Threads do not survive a fork, each worker needs its own
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.stopped = False
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            if len(self.writes) >= self.batch_size:
+                self.condition.notify()
+
+    def get(self, key):
+        """Return the record of a queued write not yet flushed, or None."""
+        with self.condition:
+            return self.overlay.get(key)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.writes and not self.stopped:
+                    self.condition.wait()
+                self.wait_until(time.time() + self.delay,
+                        lambda: len(self.writes) >= self.batch_size)
+                if self.stopped:
+                    return
+                writes, self.writes = self.writes, []
+
+            failures = 0
+            while not self.write(writes):
+                failures += 1
+                if failures > self.retries:
+                    self.split(writes)
+                    break
+                with self.condition:
+                    self.wait_until(time.time() +
+                            min(self.delay * 2 ** failures, 60))
+                    if self.stopped:
+                        # Flushed by stop, along with later writes
+                        self.writes[:0] = writes
+                        return
+
+    def wait_until(self, deadline, done=lambda: False):
+        """Wait for the condition until deadline, done() or stop."""
+        while not done() and not self.stopped:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.condition.wait(remaining)
+
+    def stop(self):
+        """Stop the background thread and flush the writes left.
+
+        Registered to run at exit, before the interpreter tears down the
+        modules the thread would otherwise still be using.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join()
+        self.flush()
+
+    def flush(self):
+        """Flush all queued writes in the calling thread, without retrying."""
+        with self.condition:
+            writes, self.writes = self.writes, []
+        if writes and not self.write(writes):
+            self.split(writes)
+
+    def write(self, writes):
+        """Flush a batch, returning whether it was persisted."""
+        try:
+            self.flush_writes([(kind, record) for kind, record, key in writes])
+        except Exception:
+            log.exception("Failed to flush %d queued writes", len(writes))
+            return False
+        self.forget(writes)
+        return True
+
+    def split(self, writes):
+        """Flush halves of a failed batch apart, down to single writes."""
+        if len(writes) == 1:
+            self.drop(writes)
+            return
+        middle = len(writes) // 2
+        for half in (writes[:middle], writes[middle:]):
+            if not self.write(half):
+                self.split(half)
+
+    def drop(self, writes):
+        log.error("Dropped %d queued writes", len(writes))
+        self.forget(writes)
+        if self.dropped is not None:
+            self.dropped([(kind, record) for kind, record, key in writes])
+
+    def forget(self, writes):
+        with self.condition:
+            for kind, record, key in writes:
+                # A later write may have replaced the record since
+                if key is not None and self.overlay.get(key) is record:
+                    del self.overlay[key]
+
+
+class Reaper(object):
+    """Periodically purges expired records using purge(kind, before, limit).
+
+    purge deletes at most limit records of kind which expired before the
+    given UTC datetime and returns how many were deleted. Each kind is
+    purged in chunks until a chunk comes back short, keeping transactions
+    small while the tables stay online.
+    """
+
+    def __init__(self, purge, kinds, interval, chunk_size):
+        self.purge = purge
+        self.kinds = kinds
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.pid = None
+
+    def start(self):
+        """Start reaping in a background thread, once per process."""
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        thread = Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reap()
+            except Exception:
+                log.exception("Failed to purge expired records")
+
+    def reap(self):
+        """Purge every kind of expired record once."""
+        for kind, lifetime in self.kinds:
+            before = datetime.utcnow() - timedelta(seconds=lifetime)
+            while self.purge(kind, before, self.chunk_size) >= self.chunk_size:
+                pass
+
+
+class TokenStore(object):
+    """Storage backend for clients, tokens and nonces.
+
+    Passing a store to OAuthProvider provides default implementations of
+    every loader, validator, getter and save_* method, leaving only the
+    register and authorize views to be implemented.
+
+    Loaders return Records, or None if nothing matched, with these
+    attributes:
+
+    * clients: client_key, secret, pubkey and callbacks, a list of URIs
+    * request tokens: client_key, token, secret, realm, callback, verifier,
+      resource_owner, created_at and expires_at
+    * access tokens: client_key, token, secret, realm, resource_owner,
+      created_at and expires_at
+
+    Resource owners are stored as opaque ids, e.g. the primary key of a
+    user, which OAuthProvider.load_resource_owner may turn into a user.
+    """
+
+    def load_client(self, client_key):
+        raise NotImplementedError("Must be implemented by inheriting classes")
+
+    def load_request_token(self, client_key, request_token):
+        raise NotImplementedError("Must be implemented by inheriting classes")
+
+    def load_access_token(self, client_key, access_token):
+        raise NotImplementedError("Must be implemented by inheriting classes")
+
+    def save_client(self, client_key, secret=None, pubkey=None, callbacks=()):
+        raise NotImplementedError("Must be implemented by inheriting classes")
+
+    def save_request_token(self, client_key, request_token, callback,
+            realm=None, secret=None, created_at=None, expires_at=None):
+        raise NotImplementedError("Must be implemented by inheriting classes")
+
+    def save_verifier(self, request_token, verifier, resource_owner,
+            expires_at=None):
+        raise NotImplementedError("Must be implemented by inheriting classes")
+
+    def save_access_token(self, client_key, access_token, request_token,
+            secret=None, created_at=None, expires_at=None):
+        """Store an access token with the realm and owner of request_token."""
+        raise NotImplementedError("Must be implemented by inheriting classes")
+
+    def add_nonce(self, client_key, timestamp, nonce):
+        """Record a nonce, returning False if it has been used before."""
+        raise NotImplementedError("Must be implemented by inheriting classes")
+
+    def purge_expired(self, kind, before, limit):
+        """See OAuthProvider.purge_expired."""
+        raise NotImplementedError("Must be implemented by inheriting classes")
+
+    @contextmanager
+    def transaction(self):
+        """Have all calls within share a transaction, see unit_of_work.
+
+        Commits on exit and rolls back on error, stores without
+        transactions have calls take effect immediately.
+        """
+        yield
+
+    def known_keys(self):
+        """See OAuthProvider.known_keys."""
+        raise NotImplementedError("Must be implemented by inheriting classes")
+
+
+class SQLAlchemyStore(TokenStore):
+    """TokenStore keeping clients, tokens and nonces in SQL tables.
+
+    Tables are named with prefix and added to metadata, create them using
+    create_all. Client keys and tokens are unique and indexed, every token
+    is loaded along with its client, realm and owner in a single query.
+    Nonces are claimed with a single INSERT against a unique index.
+
+    Requires SQLAlchemy.
+    """
+
+    def __init__(self, engine, metadata=None, prefix=u'oauth_'):
+        from sqlalchemy import MetaData, Table, Column, ForeignKey, Index
+        from sqlalchemy import Integer, Unicode, UnicodeText, DateTime
+
+        self.engine = engine
+        self.local = local()
+        self.metadata = metadata = metadata or MetaData()
+
+        self.clients = Table(prefix + u'clients', metadata,
+            Column(u'id', Integer, primary_key=True),
+            Column(u'client_key', Unicode(255), nullable=False, unique=True),
+            Column(u'secret', Unicode(255)),
+            Column(u'pubkey', UnicodeText),
+            Column(u'callbacks', UnicodeText))
+
+        self.request_tokens = Table(prefix + u'request_tokens', metadata,
+            Column(u'id', Integer, primary_key=True),
+            Column(u'client_id', Integer, ForeignKey(self.clients.c.id),
+                nullable=False),
+            Column(u'token', Unicode(255), nullable=False, unique=True),
+            Column(u'secret', Unicode(255)),
+            Column(u'realm', Unicode(255)),
+            Column(u'callback', UnicodeText),
+            Column(u'verifier', Unicode(255)),
+            Column(u'resource_owner', Unicode(255)),
+            Column(u'created_at', DateTime),
+            Column(u'expires_at', DateTime, index=True))
+
+        self.access_tokens = Table(prefix + u'access_tokens', metadata,
+            Column(u'id', Integer, primary_key=True),
+            Column(u'client_id', Integer, ForeignKey(self.clients.c.id),
+                nullable=False),
+            Column(u'token', Unicode(255), nullable=False, unique=True),
+            Column(u'secret', Unicode(255)),
+            Column(u'realm', Unicode(255)),
+            Column(u'resource_owner', Unicode(255)),
+            Column(u'created_at', DateTime),
+            Column(u'expires_at', DateTime, index=True))
+
+        self.nonces = Table(prefix + u'nonces', metadata,
+            Column(u'id', Integer, primary_key=True),
+            Column(u'client_key', Unicode(255), nullable=False),
+            Column(u'timestamp', Integer, nullable=False, index=True),
+            Column(u'nonce', Unicode(255), nullable=False),
+            Index(prefix + u'nonces_unique', u'client_key', u'timestamp',
+                u'nonce', unique=True))
+
+    def create_all(self):
+        self.metadata.create_all(self.engine)
+
+    @contextmanager
+    def transaction(self):
+        """Have store calls of this thread share a connection and transaction.
+
+        Nested calls join the outermost transaction.
+        """
+        connection = getattr(self.local, u'connection', None)
+        if connection is not None:
+            yield connection
+            return
+        with self.engine.begin() as connection:
+            self.local.connection = connection
+            try:
+                yield connection
+            finally:
+                self.local.connection = None
+
+    def execute(self, *args, **kwargs):
+        """Execute within the transaction of this thread, if any."""
+        connection = getattr(self.local, u'connection', None)
+        return (connection or self.engine).execute(*args, **kwargs)
+
+    def load_client(self, client_key):
+        row = self.execute(self.clients.select().where(
+            self.clients.c.client_key == client_key)).first()
+        if row is None:
+            return None
+        return Record(client_key=row.client_key, secret=row.secret,
+                pubkey=row.pubkey,
+                callbacks=row.callbacks.splitlines() if row.callbacks else [])
+
+    def load_token(self, tokens, client_key, token):
+        from sqlalchemy import select
+        query = select([tokens, self.clients.c.client_key],
+                tokens.c.token == token,
+                from_obj=[tokens.join(self.clients)], use_labels=False)
+        if client_key is not None:
+            query = query.where(self.clients.c.client_key == client_key)
+        row = self.execute(query).first()
+        if row is None:
+            return None
+        return Record(**dict((key, row[key]) for key in row.keys()
+                             if key not in (u'id', u'client_id')))
+
+    def load_request_token(self, client_key, request_token):
+        return self.load_token(self.request_tokens, client_key, request_token)
+
+    def load_access_token(self, client_key, access_token):
+        return self.load_token(self.access_tokens, client_key, access_token)
+
+    def client_id(self, client_key):
+        from sqlalchemy import select
+        return select([self.clients.c.id],
+                self.clients.c.client_key == client_key).as_scalar()
+
+    def save_client(self, client_key, secret=None, pubkey=None, callbacks=()):
+        self.execute(self.clients.insert().values(
+            client_key=client_key, secret=secret, pubkey=pubkey,
+            callbacks=u'\n'.join(callbacks)))
+
+    def save_request_token(self, client_key, request_token, callback,
+            realm=None, secret=None, created_at=None, expires_at=None):
+        self.execute(self.request_tokens.insert().values(
+            client_id=self.client_id(client_key), token=request_token,
+            secret=secret, realm=realm, callback=callback,
+            created_at=created_at, expires_at=expires_at))
+
+    def save_verifier(self, request_token, verifier, resource_owner,
+            expires_at=None):
+        values = {u'verifier': verifier, u'resource_owner': resource_owner}
+        if expires_at is not None:
+            values[u'expires_at'] = expires_at
+        self.execute(self.request_tokens.update().where(
+            self.request_tokens.c.token == request_token).values(**values))
+
+    def save_access_token(self, client_key, access_token, request_token,
+            secret=None, created_at=None, expires_at=None):
+        from sqlalchemy import select
+        requests = self.request_tokens
+        with self.transaction() as connection:
+            row = connection.execute(select(
+                [requests.c.realm, requests.c.resource_owner],
+                requests.c.token == request_token)).first()
+            if row is None:
+                # i.e. purged since it was validated
+                raise ValueError("Unknown request token.")
+            connection.execute(self.access_tokens.insert().values(
+                client_id=self.client_id(client_key), token=access_token,
+                secret=secret, realm=row.realm,
+                resource_owner=row.resource_owner,
+                created_at=created_at, expires_at=expires_at))
+
+    def add_nonce(self, client_key, timestamp, nonce):
+        from sqlalchemy.exc import IntegrityError
+        try:
+            self.execute(self.nonces.insert().values(
+                client_key=client_key, timestamp=int(timestamp), nonce=nonce))
+            return True
+        except IntegrityError:
+            return False
+
+    def purge_expired(self, kind, before, limit):
+        from sqlalchemy import select
+        if kind == u'nonce':
+            table = self.nonces
+            expired = table.c.timestamp < calendar.timegm(before.utctimetuple())
+        else:
+            table = {u'request_token': self.request_tokens,
+                     u'access_token': self.access_tokens}[kind]
+            expired = table.c.expires_at < before
+        # Selected apart from the delete, as MySQL refuses a LIMIT within
+        # the subquery of an IN
+        with self.transaction() as connection:
+            ids = [row[0] for row in connection.execute(
+                select([table.c.id], expired).limit(limit))]
+            if not ids:
+                return 0
+            return connection.execute(
+                table.delete().where(table.c.id.in_(ids))).rowcount
+
+    def known_keys(self):
+        from sqlalchemy import select
+        for kind, column in ((u'client', self.clients.c.client_key),
+                             (u'request_token', self.request_tokens.c.token),
+                             (u'access_token', self.access_tokens.c.token)):
+            for row in self.execute(select([column])):
+                yield kind, row[0]
+
+
+class MongoStore(TokenStore):
+    """TokenStore keeping clients, tokens and nonces in MongoDB collections.
+
+    Either give a database, i.e. of a mongomock client in tests, or a uri
+    and database name in which case a single client is shared by all
+    stores of the process. Indexes, including TTL indexes which have
+    MongoDB itself expire tokens and nonces, are created on startup.
+
+    Tokens carry the key of their client so a token and its client are
+    matched by a single query, which only fetches the fields needed.
+
+    Nonces are removed by MongoDB nonce_lifetime seconds after their
+    timestamp, it should be no shorter than timestamp_lifetime.
+
+    Requires pymongo.
+    """
+
+    connections = {}
+    connections_lock = Lock()
+
+    token_fields = [u'client_key', u'token', u'secret', u'realm', u'callback',
+                    u'verifier', u'resource_owner', u'created_at',
+                    u'expires_at']
+
+    def __init__(self, database=None, uri=None, name=u'oauth',
+            prefix=u'oauth_', nonce_lifetime=600):
+        if database is None:
+            database = self.connect(uri)[name]
+        self.clients = database[prefix + u'clients']
+        self.request_tokens = database[prefix + u'request_tokens']
+        self.access_tokens = database[prefix + u'access_tokens']
+        self.nonces = database[prefix + u'nonces']
+        self.nonce_lifetime = nonce_lifetime
+        self.create_indexes()
+
+    @classmethod
+    def connect(cls, uri):
+        """Return the client of this process for uri, creating it once."""
+        import pymongo
+        # Clients must not be shared with forked processes
+        key = (uri, os.getpid())
+        with cls.connections_lock:
+            if key not in cls.connections:
+                cls.connections[key] = pymongo.MongoClient(uri)
+            return cls.connections[key]
+
+    def create_indexes(self):
+        self.clients.ensure_index(u'client_key', unique=True)
+        for tokens in (self.request_tokens, self.access_tokens):
+            tokens.ensure_index(u'token', unique=True)
+            tokens.ensure_index([(u'client_key', 1), (u'token', 1)])
+            tokens.ensure_index(u'expires_at', expireAfterSeconds=0)
+        self.nonces.ensure_index([(u'client_key', 1), (u'timestamp', 1),
+                                  (u'nonce', 1)], unique=True)
+        self.nonces.ensure_index(u'expires_at', expireAfterSeconds=0)
+
+    def load_client(self, client_key):
+        client = self.clients.find_one({u'client_key': client_key},
+                [u'client_key', u'secret', u'pubkey', u'callbacks'])
+        if client is None:
+            return None
+        return Record(client_key=client[u'client_key'],
+                secret=client.get(u'secret'), pubkey=client.get(u'pubkey'),
+                callbacks=client.get(u'callbacks', []))
+
+    def load_token(self, tokens, client_key, token):
+        query = {u'token': token}
+        if client_key is not None:
+            query[u'client_key'] = client_key
+        token = tokens.find_one(query, self.token_fields)
+        if token is None:
+            return None
+        return Record(**dict((str(field), token.get(field))
+                             for field in self.token_fields))
+
+    def load_request_token(self, client_key, request_token):
+        return self.load_token(self.request_tokens, client_key, request_token)
+
+    def load_access_token(self, client_key, access_token):
+        return self.load_token(self.access_tokens, client_key, access_token)
+
+    def save_client(self, client_key, secret=None, pubkey=None, callbacks=()):
+        self.clients.insert({u'client_key': client_key, u'secret': secret,
+                             u'pubkey': pubkey, u'callbacks': list(callbacks)})
+
+    def save_request_token(self, client_key, request_token, callback,
+            realm=None, secret=None, created_at=None, expires_at=None):
+        self.request_tokens.insert({u'client_key': client_key,
+                u'token': request_token, u'secret': secret, u'realm': realm,
+                u'callback': callback, u'verifier': None,
+                u'resource_owner': None, u'created_at': created_at,
+                u'expires_at': expires_at})
+
+    def save_verifier(self, request_token, verifier, resource_owner,
+            expires_at=None):
+        values = {u'verifier': verifier, u'resource_owner': resource_owner}
+        if expires_at is not None:
+            values[u'expires_at'] = expires_at
+        self.request_tokens.update({u'token': request_token},
+                {u'$set': values})
+
+    def save_access_token(self, client_key, access_token, request_token,
+            secret=None, created_at=None, expires_at=None):
+        request = self.request_tokens.find_one({u'token': request_token},
+                [u'realm', u'resource_owner'])
+        if request is None:
+            # i.e. expired since it was validated
+            raise ValueError("Unknown request token.")
+        self.access_tokens.insert({u'client_key': client_key,
+                u'token': access_token, u'secret': secret,
+                u'realm': request[u'realm'],
+                u'resource_owner': request[u'resource_owner'],
+                u'created_at': created_at, u'expires_at': expires_at})
+
+    def add_nonce(self, client_key, timestamp, nonce):
+        from pymongo.errors import DuplicateKeyError
+        timestamp = int(timestamp)
+        expires_at = datetime.utcfromtimestamp(timestamp + self.nonce_lifetime)
+        try:
+            self.nonces.insert({u'client_key': client_key,
+                    u'timestamp': timestamp, u'nonce': nonce,
+                    u'expires_at': expires_at})
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def purge_expired(self, kind, before, limit):
+        # Expired documents are removed by the TTL indexes
+        return 0
+
+    def known_keys(self):
+        for kind, documents, field in (
+                (u'client', self.clients, u'client_key'),
+                (u'request_token', self.request_tokens, u'token'),
+                (u'access_token', self.access_tokens, u'token')):
+            for document in documents.find({}, [field]):
+                yield kind, document[field]
+
+
+class RemoteStore(TokenStore):
+    """TokenStore of a resource server asking the authorization server.
+
+    Clients and access tokens are looked up through the introspection
+    route of an OAuthProvider at url, authenticated by a shared secret,
+    see OAuthProvider.introspection_url. Answers, including unknown keys,
+    are cached for ttl seconds. Lookups missing the cache within
+    batch_delay seconds of each other, i.e. from concurrent requests or
+    prefetched by the provider, are sent as a single batch of at most
+    batch_size keys, which should not exceed the introspection_batch_size
+    of the authorization server. Requests whose lookups fail, the server
+    answering with an error or not at all, get ServiceUnavailable.
+
+    Tokens can not be issued, and nonces are remembered in a NonceCache
+    of the process unless the provider keeps its own nonce cache.
+
+    transport(url, body, headers) posts and returns the status code and
+    body of the response, it defaults to urllib2 and may be replaced by
+    i.e. a Flask test client:
+
+        def transport(url, body, headers):
+            response = client.post(url, data=body, headers=headers)
+            return response.status_code, response.data
+
+        client = auth_app.test_client()
+        store = RemoteStore(u'/introspect', secret, transport=transport)
+    """
+
+    def __init__(self, url, secret, ttl=60, batch_delay=0.002,
+            batch_size=100, timeout=5, nonce_lifetime=600,
+            nonce_cache_size=100000, transport=None):
+        self.url = url
+        self.secret = secret
+        self.ttl = ttl
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.transport = transport or self.post
+        self.nonces = NonceCache(nonce_lifetime, nonce_cache_size)
+        self.cache = {}
+        self.batch = None
+        self.condition = Condition()
+
+    def load_client(self, client_key):
+        return self.lookup((client_key, None))[0]
+
+    def load_request_token(self, client_key, request_token):
+        return None
+
+    def load_access_token(self, client_key, access_token):
+        return self.lookup((client_key, access_token))[1]
+
+    def lookup(self, key):
+        """Return the (client, access token) records of a key, cached."""
+        now = time.time()
+        with self.condition:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+            batch = self.batch
+            # A full batch is sent as is, later keys start another one
+            leader = batch is None or (key not in batch.keys and
+                                       len(batch.keys) >= self.batch_size)
+            if leader:
+                batch = self.batch = Record(keys=set(), done=False,
+                        results=None, error=None)
+            batch.keys.add(key)
+
+        if leader:
+            time.sleep(self.batch_delay)
+            with self.condition:
+                if self.batch is batch:
+                    self.batch = None
+            try:
+                results, error = self.introspect(batch.keys), None
+            except Exception as err:
+                log.exception("Failed to introspect %d keys", len(batch.keys))
+                results, error = None, err
+            with self.condition:
+                if results is not None:
+                    expires = time.time() + self.ttl
+                    for result_key, records in results.items():
+                        self.cache[result_key] = (expires, records)
+                        # The client is also known from lookups of its tokens
+                        self.cache[(result_key[0], None)] = (expires,
+                                (records[0], None))
+                    self.expire(now)
+                batch.results, batch.error, batch.done = results, error, True
+                self.condition.notify_all()
+        else:
+            with self.condition:
+                while not batch.done:
+                    self.condition.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[key]
+
+    def expire(self, now):
+        if len(self.cache) > 100000:
+            for key, entry in list(self.cache.items()):
+                if entry[0] <= now:
+                    del self.cache[key]
+
+    def introspect(self, keys):
+        """Look up a batch of (client_key, token) tuples, token may be None."""
+        keys = list(keys)
+        body = json.dumps({u'lookups': keys})
+        headers = {u'Content-Type': u'application/json',
+                   u'Authorization': u'Bearer ' + self.secret}
+        status, data = self.transport(self.url, body, headers)
+        if status != 200:
+            log.error("Introspection answered %d: %s", status, data[:200])
+            raise ServiceUnavailable()
+        try:
+            data = json.loads(data)
+        except ValueError:
+            log.error("Introspection answered with invalid JSON")
+            raise ServiceUnavailable()
+        results = {}
+        for key, result in zip(keys, data[u'results']):
+            client = token = None
+            if result.get(u'client') is not None:
+                client = Record(client_key=key[0], callbacks=[],
+                                **self.fields(result[u'client']))
+            if result.get(u'access_token') is not None:
+                token = Record(client_key=key[0], token=key[1],
+                               created_at=None,
+                               **self.fields(result[u'access_token']))
+            results[key] = (client, token)
+        return results
+
+    def fields(self, values):
+        values = dict((str(name), value) for name, value in values.items())
+        if values.get('expires_at') is not None:
+            values['expires_at'] = datetime.utcfromtimestamp(
+                values['expires_at'])
+        return values
+
+    def post(self, url, body, headers):
+        import urllib2
+        request = urllib2.Request(url, body, headers)
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError as err:
+            return err.code, err.read()
+        except IOError:
+            log.exception("Failed to reach %s", url)
+            raise ServiceUnavailable()
+        return response.getcode(), response.read()
+
+    def save_client(self, client_key, secret=None, pubkey=None, callbacks=()):
+        raise NotImplementedError("Clients are registered with the "
+                                  "authorization server")
+
+    def save_request_token(self, client_key, request_token, callback,
+            realm=None, secret=None, created_at=None, expires_at=None):
+        raise NotImplementedError("Tokens are issued by the authorization "
+                                  "server")
+
+    def save_verifier(self, request_token, verifier, resource_owner,
+            expires_at=None):
+        raise NotImplementedError("Tokens are issued by the authorization "
+                                  "server")
+
+    def save_access_token(self, client_key, access_token, request_token,
+            secret=None, created_at=None, expires_at=None):
+        raise NotImplementedError("Tokens are issued by the authorization "
+                                  "server")
+
+    def add_nonce(self, client_key, timestamp, nonce):
+        return self.nonces.add(client_key, timestamp, nonce)
+
+    def purge_expired(self, kind, before, limit):
+        return 0
+
+
+class TokenSealer(object):
+    """Seals access token claims into self-contained tokens.
+
+    The client key, realm, resource owner id and expiry of an access token
+    are serialized and encrypted, then authenticated with HMAC-SHA256.
+    With PyCrypto installed, claims are encrypted using AES-256 in CTR mode
+    from a random 128 bit initial counter. Without it, they are xored with
+    a keystream of HMAC-SHA256 blocks of a random 128 bit IV and a block
+    counter. That is CTR mode using HMAC as the block function, sound but
+    not a vetted standard, so install PyCrypto where tokens are sealed.
+    Either way a keystream repeats with a chance of about n**2 / 2**129
+    among n tokens, negligible well beyond 2**48 tokens per master_key.
+
+    Tokens record which cipher sealed them. AES sealed tokens are refused
+    by servers lacking PyCrypto, all servers sharing a master_key should
+    thus have it or none. The encryption and authentication keys, and
+    those used to derive token secrets, are derived from master_key so
+    only servers knowing it can read, mint or verify tokens.
+
+    Tokens are base 62 encoded to only contain characters oauthlib deems
+    safe, they are a good deal longer than tokens stored server side.
+    """
+
+    aes_version = b'\x03'
+    keystream_version = b'\x02'
+    digits = u'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+    def __init__(self, master_key, secret_length=30):
+        if isinstance(master_key, unicode):
+            master_key = master_key.encode('utf-8')
+        derive = lambda label: hmac.new(master_key, label, hashlib.sha256).digest()
+        self.encryption_key = derive(b'encryption')
+        self.authentication_key = derive(b'authentication')
+        self.secret_key = derive(b'secret')
+        self.secret_length = secret_length
+        try:
+            from Crypto.Cipher import AES
+            from Crypto.Util import Counter
+        except ImportError:
+            self.aes = None
+            self.version = self.keystream_version
+        else:
+            self.aes = (AES, Counter)
+            self.version = self.aes_version
+
+    def seal(self, client_key, realm, resource_owner, expires_at=None):
+        """Return a token carrying the given claims."""
+        expiry = calendar.timegm(expires_at.utctimetuple()) if expires_at else 0
+        claims = json.dumps([client_key, realm, resource_owner, expiry])
+        iv = os.urandom(16)
+        sealed = self.version + iv + self.crypt(self.version, iv,
+                claims.encode('utf-8'))
+        return self.encode(sealed + self.tag(sealed))
+
+    def unseal(self, token):
+        """Return a Record of the claims of a token, or None if forged."""
+        sealed = self.decode(token)
+        if sealed is None or len(sealed) < 34:
+            return None
+        version = sealed[:1]
+        if version != self.keystream_version and (
+                version != self.aes_version or self.aes is None):
+            return None
+        sealed, tag = sealed[:-16], sealed[-16:]
+        if not safe_string_equals(self.tag(sealed), tag):
+            return None
+        claims = self.crypt(version, sealed[1:17], sealed[17:])
+        client_key, realm, resource_owner, expiry = json.loads(
+                claims.decode('utf-8'))
+        return Record(client_key=client_key, token=token,
+                secret=self.secret(token), realm=realm,
+                resource_owner=resource_owner, created_at=None,
+                expires_at=datetime.utcfromtimestamp(expiry) if expiry else None)
+
+    def secret(self, token):
+        """Derive the token secret, which is never stored, from the token."""
+        digest = hmac.new(self.secret_key, token.encode('utf-8'),
+                hashlib.sha512).digest()
+        # Any leading byte but zero keeps every digit of the digest
+        return self.encode(b'\x01' + digest)[-self.secret_length:]
+
+    def looks_sealed(self, token, max_length=512):
+        return (32 < len(token) <= max_length and
+                set(token) <= set(self.digits))
+
+    def tag(self, data):
+        return hmac.new(self.authentication_key, data,
+                hashlib.sha256).digest()[:16]
+
+    def crypt(self, version, iv, data):
+        """Encrypt or decrypt data by xoring it with a keystream."""
+        if version == self.aes_version:
+            AES, Counter = self.aes
+            counter = Counter.new(128, allow_wraparound=True,
+                    initial_value=int(binascii.hexlify(iv), 16))
+            return AES.new(self.encryption_key, AES.MODE_CTR,
+                    counter=counter).encrypt(data)
+        stream = b''.join(hmac.new(self.encryption_key,
+                iv + struct.pack('>I', block), hashlib.sha256).digest()
+                for block in range(len(data) // 32 + 1))
+        return b''.join(chr(ord(a) ^ ord(b)) for a, b in zip(data, stream))
+
+    def encode(self, data):
+        number = int(binascii.hexlify(data), 16)
+        encoded = []
+        while number:
+            number, digit = divmod(number, 62)
+            encoded.append(self.digits[digit])
+        return u''.join(reversed(encoded))
+
+    def decode(self, token):
+        number = 0
+        for digit in token:
+            index = self.digits.find(digit)
+            if index < 0:
+                return None
+            number = number * 62 + index
+        hexed = '%x' % number
+        return binascii.unhexlify('0' * (len(hexed) % 2) + hexed)
+
+
+class RSAKeyCache(object):
+    """A bounded cache of parsed RSA public keys.
+
+    Parsing a PEM encoded key costs about as much as verifying a signature
+    with it. Keys are cached per client along with a fingerprint of the
+    PEM they were parsed from, a changed key is thus parsed again. The
+    least recently used key is evicted once more than size are cached.
+
+    Requires PyCrypto, like RSA-SHA1 support in oauthlib.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.keys = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, client_key, pem):
+        """Return the parsed key of a client, parsing pem if needed."""
+        if isinstance(pem, unicode):
+            pem = pem.encode('utf-8')
+        fingerprint = hashlib.sha1(pem).digest()
+        with self.lock:
+            entry = self.keys.pop(client_key, None)
+            if entry is not None and entry[0] == fingerprint:
+                self.keys[client_key] = entry
+                return entry[1]
+
+        from Crypto.PublicKey import RSA
+        key = RSA.importKey(pem)
+        with self.lock:
+            self.keys[client_key] = (fingerprint, key)
+            while len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+        return key
+
+    def invalidate(self, client_key=None):
+        """Forget the key of a single client or, without a key, of all."""
+        with self.lock:
+            if client_key is None:
+                self.keys.clear()
+            else:
+                self.keys.pop(client_key, None)
+
+
+worker_rsa_keys = RSAKeyCache(1000)
+
+
+def verify_rsa_sha1_in_worker(client_key, pem, message, sig):
+    """Verify a RSA-SHA1 signature inside a RSAVerifierPool process."""
+    from Crypto.Signature import PKCS1_v1_5
+    from Crypto.Hash import SHA
+    key = worker_rsa_keys.get(client_key, pem)
+    return PKCS1_v1_5.new(key).verify(SHA.new(message), sig)
+
+
+def call_in_worker(func, *args):
+    """Call func in a pool process, returning (True, result) or (False, error).
+
+    Errors are returned rather than raised, pools only calling back for
+    jobs which succeeded.
+    """
+    try:
+        return True, func(*args)
+    except Exception as e:
+        return False, e
+
+
+class RSAVerifierPool(object):
+    """Verifies RSA-SHA1 signatures in a pool of worker processes.
+
+    RSA verification is CPU bound and would otherwise be serialized by the
+    GIL across all request threads. Only the key and the signature base
+    string, built in the request thread, are sent to a worker, which keeps
+    its own cache of parsed keys.
+
+    At most max_pending verifications may be queued or running, further
+    requests wait for a free spot. Waiting for a spot and for the result
+    take up to timeout seconds together, after which ServiceUnavailable
+    is raised. A spot is only freed
+    once its verification has finished, also when its request gave up
+    waiting for it, so that the queue never grows beyond max_pending.
+
+    Call start before serving requests. Pools do not survive a fork, a
+    server forking workers after loading the app should call start in
+    each worker, i.e. from a post fork hook, or the pool is started by
+    the first request of the worker.
+    """
+
+    def __init__(self, size, max_pending, timeout):
+        self.size = size
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self.condition = Condition()
+        self.pool = None
+        self.pid = None
+
+    def start(self):
+        """Start the worker processes, unless started by this process."""
+        with self.condition:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pending = 0
+                self.pool = multiprocessing.Pool(self.size)
+            return self.pool
+
+    def verify(self, client_key, pem, message, sig):
+        return self.call(verify_rsa_sha1_in_worker, client_key, pem, message,
+                sig)
+
+    def call(self, func, *args):
+        """Call func in a worker, waiting for a spot and for its result."""
+        pool = self.start()
+        deadline = time.time() + self.timeout
+        if not self.acquire(deadline):
+            raise ServiceUnavailable()
+        try:
+            result = pool.apply_async(call_in_worker, (func,) + args,
+                    callback=self.release)
+        except Exception:
+            self.release()
+            raise
+        try:
+            success, value = result.get(max(deadline - time.time(), 0))
+        except multiprocessing.TimeoutError:
+            raise ServiceUnavailable()
+        if not success:
+            raise value
+        return value
+
+    def acquire(self, deadline):
+        """Wait until deadline for a free spot, returning False if none was."""
+        with self.condition:
+            while self.pending >= self.max_pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.pending += 1
+            return True
+
+    def release(self, result=None):
+        """Free the spot of a finished verification."""
+        with self.condition:
+            self.pending -= 1
+            self.condition.notify()
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of a fraction of requests into flame graph files.
+
+    Each request is profiled with probability rate. While it runs, a
+    background thread records the stack of its thread every interval
+    seconds. Profiles of requests taking at least threshold seconds are
+    written to path as collapsed stacks, one "outer;inner count" line per
+    distinct stack as read by flamegraph.pl and speedscope. The oldest
+    files are removed once the directory holds over max_bytes of them.
+    """
+
+    def __init__(self, path, rate, threshold, interval, max_bytes):
+        self.path = path
+        self.rate = rate
+        self.threshold = threshold
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.active = {}
+        self.condition = Condition()
+        self.pid = None
+        self.written = 0
+
+    def wrap(self, f):
+        """Return f, profiled for a sample of its calls."""
+        @wraps(f)
+        def profiled(*args, **kwargs):
+            if random.random() >= self.rate:
+                return f(*args, **kwargs)
+            ident = current_thread().ident
+            self.start(ident)
+            start = timeit.default_timer()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                duration = timeit.default_timer() - start
+                samples = self.stop(ident)
+                if samples and duration >= self.threshold:
+                    self.write(f.__name__, duration, samples)
+        return profiled
+
+    def start(self, ident):
+        with self.condition:
+            self.active[ident] = {}
+            # Threads do not survive a fork, each worker needs its own
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                thread = Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+            self.condition.notify()
+
+    def stop(self, ident):
+        with self.condition:
+            return self.active.pop(ident, None)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.active:
+                    self.condition.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.condition:
+                for ident, samples in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = self.collapse(frame)
+                        samples[stack] = samples.get(stack, 0) + 1
+            del frames
+
+    def collapse(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(u'%s:%s' % (os.path.basename(code.co_filename),
+                                     code.co_name))
+            frame = frame.f_back
+        return u';'.join(reversed(stack))
+
+    def write(self, name, duration, samples):
+        self.written += 1
+        filename = os.path.join(self.path, u'%s-%d-%d-%s-%dms.folded' % (
+            time.strftime(u'%Y%m%d%H%M%S'), os.getpid(), self.written, name,
+            duration * 1000))
+        try:
+            with open(filename, u'w') as f:
+                for stack, count in sorted(samples.items()):
+                    f.write((u'%s %d\n' % (stack, count)).encode(u'utf-8'))
+            self.rotate()
+        except (IOError, OSError):
+            log.exception("Failed to write profile %s", filename)
+
+    def rotate(self):
+        """Remove the oldest profiles while over max_bytes in total."""
+        profiles = []
+        for name in os.listdir(self.path):
+            if name.endswith(u'.folded'):
+                filename = os.path.join(self.path, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                profiles.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(size for _, size, _ in profiles)
+        for _, size, filename in sorted(profiles):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                # Already removed by another process
+                pass
+            total -= size
+
+
+class Metrics(object):
+    """Counters and latency histograms in the Prometheus text format.
+
+    Without a path only this process is reported. Given a directory shared
+    by all worker processes, each process dumps its metrics to a file of
+    its own at most every interval seconds and on exit, and rendering sums
+    the metrics of every file. Files of exited processes are kept as their
+    counts still count.
+
+    Collectors are callables returning (name, labels, value) tuples of
+    counters kept elsewhere, i.e. cache hits, read when dumping or rendering.
+    """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, path=None, interval=1):
+        self.path = path
+        self.interval = interval
+        self.collectors = []
+        self.lock = Lock()
+        # Dumps of concurrent requests would write the same temporary file
+        self.dump_lock = Lock()
+        self.reset()
+        if path is not None:
+            atexit.register(self.dump)
+
+    def reset(self):
+        # Metrics inherited from a parent process are already in its file
+        self.pid = os.getpid()
+        self.counters = {}
+        self.histograms = {}
+        self.dumped = time.time()
+
+    def inc(self, name, labels, value=1):
+        """Add value to the counter name with a dict of labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.maybe_dump()
+
+    def observe(self, name, labels, value):
+        """Count value in the histogram name with a dict of labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+        self.maybe_dump()
+
+    def snapshot(self):
+        """Return the counters and histograms of this process."""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            counters = dict(self.counters)
+            histograms = dict((key, list(value)) for key, value
+                              in self.histograms.items())
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                key = (name, tuple(sorted(labels.items())))
+                counters[key] = counters.get(key, 0) + value
+        return counters, histograms
+
+    def filename(self, pid):
+        return os.path.join(self.path, u'metrics-%d.json' % pid)
+
+    def maybe_dump(self):
+        if self.path is None:
+            return
+        with self.lock:
+            now = time.time()
+            if now - self.dumped < self.interval:
+                return
+            self.dumped = now
+        self.dump()
+
+    def dump(self):
+        """Atomically replace the metrics file of this process."""
+        with self.dump_lock:
+            counters, histograms = self.snapshot()
+            data = {u'counters': [[k[0], k[1], v]
+                                  for k, v in counters.items()],
+                    u'histograms': [[k[0], k[1], v]
+                                    for k, v in histograms.items()]}
+            filename = self.filename(os.getpid())
+            try:
+                with open(filename + u'.tmp', u'w') as f:
+                    json.dump(data, f)
+                os.rename(filename + u'.tmp', filename)
+            except (IOError, OSError):
+                log.exception("Failed to dump metrics to %s", filename)
+
+    def collect(self):
+        """Sum the metrics of this process with those of all other files."""
+        counters, histograms = self.snapshot()
+        if self.path is None:
+            return counters, histograms
+        own = os.path.basename(self.filename(os.getpid()))
+        for name in os.listdir(self.path):
+            if name == own or not name.endswith(u'.json'):
+                continue
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    data = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            for metric, labels, value in data[u'counters']:
+                key = (metric, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for metric, labels, value in data[u'histograms']:
+                key = (metric, tuple(tuple(label) for label in labels))
+                if key in histograms:
+                    value = [a + b for a, b in zip(histograms[key], value)]
+                histograms[key] = value
+        return counters, histograms
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        counters, histograms = self.collect()
+        lines = []
+        for name, samples in self.group(counters):
+            lines.append(u'# TYPE %s counter' % name)
+            for labels, value in samples:
+                lines.append(u'%s%s %s' % (name, self.labels(labels),
+                                            self.number(value)))
+        for name, samples in self.group(histograms):
+            lines.append(u'# TYPE %s histogram' % name)
+            for labels, value in samples:
+                count = 0
+                bounds = [repr(bound) for bound in self.buckets] + [u'+Inf']
+                for bound, observed in zip(bounds, value):
+                    count += observed
+                    lines.append(u'%s_bucket%s %d' % (name,
+                            self.labels(labels + ((u'le', bound),)), count))
+                lines.append(u'%s_sum%s %s' % (name, self.labels(labels),
+                                                self.number(value[-1])))
+                lines.append(u'%s_count%s %d' % (name, self.labels(labels),
+                                                  count))
+        return u'\n'.join(lines) + u'\n'
+
+    def group(self, metrics):
+        names = {}
+        for (name, labels), value in sorted(metrics.items()):
+            names.setdefault(name, []).append((labels, value))
+        return sorted(names.items())
+
+    def labels(self, labels):
+        if not labels:
+            return u''
+        return u'{%s}' % u','.join(u'%s="%s"' % (key, unicode(value)
+                .replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+                .replace(u'\n', u'\\n')) for key, value in labels)
+
+    def number(self, value):
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class TokenPool(object):
+    """Serves random tokens sliced from a pool of pregenerated characters.
+
+    oauthlib's generate_token draws each character from SystemRandom on
+    its own. Here block_size bytes are read from os.urandom at once and
+    translated into chars in bulk, bytes which would bias the choice of
+    characters being dropped, so that a token is a slice of the pool.
+
+    The pool is discarded in forked processes, which would otherwise hand
+    out the same tokens as their parent.
+    """
+
+    def __init__(self, block_size, chars=UNICODE_ASCII_CHARACTER_SET):
+        self.block_size = block_size
+        # Only the largest multiple of len(chars) bytes maps evenly
+        limit = 256 - 256 % len(chars)
+        self.table = bytes(bytearray(ord(chars[b % len(chars)])
+                                     if b < limit else 0 for b in range(256)))
+        self.rejected = bytes(bytearray(range(limit, 256)))
+        self.pool = u''
+        self.offset = 0
+        self.pid = None
+        self.lock = Lock()
+
+    def token(self, length):
+        """Return a random token of length characters."""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pool, self.offset = u'', 0
+            while len(self.pool) - self.offset < length:
+                self.refill()
+            token = self.pool[self.offset:self.offset + length]
+            self.offset += length
+            return token
+
+    def refill(self):
+        data = os.urandom(max(self.block_size, 256))
+        chars = data.translate(self.table, self.rejected).decode('ascii')
+        self.pool, self.offset = self.pool[self.offset:] + chars, 0
 
 
 class OAuthProvider(Server):
@@ -20,11 +1954,14 @@ class OAuthProvider(Server):
     and documented as to how they fit into the whole OAuth workflow. Detailed
     descriptions of these methods are provided in respective method __doc__.
 
-    Providers will have to implement the following methods:
+    Providers will have to implement the following methods, unless a
+    TokenStore such as SQLAlchemyStore or MongoStore is given in which case only register,
+    authorize and current_resource_owner remain:
 
     * register(self)
     * save_timestamp_and_nonce(self, client_key, timestamp, nonce,
             request_token=None, access_token=None
+      (unless nonce_cache_size is set)
     * authorize(self)
     * get_callback(self, request_token)
     * save_request_token(self, client_key, request_token, callback, realm=None,
@@ -44,6 +1981,16 @@ class OAuthProvider(Server):
     returned to clients. They will be saved using the abstract methods outlined
     earlier.
 
+    Validators, getters and save_* methods usually need the same client and
+    token records. Implementing the following loaders and reading records
+    through get_client, get_request_token, get_access_token and
+    get_resource_owner ensures each record is only fetched once per request:
+
+    * load_client(self, client_key)
+    * load_request_token(self, client_key, request_token)
+    * load_access_token(self, client_key, access_token)
+    * load_resource_owner(self, token)
+
     A successful provider implementation will enable views to be easily and
     securely protected. Providers will also enjoy fine-grained control over
     which clients can access which resources through the use of realms.
@@ -85,6 +2032,284 @@ class OAuthProvider(Server):
     def secret_length(self):
         return 30
 
+    @property
+    def token_pool_size(self):
+        """Bytes of entropy read at once to generate tokens from, 0 disables.
+
+        Tokens are then sliced from a pool of random characters rather than
+        generated one character at a time, see TokenPool. 4096 serves over
+        a hundred tokens per read of the system's random source.
+        """
+        return 0
+
+    @property
+    def client_cache_size(self):
+        """Number of client records cached by get_client, 0 disables."""
+        return 0
+
+    @property
+    def client_cache_ttl(self):
+        """Seconds before a cached client record is loaded again."""
+        return 300
+
+    @property
+    def prefetch_pool_size(self):
+        """Threads loading client and token records concurrently, 0 disables.
+
+        Loaders then run outside of the request context, in threads of
+        their own, and must neither use flask.request nor records bound to
+        the storage session of another thread.
+        """
+        return 0
+
+    @property
+    def rate_limits(self):
+        """Token bucket limits by (endpoint, realm), empty disables.
+
+        Values are (rate, burst) tuples, allowing on average rate requests
+        per second and at most burst at once, per client key. Endpoints are
+        those of Flask, i.e. u'request_token' or a protected view, realms
+        those required by the view or else requested. Either may be None
+        to match all, the most specific key applies. A view requiring one
+        of several realms, or a request for several, is limited as the
+        first of them with a limit of its own. Clients have a bucket per
+        endpoint and realm of the limit applied. For example:
+
+            {(None, None): (10, 50), (u'access_token', None): (1, 5)}
+        """
+        return {}
+
+    @property
+    def rate_limit_per_token(self):
+        """Also limit each access token on its own, using the same limits."""
+        return False
+
+    @property
+    def rate_limit_size(self):
+        """Buckets to keep, beyond which the least recently used are reset."""
+        return 100000
+
+    @property
+    def rate_limit_path(self):
+        """File sharing the buckets between processes, None keeps them local."""
+        return None
+
+    @property
+    def introspection_url(self):
+        """Route describing clients and access tokens to resource servers.
+
+        Resource servers running apart from this provider look up tokens
+        using a RemoteStore pointed at it. None disables, the route is
+        also disabled without an introspection_secret.
+        """
+        return None
+
+    @property
+    def introspection_secret(self):
+        """Secret shared with resource servers, sent as a Bearer token."""
+        return None
+
+    @property
+    def introspection_batch_size(self):
+        """Most lookups answered by a single introspection request."""
+        return 100
+
+    @property
+    def negative_cache_size(self):
+        """Unknown client keys and tokens to remember, 0 disables.
+
+        Unknown keys are answered without a storage round trip for
+        negative_cache_ttl seconds after having been looked up, though not
+        faster than a lookup takes on average. Keys registered in another
+        process are only seen once that has passed.
+        """
+        return 0
+
+    @property
+    def negative_cache_ttl(self):
+        return 60
+
+    @property
+    def bloom_filter_path(self):
+        """File sharing a Bloom filter of all keys between processes.
+
+        Keys not in the filter are rejected without a storage lookup. The
+        filter is filled using known_keys before the first request and
+        kept up to date as tokens are issued and clients saved through
+        save_client, or invalidate_client called. Clients saved directly
+        to the store after startup are rejected until then. None disables.
+
+        Rejected keys are answered after waiting as long as a lookup of
+        their kind takes on average, sparing storage but not the worker,
+        so that unknown keys can not be told apart by timing. Clients are
+        not waited for if client_cache_size is set, known clients then
+        being answered from memory as well.
+        """
+        return None
+
+    @property
+    def bloom_filter_capacity(self):
+        """Keys the Bloom filter is sized for at bloom_filter_error_rate."""
+        return 1000000
+
+    @property
+    def bloom_filter_error_rate(self):
+        return 0.01
+
+    @property
+    def rsa_key_cache_size(self):
+        """Number of parsed RSA public keys kept in memory."""
+        return 1000
+
+    @property
+    def rsa_pool_size(self):
+        """Processes verifying RSA-SHA1 signatures, 0 verifies in-thread."""
+        return 0
+
+    @property
+    def rsa_pool_max_pending(self):
+        """RSA-SHA1 verifications allowed to queue for the pool at once."""
+        return 4 * (self.rsa_pool_size or 1)
+
+    @property
+    def rsa_pool_timeout(self):
+        """Seconds to wait for the pool before answering 503."""
+        return 5
+
+    @property
+    def timestamp_skew(self):
+        """Seconds a request timestamp may be ahead of the server's clock.
+
+        Together with timestamp_lifetime, which bounds how far behind it
+        may be, this bounds for how long nonces must be remembered to
+        timestamp_lifetime + timestamp_skew. None accepts any timestamp
+        ahead, as oauthlib does.
+        """
+        return 300
+
+    @property
+    def nonce_cache_size(self):
+        """Number of nonces remembered in memory, 0 disables the cache.
+
+        It should exceed the number of requests expected within the
+        timestamp_lifetime + timestamp_skew window.
+
+        When enabled validate_timestamp_and_nonce and save_timestamp_and_nonce
+        no longer need to be implemented.
+        """
+        return 0
+
+    @property
+    def nonce_cache_path(self):
+        """File shared by worker processes to remember nonces in.
+
+        If not set nonces are only remembered within each process.
+        """
+        return None
+
+    @property
+    def metrics_url(self):
+        """Route serving metrics in the Prometheus text format, None disables.
+
+        Metrics are collected through signals and thus require blinker.
+        Protect the route from the public, i.e. in a reverse proxy.
+        """
+        return None
+
+    @property
+    def metrics_path(self):
+        """Directory where worker processes share their metrics.
+
+        Without one each process only reports its own metrics. Clear the
+        directory whenever the server is restarted.
+        """
+        return None
+
+    @property
+    def profile_path(self):
+        """Directory to write profiles of sampled requests to, None disables.
+
+        See SamplingProfiler for the format, profiles are only taken of
+        views protected by require_oauth including the token endpoints.
+        """
+        return None
+
+    @property
+    def profile_sample_rate(self):
+        """Fraction of requests to profile, i.e. 0.01 for one in a hundred."""
+        return 0
+
+    @property
+    def profile_threshold(self):
+        """Only keep profiles of requests taking at least these seconds."""
+        return 0
+
+    @property
+    def profile_interval(self):
+        """Seconds between stack samples of a profiled request."""
+        return 0.005
+
+    @property
+    def profile_max_bytes(self):
+        """Size of the profile directory above which the oldest are removed."""
+        return 50 * 1024 * 1024
+
+    @property
+    def request_token_lifetime(self):
+        """Seconds a request token is valid for, None never expires it."""
+        return None
+
+    @property
+    def verifier_lifetime(self):
+        """Seconds a verifier is valid for, None never expires it."""
+        return None
+
+    @property
+    def access_token_lifetime(self):
+        """Seconds an access token is valid for, None never expires it."""
+        return None
+
+    @property
+    def token_master_key(self):
+        """Key to mint self-contained access tokens with, None disables them.
+
+        Self-contained tokens carry their client, realm, resource owner and
+        expiry, so they are validated without any storage lookup and never
+        passed to save_access_token. They can only be revoked before they
+        expire through access_token_revoked. Keep the key secret and share
+        it only with the servers validating tokens, which should all have
+        PyCrypto installed or none, see TokenSealer.
+        """
+        return None
+
+    @property
+    def reaper_interval(self):
+        """Seconds between purges of expired records, None disables it.
+
+        See purge_expired.
+        """
+        return None
+
+    @property
+    def reaper_chunk_size(self):
+        """Number of expired records deleted per purge_expired call."""
+        return 1000
+
+    @property
+    def write_batch_size(self):
+        """Writes passed to write_behind per batch, 0 writes immediately."""
+        return 0
+
+    @property
+    def write_batch_delay(self):
+        """Seconds a write passed to write_behind may wait for its batch."""
+        return 0.05
+
+    @property
+    def write_batch_retries(self):
+        """Times a batch failing to flush is retried before it is dropped."""
+        return 5
+
     # Methods that must be overloaded
 
     def register(self):
@@ -107,6 +2332,9 @@ class OAuthProvider(Server):
 
         * generate_client_key(self) for the client/consumer key
         * generate_client_secret(self) for the client/consumer secret
+
+        If client records are cached, see client_cache_size, any change to a
+        client must be followed by invalidate_client(self, client_key).
         """
         raise NotImplementedError("Must be implemented by inheriting classes")
 
@@ -116,7 +2344,24 @@ class OAuthProvider(Server):
 
         It is recommended that they are also connected to at least the client
         but preferably also the resource owner/user.
+
+        Nonces kept by the nonce cache or the store are already recorded
+        while validating.
         """
+        if self.nonce_store is None and self.store is None:
+            raise NotImplementedError("Must be implemented by inheriting classes")
+
+    def validate_timestamp_and_nonce(self, client_key, timestamp, nonce,
+            request_token=None, access_token=None):
+        """Check that the nonce has not been used and claim it if so.
+
+        Checking and recording the nonce in one step ensures two concurrent
+        requests can not both pass with the same nonce.
+        """
+        if self.nonce_store is not None:
+            return self.nonce_store.add(client_key, timestamp, nonce)
+        if self.store is not None:
+            return self.store.add_nonce(client_key, timestamp, nonce)
         raise NotImplementedError("Must be implemented by inheriting classes")
 
     def authorize(self):
@@ -153,20 +2398,44 @@ class OAuthProvider(Server):
         raise NotImplementedError("Must be implemented by inheriting classes")
 
 
+    def save_client(self, client_key, secret=None, pubkey=None,
+            callbacks=()):
+        """Register a client, or save changes to one, through the store.
+
+        The client is then known to the Bloom filter and forgotten by the
+        caches, see invalidate_client. Providers without a store save
+        clients themselves and call invalidate_client afterwards.
+        """
+        if self.store is None:
+            raise NotImplementedError("Must be implemented by inheriting classes")
+        with self.unit_of_work():
+            self.store.save_client(client_key, secret=secret, pubkey=pubkey,
+                    callbacks=callbacks)
+        self.invalidate_client(client_key)
+
     def get_callback(self, request_token):
         """Return the callback associated with the request token."""
-        raise NotImplementedError("Must be implemented by inheriting classes")
+        token = self.get_request_token(None, request_token)
+        return token.callback if token else None
 
     def save_request_token(self, client_key, request_token, callback, realm=None,
-            secret=None):
+            secret=None, **kwargs):
         """Store request tokens.
 
         This method is invoked by the request_token view and all you need to do
         is to store the token and its associated realm and token secret.
+
+        If request_token_lifetime is set created_at and expires_at keyword
+        arguments are passed as well. Store both, loaded records exposing
+        expires_at are treated as invalid once it has passed.
         """
-        raise NotImplementedError("Must be implemented by inheriting classes")
+        if self.store is None:
+            raise NotImplementedError("Must be implemented by inheriting classes")
+        self.store.save_request_token(client_key, request_token, callback,
+                realm=realm, secret=secret, **kwargs)
 
-    def save_verifier(self, request_token, verifier):
+    def save_verifier(self, request_token, verifier, created_at=None,
+            expires_at=None):
         """Store verifier and user associated with a specific request token.
 
         This method is invoked automatically by authorized.
@@ -178,11 +2447,67 @@ class OAuthProvider(Server):
         Since invocation of this method originates from the user accessing
         the authorize view you should be able to extract their ID easily from
         the request object.
+
+        If verifier_lifetime is set created_at and expires_at keyword
+        arguments are passed as well. The request token should then expire
+        no later than expires_at, as it is of no use after the verifier.
+
+        With a store the user is obtained from current_resource_owner.
+        Unknown and expired request tokens raise ValueError.
+        """
+        if self.store is None:
+            raise NotImplementedError("Must be implemented by inheriting classes")
+        token = self.get_request_token(None, request_token)
+        if token is None:
+            raise ValueError("Unknown request token.")
+        if token.expires_at is not None and expires_at is not None:
+            expires_at = min(token.expires_at, expires_at)
+        self.store.save_verifier(request_token, verifier,
+                self.current_resource_owner(), expires_at=expires_at)
+
+    def access_token_revoked(self, token):
+        """Check whether a self-contained access token has been revoked.
+
+        The token is a Record of the claims sealed into it. Revocation lists
+        should be small and kept in memory, or this defeats the purpose.
+        """
+        return False
+
+    def get_resource_owner_id(self, client_key, request_token):
+        """Return the id of the user who authorized a request token.
+
+        Sealed into self-contained access tokens, it must be serializable
+        as JSON. Defaults to the resource_owner of the request token record.
+        """
+        return self.get_request_token(client_key, request_token).resource_owner
+
+    def known_keys(self):
+        """Return an iterable of every (kind, key) for the Bloom filter.
+
+        Kind is one of u'client', u'request_token' and u'access_token' and
+        key the client key or token. Only invoked before the first request
+        if bloom_filter_path is set, defaults to the keys of the store.
+        """
+        if self.store is None:
+            raise NotImplementedError("Must be implemented by inheriting classes")
+        return self.store.known_keys()
+
+    def active_rsa_clients(self):
+        """Return keys of RSA-SHA1 clients whose keys to parse at startup.
+
+        Invoked before the first request, defaults to none.
+        """
+        return []
+
+    def current_resource_owner(self):
+        """Return the id of the user authorizing access in this request.
+
+        Only needed by the default save_verifier used with a store.
         """
         raise NotImplementedError("Must be implemented by inheriting classes")
 
     def save_access_token(self, client_key, access_token, request_token,
-            secret=None):
+            secret=None, **kwargs):
         """Store access tokens.
 
         This method is invoked by the access_token view and there are two
@@ -190,15 +2515,244 @@ class OAuthProvider(Server):
 
         1. Retrieve the associated user and realm using request_token
         2. Associate the realm and user with the new access token
+
+        If access_token_lifetime is set created_at and expires_at keyword
+        arguments are passed as well.
+        """
+        if self.store is None:
+            raise NotImplementedError("Must be implemented by inheriting classes")
+        self.store.save_access_token(client_key, access_token, request_token,
+                secret=secret, **kwargs)
+
+    # Methods that may be overloaded to share lookups within a request,
+    # they default to loading from the store if one was given.
+
+    def load_client(self, client_key):
+        """Return the client record for client_key or None if unknown.
+
+        Note that the dummy client is never a known client.
+        """
+        if self.store is None:
+            raise NotImplementedError("Must be implemented by inheriting classes")
+        return self.store.load_client(client_key)
+
+    def load_request_token(self, client_key, request_token):
+        """Return the request token record issued to client_key or None.
+
+        A client_key of None means the token is looked up regardless of
+        client, as is done during authorization by the resource owner.
+        """
+        if self.store is None:
+            raise NotImplementedError("Must be implemented by inheriting classes")
+        return self.store.load_request_token(client_key, request_token)
+
+    def load_access_token(self, client_key, access_token):
+        """Return the access token record issued to client_key or None."""
+        if self.store is None:
+            raise NotImplementedError("Must be implemented by inheriting classes")
+        return self.store.load_access_token(client_key, access_token)
+
+    def load_resource_owner(self, token):
+        """Return the resource owner who authorized the given token record.
+
+        Stores only know the id of the owner, which is returned as is.
+        """
+        if self.store is None:
+            raise NotImplementedError("Must be implemented by inheriting classes")
+        return token.resource_owner
+
+    # OAuthLib validators and getters reading the records returned by the
+    # loaders, see TokenStore for the attributes records are expected to have.
+
+    @property
+    def dummy_client(self):
+        return u'dummy_client'
+
+    @property
+    def dummy_request_token(self):
+        return u'dummy_request_token'
+
+    @property
+    def dummy_access_token(self):
+        return u'dummy_access_token'
+
+    def validate_client_key(self, client_key):
+        return self.get_client(client_key) is not None
+
+    def validate_redirect_uri(self, client_key, redirect_uri):
+        client = self.get_client(client_key)
+        if client is None:
+            return False
+        if redirect_uri is None:
+            return len(client.callbacks) == 1
+        return redirect_uri in client.callbacks
+
+    def validate_requested_realm(self, client_key, realm):
+        return True
+
+    def validate_realm(self, client_key, access_token, uri=None,
+            required_realm=None):
+        # Requesting a token for a realm also ends up here, without an
+        # access token, the realm having been checked by check_realm
+        if not required_realm:
+            return True
+        token = self.get_access_token(client_key, access_token)
+        if token is None:
+            return False
+        return bool(self.token_realm_mask(token) &
+                    self.realm_mask(required_realm))
+
+    def validate_request_token(self, client_key, request_token):
+        return self.get_request_token(client_key, request_token) is not None
+
+    def validate_access_token(self, client_key, access_token):
+        return self.get_access_token(client_key, access_token) is not None
+
+    def validate_verifier(self, client_key, request_token, verifier):
+        token = self.get_request_token(client_key, request_token)
+        return (token is not None and token.verifier is not None and
+                safe_string_equals(token.verifier, verifier))
+
+    def get_realm(self, client_key, request_token):
+        token = self.get_request_token(client_key, request_token)
+        return token.realm if token else None
+
+    def get_client_secret(self, client_key):
+        client = self.get_client(client_key)
+        return client.secret if client else None
+
+    def get_rsa_key(self, client_key):
+        client = self.get_client(client_key)
+        return client.pubkey if client else None
+
+    def get_request_token_secret(self, client_key, request_token):
+        token = self.get_request_token(client_key, request_token)
+        return token.secret if token else None
+
+    def get_access_token_secret(self, client_key, access_token):
+        token = self.get_access_token(client_key, access_token)
+        return token.secret if token else None
+
+    def purge_expired(self, kind, before, limit):
+        """Delete at most limit records which expired before a UTC datetime.
+
+        Invoked periodically from a background thread if reaper_interval is
+        set, kind is one of u'request_token' and u'access_token' if their
+        lifetimes are set and u'nonce' unless nonces are kept by the nonce
+        cache. Tokens are expired once their expires_at, which should be
+        indexed, is before the given datetime. Nonces are expired once their
+        timestamp is, as before is then already timestamp_lifetime ago.
+
+        Return the number of deleted records.
+        """
+        if self.store is None:
+            raise NotImplementedError("Must be implemented by inheriting classes")
+        return self.store.purge_expired(kind, before, limit)
+
+    def flush_writes(self, writes):
+        """Persist a batch of writes passed to write_behind.
+
+        Writes are (kind, record) tuples in the order they were made, kinds
+        and records are whatever the save_* methods passed to write_behind.
+        The whole batch should be persisted using a single transaction.
+
+        Batches are flushed from a background thread if write_batch_size is
+        set, so records must not be bound to any request specific state
+        such as a database session. Use Record for plain records.
         """
         raise NotImplementedError("Must be implemented by inheriting classes")
 
     # There be dragons beyond this point, tread lightly.
 
-    def __init__(self, app):
-        """Setup routes and OAuth token methods."""
+    def __init__(self, app, store=None):
+        """Setup routes and OAuth token methods.
+
+        A TokenStore may be given to provide all storage related methods.
+        """
+        self.store = store
+        self.compile_realms()
+        if self.token_pool_size:
+            self.token_pool = TokenPool(self.token_pool_size)
+        else:
+            self.token_pool = None
+        self.rsa_keys = RSAKeyCache(self.rsa_key_cache_size)
+        if self.prefetch_pool_size:
+            self.prefetch_pool = PrefetchPool(self.prefetch_pool_size)
+        else:
+            self.prefetch_pool = None
+        if self.rsa_pool_size:
+            self.rsa_pool = RSAVerifierPool(self.rsa_pool_size,
+                    self.rsa_pool_max_pending, self.rsa_pool_timeout)
+        else:
+            self.rsa_pool = None
+        if self.token_master_key:
+            self.token_sealer = TokenSealer(self.token_master_key,
+                    self.secret_length)
+        else:
+            self.token_sealer = None
+        if self.profile_path and self.profile_sample_rate:
+            self.profiler = SamplingProfiler(self.profile_path,
+                    self.profile_sample_rate, self.profile_threshold,
+                    self.profile_interval, self.profile_max_bytes)
+        else:
+            self.profiler = None
         self.request_token = self.require_oauth(require_resource_owner=False)(self.request_token)
         self.access_token = self.require_oauth(require_verifier=True)(self.access_token)
+        if self.client_cache_size:
+            self.client_cache = ClientCache(self.client_cache_size,
+                    self.client_cache_ttl)
+        else:
+            self.client_cache = None
+        if self.rate_limits and self.rate_limit_path:
+            self.rate_buckets = SharedTokenBuckets(self.rate_limit_path,
+                    self.rate_limit_size)
+        elif self.rate_limits:
+            self.rate_buckets = TokenBuckets(self.rate_limit_size)
+        else:
+            self.rate_buckets = None
+        if self.negative_cache_size:
+            self.negative_cache = NegativeCache(self.negative_cache_size,
+                    self.negative_cache_ttl)
+        else:
+            self.negative_cache = None
+        if self.bloom_filter_path:
+            self.bloom_filter = BloomFilter(self.bloom_filter_path,
+                    self.bloom_filter_capacity, self.bloom_filter_error_rate)
+        else:
+            self.bloom_filter = None
+        self.lookup_timer = LookupTimer()
+        if self.write_batch_size:
+            self.write_queue = WriteBehindQueue(self.flush_writes,
+                    self.write_batch_size, self.write_batch_delay,
+                    self.write_batch_retries, self.drop_writes)
+        else:
+            self.write_queue = None
+        if self.reaper_interval:
+            kinds = [(u'request_token', self.request_token_lifetime),
+                     (u'access_token', self.access_token_lifetime)]
+            kinds = [(kind, 0) for kind, lifetime in kinds if lifetime]
+            if not self.nonce_cache_size:
+                kinds.append((u'nonce', self.timestamp_lifetime))
+            self.reaper = Reaper(self.purge_expired, kinds,
+                    self.reaper_interval, self.reaper_chunk_size)
+        else:
+            self.reaper = None
+        if self.nonce_cache_size and self.nonce_cache_path:
+            self.nonce_store = SharedNonceCache(self.nonce_cache_path,
+                    self.timestamp_lifetime, self.nonce_cache_size)
+        elif self.nonce_cache_size:
+            self.nonce_store = NonceCache(self.timestamp_lifetime,
+                    self.nonce_cache_size)
+        else:
+            self.nonce_store = None
+        if self.metrics_url:
+            self.metrics = Metrics(self.metrics_path)
+            self.metrics.collectors.append(self.cache_metrics)
+            phase_timed.connect(self.count_phase, sender=self)
+            request_handled.connect(self.count_request, sender=self)
+            writes_dropped.connect(self.count_dropped_writes, sender=self)
+        else:
+            self.metrics = None
         if app is not None:
             self.app = app
             self.init_app(app)
@@ -215,16 +2769,39 @@ class OAuthProvider(Server):
                          methods=[u'GET', u'POST'])
         app.add_url_rule(self.authorize_url, view_func=self.authorize,
                          methods=[u'GET', u'POST'])
+        if self.introspection_url and self.introspection_secret:
+            app.add_url_rule(self.introspection_url,
+                             view_func=self.introspect, methods=[u'POST'])
+        if self.metrics is not None:
+            app.add_url_rule(self.metrics_url, view_func=self.metrics_view,
+                             methods=[u'GET'])
+        if self.reaper is not None:
+            app.before_first_request(self.reaper.start)
+        app.before_first_request(self.warm_rsa_keys)
+        if self.rsa_pool is not None:
+            self.rsa_pool.start()
+        if self.bloom_filter is not None:
+            app.before_first_request(
+                lambda: self.bloom_filter.populate(self.known_keys()))
 
     def authorized(self, request_token):
-        """Create a verifier for an user authorized client"""
-        verifier = generate_token(length=self.verifier_length[1])
-        self.save_verifier(request_token, verifier)
+        """Create a verifier for an user authorized client
+
+        Raises BadRequest if save_verifier refuses the request token, i.e.
+        by raising ValueError as it is unknown or has expired.
+        """
+        verifier = self.generate_token(self.verifier_length[1])
+        try:
+            with self.unit_of_work():
+                self.call_hook(u'save_verifier', request_token, verifier,
+                        **self.expiry(self.verifier_lifetime))
+                callback = self.call_hook(u'get_callback', request_token)
+        except ValueError as err:
+            raise BadRequest(err.message)
         response = [
             (u'oauth_token', request_token),
             (u'oauth_verifier', verifier)
         ]
-        callback = self.get_callback(request_token)
         return redirect(add_params_to_uri(callback, response))
 
     def request_token(self):
@@ -236,10 +2813,12 @@ class OAuthProvider(Server):
         realm = request.oauth.realm
         # TODO: fallback on default realm?
         callback = request.oauth.callback_uri
-        request_token = generate_token(length=self.request_token_length[1])
-        token_secret = generate_token(length=self.secret_length)
-        self.save_request_token(client_key, request_token, callback,
-            realm=realm, secret=token_secret)
+        request_token = self.generate_token(self.request_token_length[1])
+        token_secret = self.generate_token(self.secret_length)
+        self.call_hook(u'save_request_token', client_key, request_token,
+            callback, realm=realm, secret=token_secret,
+            **self.expiry(self.request_token_lifetime))
+        self.issued(u'request_token', client_key, request_token)
         return urlencode([(u'oauth_token', request_token),
                           (u'oauth_token_secret', token_secret),
                           (u'oauth_callback_confirmed', u'true')])
@@ -249,79 +2828,882 @@ class OAuthProvider(Server):
 
         Defaults to /access_token. Invoked by client applications.
         """
-        access_token = generate_token(length=self.access_token_length[1])
-        token_secret = generate_token(self.secret_length)
         client_key = request.oauth.client_key
-        self.save_access_token(client_key, access_token,
-            request.oauth.resource_owner_key, secret=token_secret)
+        request_token = request.oauth.resource_owner_key
+        expiry = self.expiry(self.access_token_lifetime)
+        if self.token_sealer is not None:
+            access_token = self.token_sealer.seal(client_key,
+                    self.get_realm(client_key, request_token),
+                    self.get_resource_owner_id(client_key, request_token),
+                    expiry.get(u'expires_at'))
+            token_secret = self.token_sealer.secret(access_token)
+        else:
+            access_token = self.generate_token(self.access_token_length[1])
+            token_secret = self.generate_token(self.secret_length)
+            self.call_hook(u'save_access_token', client_key, access_token,
+                request_token, secret=token_secret, **expiry)
+            self.issued(u'access_token', client_key, access_token)
         return urlencode([(u'oauth_token', access_token),
                           (u'oauth_token_secret', token_secret)])
 
+    @property
+    def lookups(self):
+        """The lookup context of the current request.
+
+        Outside of a request a fresh, and thus unshared, context is returned.
+        """
+        ctx = _request_ctx_stack.top
+        if ctx is None:
+            return LookupContext()
+        lookups = getattr(ctx, 'oauth_lookups', None)
+        if lookups is None:
+            lookups = ctx.oauth_lookups = LookupContext()
+        return lookups
+
+    def get_client(self, client_key):
+        """Return the client record, loaded at most once per request.
+
+        Records are also shared between requests if client_cache_size is set.
+        """
+        return self.lookups.get(u'client', (client_key,),
+                self.load_cached_client)
+
+    def compile_realms(self):
+        """Assign each of realms a bit, for realm_mask to combine."""
+        self.realm_bits = dict((realm, 1 << i)
+                               for i, realm in enumerate(self.realms))
+        self.realm_masks = {}
+
+    def realm_mask(self, realms):
+        """Return the bitmask of a space separated string or tuple of realms.
+
+        Unknown realms are ignored. Masks are memoized, there being only
+        as many as combinations of realms in use.
+        """
+        try:
+            return self.realm_masks[realms]
+        except KeyError:
+            pass
+        if isinstance(realms, basestring):
+            names = realms.split()
+        else:
+            names = realms
+        mask = 0
+        for name in names:
+            mask |= self.realm_bits.get(name, 0)
+        if len(self.realm_masks) < 1024:
+            self.realm_masks[realms] = mask
+        return mask
+
+    def token_realm_mask(self, token):
+        """Return the bitmask of the realms granted to a token record.
+
+        Records may carry a precomputed realm_mask, else it is computed
+        from their space separated realm.
+        """
+        if isinstance(token, dict):
+            mask, realm = token.get(u'realm_mask'), token.get(u'realm')
+        else:
+            mask = getattr(token, u'realm_mask', None)
+            realm = getattr(token, u'realm', None)
+        if mask is None:
+            mask = self.realm_mask(realm or u'')
+        return mask
+
+    def check_realm(self, realm):
+        """Check that each of a space separated list of realms is allowed."""
+        names = realm.split()
+        return bool(names) and all(name in self.realm_bits for name in names)
+
+    def load_cached_client(self, client_key):
+        """Load a client through the client cache, if enabled."""
+        loader = partial(self.load_known, u'client', u'load_client')
+        if self.client_cache is None:
+            return loader(client_key)
+        return self.client_cache.get(client_key, loader)
+
+    def load_known(self, kind, hook, *key):
+        """Call the loader hook unless the last of key is known to be missing.
+
+        Keys not in the Bloom filter are missing, as are those which the
+        negative cache has seen missing recently. Either is answered as
+        slowly as a lookup.
+        """
+        if (self.bloom_filter is not None and
+                not self.bloom_filter.may_contain(kind, key[-1])):
+            self.wait_as_lookup(kind)
+            return None
+        if self.negative_cache is None:
+            return self.timed_lookup(kind, hook, *key)
+        looked_up = []
+
+        def load():
+            looked_up.append(True)
+            return self.timed_lookup(kind, hook, *key)
+        record = self.negative_cache.get((kind,) + key, load)
+        if not looked_up:
+            self.wait_as_lookup(kind)
+        return record
+
+    def wait_as_lookup(self, kind):
+        """Wait as long as a lookup of a kind of key takes on average."""
+        # Known clients are answered from the client cache, as quickly
+        if kind != u'client' or self.client_cache is None:
+            self.lookup_timer.wait(kind)
+
+    def timed_lookup(self, kind, hook, *key):
+        """Call the loader hook, timing it for the waits of known misses."""
+        if self.bloom_filter is None and self.negative_cache is None:
+            return self.call_hook(hook, *key)
+        start = timeit.default_timer()
+        try:
+            return self.call_hook(hook, *key)
+        finally:
+            self.lookup_timer.observe(kind, timeit.default_timer() - start)
+
+    def issued(self, kind, client_key, key):
+        """Make a newly saved token known to the negative caches."""
+        if self.bloom_filter is not None:
+            self.bloom_filter.add(kind, key)
+        if self.negative_cache is not None:
+            self.negative_cache.forget((kind, client_key, key))
+            self.negative_cache.forget((kind, None, key))
+
+    def invalidate_client(self, client_key=None):
+        """Forget cached records of a client whose record has changed.
+
+        Call this after registering or updating a client, i.e. when it has
+        uploaded a new RSA key, or without a key to forget all clients.
+        Newly registered clients are thereby added to the Bloom filter.
+        """
+        if self.client_cache is not None:
+            self.client_cache.invalidate(client_key)
+        if self.negative_cache is not None:
+            self.negative_cache.forget(
+                None if client_key is None else (u'client', client_key))
+        if self.bloom_filter is not None and client_key is not None:
+            self.bloom_filter.add(u'client', client_key)
+        self.rsa_keys.invalidate(client_key)
+        if client_key is None:
+            self.lookups.records.clear()
+        else:
+            self.lookups.forget(u'client', (client_key,))
+
+    def get_request_token(self, client_key, request_token):
+        """Return the request token record, loaded at most once per request.
+
+        Expired tokens are returned as None.
+        """
+        loader = partial(self.load_known, u'request_token',
+                u'load_request_token')
+        token = self.lookups.get(u'request_token', (client_key, request_token),
+                loader)
+        return None if self.is_expired(token) else token
+
+    def get_access_token(self, client_key, access_token):
+        """Return the access token record, loaded at most once per request.
+
+        Self-contained tokens are unsealed rather than loaded. Expired and
+        revoked tokens are returned as None.
+        """
+        token = self.lookups.get(u'access_token', (client_key, access_token),
+                self.access_token_loader(access_token))
+        return None if self.is_expired(token) else token
+
+    def access_token_loader(self, access_token):
+        """Return the loader for an access token, depending on its kind."""
+        if (self.token_sealer is not None and
+                self.token_sealer.looks_sealed(access_token)):
+            return self.load_sealed_access_token
+        return partial(self.load_known, u'access_token', u'load_access_token')
+
+    def load_sealed_access_token(self, client_key, access_token):
+        """Return the claims of a self-contained access token, or None."""
+        token = self.token_sealer.unseal(access_token)
+        if (token is None or token.client_key != client_key or
+                self.access_token_revoked(token)):
+            return None
+        return token
+
+    def expiry(self, lifetime):
+        """Keyword arguments recording when a new token is created and expires."""
+        if not lifetime:
+            return {}
+        now = datetime.utcnow()
+        return {u'created_at': now,
+                u'expires_at': now + timedelta(seconds=lifetime)}
+
+    def is_expired(self, token):
+        """Check whether a record has an expires_at which has passed."""
+        if isinstance(token, dict):
+            expires_at = token.get(u'expires_at')
+        else:
+            expires_at = getattr(token, u'expires_at', None)
+        return expires_at is not None and expires_at <= datetime.utcnow()
+
+    def get_resource_owner(self, client_key, access_token):
+        """Return the resource owner of an access token, or None."""
+        token = self.get_access_token(client_key, access_token)
+        if token is None:
+            return None
+        return self.lookups.get(u'resource_owner', (client_key, access_token),
+                lambda *key: self.call_hook(u'load_resource_owner', token))
+
+    def write_behind(self, kind, record, key=None):
+        """Have flush_writes persist a record, batched with other writes.
+
+        Without write_batch_size the record is flushed right away. Records
+        written with a key can be read back using pending_write(key) until
+        they have been flushed, which loaders should check before storage.
+
+        Mind the two costs of batching. Pending writes are only readable in
+        the process which made them, so a token used at another worker
+        before its batch is flushed is unknown there; keep the delay well
+        below the time clients take to use a token, or route clients to the
+        same worker. And a token is handed out before it is persisted, if
+        its batch keeps failing to flush, see write_batch_retries, it is
+        dropped and writes_dropped sent.
+        """
+        if self.write_queue is None:
+            self.flush_writes([(kind, record)])
+        else:
+            self.write_queue.put(kind, record, key)
+
+    def drop_writes(self, writes):
+        """Announce writes which could not be flushed, see writes_dropped."""
+        writes_dropped.send(self, writes=writes)
+
+    def pending_write(self, key):
+        """Return a record written with key but not yet flushed, or None."""
+        if self.write_queue is None:
+            return None
+        return self.write_queue.get(key)
+
+    @contextmanager
+    def unit_of_work(self):
+        """Run storage calls within a single transaction.
+
+        Wraps each call of a view protected by require_oauth, including the
+        token endpoints, and the saving of a verifier in authorized, so that
+        every hook called joins one transaction committed once the view
+        returns and rolled back if it raises. Defaults to the transaction of
+        the store, override to i.e. commit a session of your own.
+
+        Note that lookups prefetched on other threads and writes queued for
+        write_behind are not part of it.
+        """
+        if self.store is None:
+            yield
+        else:
+            with self.store.transaction():
+                yield
+
     def generate_client_key(self):
-        return generate_token(length=self.client_key_length[1])
+        return self.generate_token(self.client_key_length[1])
 
     def generate_client_secret(self):
-        return generate_token(length=self.secret_length)
+        return self.generate_token(self.secret_length)
+
+    def generate_token(self, length):
+        """Return a random token, from the token pool if enabled."""
+        if self.token_pool is None:
+            return generate_token(length=length)
+        return self.token_pool.token(length)
+
+    def verify_request(self, uri, http_method=u'GET', body=None,
+            headers=None, require_resource_owner=True, require_verifier=False,
+            require_realm=False, required_realm=None, require_callback=False):
+        """Verify a request, see oauthlib's Server.verify_request.
+
+        The checks and their order are those of oauthlib, split into stages
+        so that signatures can be verified using parsed RSA keys:
+
+        1. parse_request collects the OAuth parameters
+        2. check_request checks their presence and format and that the
+           timestamp is within the window allowed, without any storage
+        3. rate_limit takes a token from the client's bucket, if rate_limits
+           are set, raising RateLimited if the bucket is empty
+        4. validate_request runs the validators, using dummy credentials
+           in place of invalid ones to keep the running time constant, with
+           records prefetched concurrently if prefetch_pool_size is set
+        5. verify_signature checks the signature, in a process pool for
+           RSA-SHA1 if rsa_pool_size is set
+        6. validate_timestamp_and_nonce claims the nonce, only for requests
+           passing every other check
+
+        Nonces are claimed last so that requests anyone can make up, with
+        unknown clients or bad signatures, never take up room in the nonce
+        cache or the store, where they could push out the nonces of genuine
+        requests and have those refused as replays.
+
+        Stages and the hooks they call are timed through call_hook.
+
+        Returns a tuple of validity and the parsed oauthlib request.
+        """
+        oauth_request = self.call_hook(u'parse_request', uri, http_method,
+                body, headers)
+        self.call_hook(u'check_request', oauth_request,
+                require_resource_owner, require_verifier, require_callback)
+        if self.rate_buckets is not None:
+            self.call_hook(u'rate_limit', oauth_request, required_realm)
+        r = oauth_request
+        if require_verifier:
+            token = {u'request_token': r.resource_owner_key}
+        else:
+            token = {u'access_token': r.resource_owner_key}
+        validations = self.call_hook(u'validate_request', oauth_request,
+                require_resource_owner, require_verifier, require_realm,
+                required_realm, require_callback)
+
+        valid_signature = self.call_hook(u'verify_signature', oauth_request,
+                require_resource_owner, require_verifier)
+
+        # Validity is checked at the very end, using dummy values for
+        # calculations and fetching secrets/keys to ensure the flow of every
+        # request remains almost identical regardless of whether valid values
+        # have been supplied.
+        valid = all(validations) and valid_signature
+        if not valid:
+            log.info("[Failure] OAuth request verification failed.")
+            log.info("Valid client, resource owner, realm, redirect, "
+                     "verifier: %s, %s, %s, %s, %s" % validations)
+            log.info("Valid signature:\t%s" % valid_signature)
+        elif not self.call_hook(u'validate_timestamp_and_nonce', r.client_key,
+                r.timestamp, r.nonce, **token):
+            log.info("[Failure] OAuth request replayed.")
+            oauth_request.replayed = True
+            valid = False
+        return valid, oauth_request
+
+    def parse_request(self, uri, http_method, body, headers):
+        """Collect the OAuth parameters of a request from a single source."""
+        # Only include body data from x-www-form-urlencoded requests
+        headers = headers or {}
+        if headers.get(u'Content-Type') != CONTENT_TYPE_FORM_URLENCODED:
+            body = u''
+        oauth_request = Request(uri, http_method, body, headers)
+
+        if self.enforce_ssl and not oauth_request.uri.lower().startswith(u'https://'):
+            raise ValueError("Insecure transport, only HTTPS is allowed.")
+
+        signature_type, params, oauth_params = \
+                self._get_signature_type_and_params(oauth_request)
+
+        # The server SHOULD return a 400 (Bad Request) status code when
+        # receiving a request with duplicated protocol parameters.
+        if len(dict(oauth_params)) != len(oauth_params):
+            raise ValueError("Duplicate OAuth entries.")
+
+        oauth_params = dict(oauth_params)
+        oauth_request.oauth_params = oauth_params
+        oauth_request.signature = oauth_params.get(u'oauth_signature')
+        oauth_request.client_key = oauth_params.get(u'oauth_consumer_key')
+        oauth_request.resource_owner_key = oauth_params.get(u'oauth_token')
+        oauth_request.nonce = oauth_params.get(u'oauth_nonce')
+        oauth_request.timestamp = oauth_params.get(u'oauth_timestamp')
+        oauth_request.callback_uri = oauth_params.get(u'oauth_callback')
+        oauth_request.verifier = oauth_params.get(u'oauth_verifier')
+        oauth_request.signature_method = oauth_params.get(u'oauth_signature_method')
+        oauth_request.realm = dict(params).get(u'realm')
+
+        # Parameters to sign exclude the signature and the realm of the
+        # Authorization header, see RFC 5849 section 3.4.1.3.1. A realm in
+        # the query or body, i.e. /request_token?realm=photos, is signed
+        # like any other parameter.
+        params = [(k, v) for k, v in params if k != u'oauth_signature']
+        if oauth_request.realm is not None:
+            for param in collect_parameters(headers=headers,
+                    exclude_oauth_signature=False, with_realm=True):
+                if param[0] == u'realm':
+                    params.remove(param)
+        oauth_request.params = params
+        return oauth_request
+
+    def check_request(self, oauth_request, require_resource_owner,
+            require_verifier, require_callback):
+        """Check presence and format of the OAuth parameters.
+
+        Raises ValueError, to be answered with 400 Bad Request, on failure.
+        """
+        r = oauth_request
+        if not all((r.signature, r.client_key, r.nonce, r.timestamp,
+                    r.signature_method)):
+            raise ValueError("Missing OAuth parameters.")
+
+        if not r.signature_method in self.allowed_signature_methods:
+            raise ValueError("Invalid signature method.")
+
+        if r.oauth_params.get(u'oauth_version', u'1.0') != u'1.0':
+            raise ValueError("Invalid OAuth version.")
+
+        # To avoid the need to retain an infinite number of nonce values for
+        # future checks, servers MAY choose to restrict the time period after
+        # which a request with an old timestamp is rejected. Timestamps too
+        # far ahead are rejected too, or their nonces would be retained for
+        # as long as the clock of the client is ahead.
+        if len(r.timestamp) != 10:
+            raise ValueError("Invalid timestamp size")
+        try:
+            timestamp = int(r.timestamp)
+        except ValueError:
+            raise ValueError("Timestamp must be an integer")
+        now = time.time()
+        if now - timestamp > self.timestamp_lifetime:
+            raise ValueError("Request too old, over %d seconds." %
+                    self.timestamp_lifetime)
+        skew = self.timestamp_skew
+        if skew is not None and timestamp - now > skew:
+            raise ValueError("Request from the future, over %d seconds." %
+                    skew)
+
+        # Provider specific validation of parameters, used to enforce
+        # restrictions such as character set and length.
+        if not self.check_client_key(r.client_key):
+            raise ValueError("Invalid client key.")
+
+        if not r.resource_owner_key and require_resource_owner:
+            raise ValueError("Missing resource owner.")
+
+        if (require_resource_owner and not require_verifier and
+            not self.check_access_token(r.resource_owner_key)):
+            raise ValueError("Invalid resource owner key.")
+
+        if (require_resource_owner and require_verifier and
+            not self.check_request_token(r.resource_owner_key)):
+            raise ValueError("Invalid resource owner key.")
+
+        if not self.check_nonce(r.nonce):
+            raise ValueError("Invalid nonce.")
+
+        if r.realm and not self.check_realm(r.realm):
+            raise ValueError("Invalid realm. Allowed are %s" % self.realms)
+
+        if not r.verifier and require_verifier:
+            raise ValueError("Missing verifier.")
+
+        if require_verifier and not self.check_verifier(r.verifier):
+            raise ValueError("Invalid verifier.")
+
+        if require_callback and not r.callback_uri:
+            raise ValueError("Missing callback URI.")
+
+    def rate_limit(self, oauth_request, required_realm=None):
+        """Raise RateLimited if the client, or token, has exceeded its limit.
+
+        Runs before any storage lookup or signature check, the client key
+        and token are thus not yet known to be valid.
+        """
+        r = oauth_request
+        endpoint = request.endpoint if _request_ctx_stack.top else None
+        realms = required_realm or r.realm or ()
+        if isinstance(realms, basestring):
+            realms = realms.split()
+        limits = self.rate_limits
+        keys = ([(endpoint, name) for name in realms] + [(endpoint, None)] +
+                [(None, name) for name in realms] + [(None, None)])
+        for key in keys:
+            if key in limits:
+                rate, burst = limits[key]
+                realm = key[1]
+                break
+        else:
+            return
+
+        keys = [(r.client_key, endpoint, realm)]
+        if self.rate_limit_per_token and r.resource_owner_key:
+            keys.append((r.client_key, r.resource_owner_key, endpoint, realm))
+        for key in keys:
+            wait = self.rate_buckets.take(key, rate, burst)
+            if wait:
+                raise RateLimited(wait)
+
+    def validate_request(self, oauth_request, require_resource_owner,
+            require_verifier, require_realm, required_realm, require_callback):
+        """Run the validators against storage.
+
+        Returns a tuple of validity of the client, resource owner, realm,
+        redirect URI and verifier.
+        Invalid credentials are swapped for dummies rather than returning
+        early, which would enable enumeration through timing.
+        """
+        r = oauth_request
+        if self.prefetch_pool is not None:
+            self.prefetch_records(r, require_verifier)
+
+        valid_client = self.call_hook(u'validate_client_key', r.client_key)
+        if not valid_client:
+            r.client_key = self.dummy_client
+
+        if require_callback:
+            valid_redirect = self.call_hook(u'validate_redirect_uri',
+                    r.client_key, r.callback_uri)
+        else:
+            valid_redirect = True
+
+        if r.resource_owner_key:
+            if require_verifier:
+                valid_resource_owner = self.call_hook(u'validate_request_token',
+                    r.client_key, r.resource_owner_key)
+                if not valid_resource_owner:
+                    r.resource_owner_key = self.dummy_request_token
+            else:
+                valid_resource_owner = self.call_hook(u'validate_access_token',
+                    r.client_key, r.resource_owner_key)
+                if not valid_resource_owner:
+                    r.resource_owner_key = self.dummy_access_token
+        else:
+            valid_resource_owner = True
+
+        # Realms requested while obtaining a request token are checked
+        # against the client, obtaining an access token transfers the realm
+        # of the request token and protected resources check the realm of
+        # the access token.
+        if ((require_realm and not r.resource_owner_key) or
+            (not require_resource_owner and not r.realm)):
+            valid_realm = self.call_hook(u'validate_requested_realm',
+                    r.client_key, r.realm)
+        elif require_verifier:
+            valid_realm = True
+        else:
+            valid_realm = self.call_hook(u'validate_realm', r.client_key,
+                    r.resource_owner_key, uri=r.uri,
+                    required_realm=required_realm)
+
+        if r.verifier:
+            valid_verifier = self.call_hook(u'validate_verifier', r.client_key,
+                r.resource_owner_key, r.verifier)
+        else:
+            valid_verifier = True
+
+        return (valid_client, valid_resource_owner, valid_realm,
+                valid_redirect, valid_verifier)
+
+    def introspect(self):
+        """Answer a batch of client and access token lookups as JSON.
+
+        The request body holds a list of [client_key, access_token] pairs,
+        the token may be null to look up only the client:
+
+            {"lookups": [["client key", "access token"], ...]}
+
+        Results are in the same order and null for unknown or expired keys:
+
+            {"results": [{"client": {"secret": ..., "pubkey": ...},
+                          "access_token": {"secret": ..., "realm": ...,
+                                           "resource_owner": ...,
+                                           "expires_at": ...}}, ...]}
+        """
+        authorization = request.headers.get(u'Authorization', u'')
+        if not safe_string_equals(authorization,
+                u'Bearer ' + self.introspection_secret):
+            raise Unauthorized()
+        try:
+            lookups = [(client_key, access_token) for client_key, access_token
+                       in json.loads(request.data)[u'lookups']]
+        except (ValueError, KeyError, TypeError):
+            raise BadRequest("Expected a JSON object with lookups.")
+        if len(lookups) > self.introspection_batch_size:
+            raise BadRequest("At most %d lookups are answered at once." %
+                             self.introspection_batch_size)
+
+        results = []
+        for client_key, access_token in lookups:
+            result = {u'client': None, u'access_token': None}
+            if self.get_client(client_key) is not None:
+                result[u'client'] = {
+                    u'secret': self.get_client_secret(client_key),
+                    u'pubkey': self.get_rsa_key(client_key)}
+                if access_token:
+                    result[u'access_token'] = self.introspect_access_token(
+                            client_key, access_token)
+            results.append(result)
+        return Response(json.dumps({u'results': results}),
+                        content_type=u'application/json')
+
+    def introspect_access_token(self, client_key, access_token):
+        """Describe a valid access token for introspect, or return None."""
+        token = self.get_access_token(client_key, access_token)
+        if token is None:
+            return None
+        if isinstance(token, dict):
+            field = token.get
+        else:
+            field = lambda name: getattr(token, name, None)
+        expires_at = field(u'expires_at')
+        if expires_at is not None:
+            expires_at = calendar.timegm(expires_at.utctimetuple())
+        resource_owner = field(u'resource_owner')
+        if resource_owner is None:
+            resource_owner = field(u'resource_owner_id')
+        return {u'secret': self.get_access_token_secret(client_key,
+                                                         access_token),
+                u'realm': field(u'realm'),
+                u'resource_owner': resource_owner,
+                u'expires_at': expires_at}
+
+    def metrics_view(self):
+        """Serve the collected metrics, defaults to no route at all."""
+        return Response(self.metrics.render(),
+                content_type=u'text/plain; version=0.0.4; charset=utf-8')
+
+    def count_request(self, sender, endpoint, outcome, signature_method,
+            duration):
+        self.metrics.inc(u'oauth_requests_total', {u'endpoint': endpoint,
+                u'outcome': outcome,
+                u'signature_method': signature_method or u''})
+        self.metrics.observe(u'oauth_request_duration_seconds',
+                {u'endpoint': endpoint}, duration)
+
+    def count_dropped_writes(self, sender, writes):
+        for kind, record in writes:
+            self.metrics.inc(u'oauth_writes_dropped_total', {u'kind': kind})
+
+    def count_phase(self, sender, phase, duration):
+        self.metrics.inc(u'oauth_phase_calls_total', {u'phase': phase})
+        self.metrics.inc(u'oauth_phase_seconds_total', {u'phase': phase},
+                duration)
+
+    def cache_metrics(self):
+        """Counters of the caches in this process, see Metrics.collectors."""
+        if self.client_cache is None:
+            return []
+        stats = self.client_cache.stats()
+        return [(u'oauth_client_cache_hits_total', {}, stats[u'hits']),
+                (u'oauth_client_cache_misses_total', {}, stats[u'misses'])]
+
+    def call_hook(self, name, *args, **kwargs):
+        """Call the method name, timed as phase name, see timed."""
+        return self.timed(name, getattr(self, name), *args, **kwargs)
+
+    def timed(self, phase, func, *args, **kwargs):
+        """Call func, sending its duration with phase_timed when subscribed.
+
+        Subscribe using phase_timed.connect(receiver, sender=provider), the
+        receiver is called with phase and duration keyword arguments.
+        Without receivers func is called as is, which costs next to nothing.
+        """
+        if not signals_available or not phase_timed.receivers:
+            return func(*args, **kwargs)
+        start = timeit.default_timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            phase_timed.send(self, phase=phase,
+                    duration=timeit.default_timer() - start)
+
+    def prefetch_records(self, oauth_request, require_verifier):
+        """Start loading the client and token records of a request.
+
+        The validators are then answered from the lookup context, which
+        waits for these loads.
+        """
+        r = oauth_request
+        lookups = self.lookups
+        lookups.prefetch(u'client', (r.client_key,), self.load_cached_client,
+                self.prefetch_pool)
+        if not r.resource_owner_key:
+            return
+        key = (r.client_key, r.resource_owner_key)
+        if require_verifier:
+            lookups.prefetch(u'request_token', key,
+                    partial(self.load_known, u'request_token',
+                        u'load_request_token'),
+                    self.prefetch_pool)
+        else:
+            lookups.prefetch(u'access_token', key,
+                    self.access_token_loader(r.resource_owner_key),
+                    self.prefetch_pool)
+
+    def verify_signature(self, oauth_request, require_resource_owner,
+            require_verifier):
+        """Recalculate the signature and compare it to the one given."""
+        r = oauth_request
+        if r.signature_method == SIGNATURE_RSA and self.rsa_pool is not None:
+            pem = self.call_hook(u'get_rsa_key', r.client_key)
+            if not pem:
+                return False
+            return self.rsa_pool.verify(r.client_key, pem,
+                    self.signature_base_string(r),
+                    binascii.a2b_base64(r.signature.encode('utf-8')))
+        elif r.signature_method == SIGNATURE_RSA:
+            rsa_key = self.get_rsa_public_key(r.client_key)
+            return self.verify_rsa_sha1(r, rsa_key)
+
+        client_secret = self.call_hook(u'get_client_secret', r.client_key)
+        resource_owner_secret = None
+        if require_resource_owner:
+            if require_verifier:
+                resource_owner_secret = self.call_hook(
+                    u'get_request_token_secret', r.client_key,
+                    r.resource_owner_key)
+            else:
+                resource_owner_secret = self.call_hook(
+                    u'get_access_token_secret', r.client_key,
+                    r.resource_owner_key)
+
+        if r.signature_method == SIGNATURE_HMAC:
+            return signature.verify_hmac_sha1(r, client_secret,
+                resource_owner_secret)
+        else:
+            return signature.verify_plaintext(r, client_secret,
+                resource_owner_secret)
+
+    def get_rsa_public_key(self, client_key):
+        """Return the parsed RSA key of a client, or None.
+
+        Keys returned by get_rsa_key are parsed once and cached by client
+        key and a fingerprint of the key, so a newly uploaded key is parsed
+        again even before invalidate_client is called.
+        """
+        pem = self.get_rsa_key(client_key)
+        if not pem:
+            return None
+        return self.rsa_keys.get(client_key, pem)
+
+    def warm_rsa_keys(self):
+        """Parse the RSA keys of active_rsa_clients ahead of requests."""
+        for client_key in self.active_rsa_clients():
+            self.get_rsa_public_key(client_key)
+
+    def verify_rsa_sha1(self, oauth_request, rsa_key):
+        """Verify a RSA-SHA1 signature using a parsed public key."""
+        from Crypto.Signature import PKCS1_v1_5
+        from Crypto.Hash import SHA
+        if rsa_key is None:
+            return False
+        digest = SHA.new(self.signature_base_string(oauth_request))
+        sig = binascii.a2b_base64(oauth_request.signature.encode('utf-8'))
+        return PKCS1_v1_5.new(rsa_key).verify(digest, sig)
+
+    def signature_base_string(self, oauth_request):
+        """Return the UTF-8 encoded signature base string of a request."""
+        params = signature.normalize_parameters(oauth_request.params)
+        uri = signature.normalize_base_string_uri(oauth_request.uri)
+        return signature.construct_base_string(oauth_request.http_method,
+                uri, params).encode('utf-8')
+
+    def check_access_token(self, access_token):
+        """Also accept the longer self-contained access tokens."""
+        return (Server.check_access_token(self, access_token) or
+                (self.token_sealer is not None and
+                 self.token_sealer.looks_sealed(access_token)))
 
     def require_oauth(self, realm=None, require_resource_owner=True,
             require_verifier=False, require_realm=False):
-        """Mark the view function f as a protected resource"""
+        """Mark the view function f as a protected resource
+
+        realm may be a list of realms, access is then granted to tokens of
+        any of them. Tokens may hold several realms, space separated.
+        """
+        if isinstance(realm, basestring):
+            names = realm.split()
+        else:
+            names = tuple(realm or ())
+            realm = names or None
+        if not all(name in self.realm_bits for name in names):
+            raise ValueError("Unknown realm %r. Allowed are %s" % (realm,
+                             self.realms))
 
         def decorator(f):
             @wraps(f)
             def verify_request(*args, **kwargs):
                 """Verify OAuth params before running view function f"""
+                start = timeit.default_timer()
+                outcome, oauth_request = u'error', None
                 try:
-                    if request.form:
-                        body = request.form.to_dict()
-                    else:
-                        body = request.data.decode("utf-8")
-                    verify_result = self.verify_request(request.url.decode("utf-8"),
-                            http_method=request.method.decode("utf-8"),
-                            body=body,
-                            headers=request.headers,
-                            require_resource_owner=require_resource_owner,
-                            require_verifier=require_verifier,
-                            require_realm=require_realm or bool(realm),
-                            required_realm=realm)
-                    valid, oauth_request = verify_result
-                    if valid:
-                        request.oauth = self.collect_request_parameters(request)
-
-                        # Request tokens are only valid when a verifier is too
-                        token = {}
-                        if require_verifier:
-                            token[u'request_token'] = request.oauth.resource_owner_key
+                    # Every storage call joins a single transaction
+                    with self.unit_of_work():
+                        if request.form:
+                            body = request.form.to_dict()
                         else:
-                            token[u'access_token'] = request.oauth.resource_owner_key
-
-                        # All nonce/timestamp pairs must be stored to prevent
-                        # replay attacks, they may be connected to a specific
-                        # client and token to decrease collision probability.
-                        self.save_timestamp_and_nonce(request.oauth.client_key,
-                                request.oauth.timestamp, request.oauth.nonce,
-                                **token)
-
-                        # By this point, the request is fully authorized
-                        return f(*args, **kwargs)
-                    else:
-                        # Unauthorized requests should not diclose their cause
-                        raise Unauthorized()
+                            body = request.data.decode("utf-8")
+                        verify_result = self.call_hook(u'verify_request',
+                                request.url.decode("utf-8"),
+                                http_method=request.method.decode("utf-8"),
+                                body=body,
+                                headers=request.headers,
+                                require_resource_owner=require_resource_owner,
+                                require_verifier=require_verifier,
+                                require_realm=require_realm or bool(realm),
+                                required_realm=realm)
+                        valid, oauth_request = verify_result
+                        if valid:
+                            outcome = u'valid'
+
+                            # The parameters parsed during verification are
+                            # reused rather than collected a second time
+                            request.oauth = self.oauth_parameters(oauth_request)
+
+                            # Request tokens are only valid along a verifier
+                            token = {}
+                            if require_verifier:
+                                token[u'request_token'] = request.oauth.resource_owner_key
+                            else:
+                                token[u'access_token'] = request.oauth.resource_owner_key
+
+                            # All nonce/timestamp pairs must be stored to
+                            # prevent replay attacks, they may be connected to
+                            # a specific client and token to decrease
+                            # collision probability.
+                            self.call_hook(u'save_timestamp_and_nonce',
+                                    request.oauth.client_key,
+                                    request.oauth.timestamp, request.oauth.nonce,
+                                    **token)
+
+                            # By this point, the request is fully authorized
+                            return self.timed(u'view', f, *args, **kwargs)
+                        else:
+                            outcome = u'unauthorized'
+                            if getattr(oauth_request, u'replayed', False):
+                                outcome = u'replay'
+                            # Unauthorized requests should not diclose why
+                            raise Unauthorized()
 
                 except ValueError as err:
                     # Caused by missing of or badly formatted parameters
+                    outcome = u'bad_request'
                     raise BadRequest(err.message)
 
+                except RateLimited:
+                    outcome = u'rate_limited'
+                    raise
+
+                finally:
+                    if signals_available and request_handled.receivers:
+                        request_handled.send(self, endpoint=request.endpoint,
+                            outcome=outcome,
+                            signature_method=getattr(oauth_request,
+                                u'signature_method', None),
+                            duration=timeit.default_timer() - start)
+
+            if self.profiler is not None:
+                return self.profiler.wrap(verify_request)
             return verify_request
         return decorator
 
-    def collect_request_parameters(self, request):
-        """Collect parameters in an object for convenient access"""
+    def oauth_parameters(self, oauth_request):
+        """Wrap the parameters of a verified oauthlib request.
 
-        class OAuthParameters(object):
-            """Used as a parameter container since plain object()s can't"""
-            pass
+        verify_request has already collected and parsed every OAuth parameter
+        from the URI query, body and Authorization header. Exposing those
+        instead of collecting them again avoids parsing each request twice.
+        """
+        oauth_params = OAuthParameters()
+        oauth_params.client_key = oauth_request.client_key
+        oauth_params.resource_owner_key = oauth_request.resource_owner_key
+        oauth_params.nonce = oauth_request.nonce
+        oauth_params.timestamp = oauth_request.timestamp
+        oauth_params.verifier = oauth_request.verifier
+        oauth_params.callback_uri = oauth_request.callback_uri
+        oauth_params.realm = oauth_request.realm
+        return oauth_params
 
+    def collect_request_parameters(self, request):
+        """Collect parameters in an object for convenient access
+
+        Kept for views that need the OAuth parameters of an unverified
+        request, protected views should use request.oauth instead.
+        """
         # Collect parameters
         query = urlparse(request.url.decode("utf-8")).query
         content_type = request.headers.get('Content-Type', '')
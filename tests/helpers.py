@@ -0,0 +1,266 @@
+"""
+A provider on a dict based store and a client signing requests for it,
+driving the OAuth flow through Flask's test client.
+"""
+from threading import Lock
+from urlparse import urlparse, parse_qsl
+
+from flask import Flask, request
+from oauthlib.oauth1.rfc5849 import Client, SIGNATURE_HMAC, SIGNATURE_RSA
+from flask_oauthprovider import OAuthProvider, TokenStore, Record
+
+CLIENT_KEY = u'testclientkeyxxxxxxx'
+CLIENT_SECRET = u'testclientsecretxxxxxxxxxxxxxx'
+CALLBACK = u'http://client.local/callback'
+RESOURCE_OWNER = u'test-owner'
+BASE_URL = u'http://localhost'
+
+rsa_keys = {}
+
+
+def rsa_keypair():
+    """Return a (private, public) PEM pair, generated once per process."""
+    if not rsa_keys:
+        from Crypto.PublicKey import RSA
+        key = RSA.generate(1024)
+        rsa_keys[u'pair'] = (key.exportKey().decode(u'utf-8'),
+                key.publickey().exportKey().decode(u'utf-8'))
+    return rsa_keys[u'pair']
+
+
+class MemoryStore(TokenStore):
+    """A TokenStore keeping everything in dicts, counting lookups."""
+
+    def __init__(self):
+        self.clients = {}
+        self.request_tokens = {}
+        self.access_tokens = {}
+        self.nonces = set()
+        self.lookups = 0
+        self.lock = Lock()
+
+    def load_client(self, client_key):
+        self.lookups += 1
+        return self.clients.get(client_key)
+
+    def load_token(self, tokens, client_key, token):
+        self.lookups += 1
+        record = tokens.get(token)
+        if record is None:
+            return None
+        if client_key is not None and record.client_key != client_key:
+            return None
+        return record
+
+    def load_request_token(self, client_key, request_token):
+        return self.load_token(self.request_tokens, client_key, request_token)
+
+    def load_access_token(self, client_key, access_token):
+        return self.load_token(self.access_tokens, client_key, access_token)
+
+    def save_client(self, client_key, secret=None, pubkey=None, callbacks=()):
+        self.clients[client_key] = Record(client_key=client_key,
+                secret=secret, pubkey=pubkey, callbacks=list(callbacks))
+
+    def save_request_token(self, client_key, request_token, callback,
+            realm=None, secret=None, created_at=None, expires_at=None):
+        self.request_tokens[request_token] = Record(client_key=client_key,
+                token=request_token, secret=secret, realm=realm,
+                callback=callback, verifier=None, resource_owner=None,
+                created_at=created_at, expires_at=expires_at)
+
+    def save_verifier(self, request_token, verifier, resource_owner,
+            expires_at=None):
+        token = self.request_tokens[request_token]
+        token.verifier = verifier
+        token.resource_owner = resource_owner
+        if expires_at is not None:
+            token.expires_at = expires_at
+
+    def save_access_token(self, client_key, access_token, request_token,
+            secret=None, created_at=None, expires_at=None):
+        token = self.request_tokens.get(request_token)
+        if token is None:
+            raise ValueError("Unknown request token.")
+        self.access_tokens[access_token] = Record(client_key=client_key,
+                token=access_token, secret=secret, realm=token.realm,
+                resource_owner=token.resource_owner,
+                created_at=created_at, expires_at=expires_at)
+
+    def add_nonce(self, client_key, timestamp, nonce):
+        key = (client_key, timestamp, nonce)
+        with self.lock:
+            if key in self.nonces:
+                return False
+            self.nonces.add(key)
+            return True
+
+    def purge_expired(self, kind, before, limit):
+        return 0
+
+    def known_keys(self):
+        for client_key in list(self.clients):
+            yield u'client', client_key
+        for token in list(self.request_tokens):
+            yield u'request_token', token
+        for token in list(self.access_tokens):
+            yield u'access_token', token
+
+
+def sqlalchemy_store():
+    """Return a SQLAlchemyStore on an in-memory SQLite database."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import StaticPool
+    from flask_oauthprovider import SQLAlchemyStore
+    # A single connection, or each would see a database of its own
+    engine = create_engine(u'sqlite://', poolclass=StaticPool,
+            connect_args={u'check_same_thread': False})
+    store = SQLAlchemyStore(engine)
+    store.create_all()
+    return store
+
+
+def mongo_store():
+    """Return a MongoStore on a mongomock database."""
+    import mongomock
+    from flask_oauthprovider import MongoStore
+    return MongoStore(mongomock.MongoClient().oauth)
+
+
+def have(module):
+    """Check whether an optional dependency can be imported."""
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+class FlowProvider(OAuthProvider):
+    """Authorizes every request token on behalf of a single user."""
+
+    @property
+    def enforce_ssl(self):
+        return False
+
+    @property
+    def realms(self):
+        return [u'secret', u'trolling']
+
+    def authorize(self):
+        return self.authorized(request.args.get(u'oauth_token'))
+
+    def register(self):
+        return u''
+
+    def current_resource_owner(self):
+        return RESOURCE_OWNER
+
+
+def provider_class(**settings):
+    """Return a FlowProvider subclass, settings overriding its properties."""
+    properties = dict((name, property(lambda self, value=value: value))
+                      for name, value in settings.items())
+    return type('ConfiguredProvider', (FlowProvider,), properties)
+
+
+def create_app(store, **settings):
+    """Return a Flask app with protected views and its provider."""
+    app = Flask(__name__)
+    app.testing = True
+    provider = provider_class(**settings)(app, store=store)
+
+    @app.route(u'/protected')
+    @provider.require_oauth()
+    def protected():
+        return request.oauth.client_key
+
+    @app.route(u'/secret')
+    @provider.require_oauth(realm=u'secret')
+    def secret():
+        return u'secret'
+
+    @app.route(u'/trolling')
+    @provider.require_oauth(realm=u'trolling')
+    def trolling():
+        return u'trolling'
+
+    @app.route(u'/either')
+    @provider.require_oauth(realm=[u'secret', u'trolling'])
+    def either():
+        return u'either'
+
+    return app, provider
+
+
+def register_client(store, method=SIGNATURE_HMAC, client_key=CLIENT_KEY):
+    pubkey = rsa_keypair()[1] if method == SIGNATURE_RSA else None
+    store.save_client(client_key, secret=CLIENT_SECRET, pubkey=pubkey,
+            callbacks=[CALLBACK])
+
+
+class Flow(object):
+    """Runs the three legged flow through a test client."""
+
+    def __init__(self, app, method=SIGNATURE_HMAC, client_key=CLIENT_KEY):
+        self.client = app.test_client()
+        self.method = method
+        self.client_key = client_key
+
+    def credentials(self, **kwargs):
+        if self.method == SIGNATURE_RSA:
+            kwargs[u'rsa_key'] = rsa_keypair()[0]
+        else:
+            kwargs[u'client_secret'] = CLIENT_SECRET
+        return Client(self.client_key, signature_method=self.method, **kwargs)
+
+    def sign(self, oauth_client, path, http_method=u'GET', realm=None):
+        uri, headers, _ = oauth_client.sign(BASE_URL + path,
+                http_method=http_method, realm=realm)
+        return headers
+
+    def open(self, oauth_client, path, http_method=u'GET', realm=None):
+        headers = self.sign(oauth_client, path, http_method, realm)
+        return self.send(path, http_method, headers)
+
+    def send(self, path, http_method, headers):
+        return getattr(self.client, http_method.lower())(path,
+                headers=headers)
+
+    def request_token(self, realm=None):
+        """Return the response and (token, secret) of a request token."""
+        response = self.open(self.credentials(callback_uri=CALLBACK),
+                u'/request_token', u'POST', realm=realm)
+        return response, self.token(response)
+
+    def authorize(self, request_token):
+        response = self.client.get(u'/authorize?oauth_token=' + request_token)
+        location = urlparse(response.headers[u'Location'])
+        return dict(parse_qsl(location.query))[u'oauth_verifier'].decode(
+                u'utf-8')
+
+    def access_token(self, request_token, request_secret, verifier):
+        """Return the response and (token, secret) of an access token."""
+        response = self.open(self.credentials(
+                resource_owner_key=request_token,
+                resource_owner_secret=request_secret, verifier=verifier),
+                u'/access_token', u'POST')
+        return response, self.token(response)
+
+    def token(self, response):
+        if response.status_code != 200:
+            return None, None
+        data = dict(parse_qsl(response.data))
+        return (data[u'oauth_token'].decode(u'utf-8'),
+                data[u'oauth_token_secret'].decode(u'utf-8'))
+
+    def authorized_access_token(self, realm=u'secret'):
+        """Run the whole flow, returning the (token, secret) obtained."""
+        response, (token, secret) = self.request_token(realm=realm)
+        verifier = self.authorize(token)
+        response, access = self.access_token(token, secret, verifier)
+        return access
+
+    def get(self, path, access, realm=None):
+        return self.open(self.credentials(resource_owner_key=access[0],
+                resource_owner_secret=access[1]), path, realm=realm)
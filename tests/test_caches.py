@@ -0,0 +1,606 @@
+"""
+Caches, shared memory tables and token helpers, on their own.
+"""
+import imp
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from threading import Thread
+
+from oauthlib.common import UNICODE_ASCII_CHARACTER_SET
+from werkzeug.exceptions import ServiceUnavailable
+
+import flask_oauthprovider
+from flask_oauthprovider import ClientCache, NegativeCache, NonceCache
+from flask_oauthprovider import SharedNonceCache, BloomFilter, TokenBuckets
+from flask_oauthprovider import SharedTokenBuckets, TokenPool, TokenSealer
+from flask_oauthprovider import LookupContext, PrefetchPool, Metrics
+from flask_oauthprovider import LookupTimer, RSAVerifierPool, WriteBehindQueue
+
+from tests.helpers import have, rsa_keypair
+
+
+class TemporaryDirectory(object):
+    """Mixed into a TestCase needing a directory for its files."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+class LoaderMixin(object):
+
+    def loader(self, value):
+        """Return a loader returning value and counting its calls."""
+        self.loads = 0
+
+        def load(*key):
+            self.loads += 1
+            return value
+        return load
+
+
+class LookupContextTest(LoaderMixin, unittest.TestCase):
+
+    def test_loads_once(self):
+        lookups = LookupContext()
+        load = self.loader(u'record')
+        self.assertEqual(lookups.get(u'client', (u'key',), load), u'record')
+        self.assertEqual(lookups.get(u'client', (u'key',), load), u'record')
+        self.assertEqual(self.loads, 1)
+
+    def test_misses_are_memoized(self):
+        lookups = LookupContext()
+        load = self.loader(None)
+        lookups.get(u'client', (u'key',), load)
+        self.assertEqual(lookups.get(u'client', (u'key',), load), None)
+        self.assertEqual(self.loads, 1)
+
+    def test_forget(self):
+        lookups = LookupContext()
+        load = self.loader(u'record')
+        lookups.get(u'client', (u'key',), load)
+        lookups.forget(u'client', (u'key',))
+        lookups.get(u'client', (u'key',), load)
+        self.assertEqual(self.loads, 2)
+
+    def test_prefetch(self):
+        lookups = LookupContext()
+        pool = PrefetchPool(2)
+        lookups.prefetch(u'client', (u'key',), lambda key: key.upper(), pool)
+        self.assertEqual(lookups.get(u'client', (u'key',), None), u'KEY')
+
+
+class ClientCacheTest(LoaderMixin, unittest.TestCase):
+
+    def test_hit(self):
+        cache = ClientCache(10, 60)
+        load = self.loader(u'record')
+        cache.get(u'key', load)
+        self.assertEqual(cache.get(u'key', load), u'record')
+        self.assertEqual(self.loads, 1)
+        stats = cache.stats()
+        self.assertEqual((stats[u'hits'], stats[u'misses']), (1, 1))
+
+    def test_unknown_clients_are_not_cached(self):
+        cache = ClientCache(10, 60)
+        load = self.loader(None)
+        cache.get(u'key', load)
+        cache.get(u'key', load)
+        self.assertEqual(self.loads, 2)
+
+    def test_expiry(self):
+        cache = ClientCache(10, -1)
+        load = self.loader(u'record')
+        cache.get(u'key', load)
+        cache.get(u'key', load)
+        self.assertEqual(self.loads, 2)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ClientCache(2, 60)
+        load = self.loader(u'record')
+        cache.get(u'a', load)
+        cache.get(u'b', load)
+        cache.get(u'a', load)
+        cache.get(u'c', load)
+        self.assertEqual(list(cache.records), [u'a', u'c'])
+
+    def test_invalidate(self):
+        cache = ClientCache(10, 60)
+        load = self.loader(u'record')
+        cache.get(u'key', load)
+        cache.invalidate(u'key')
+        cache.get(u'key', load)
+        self.assertEqual(self.loads, 2)
+
+    def test_invalidated_while_loading(self):
+        cache = ClientCache(10, 60)
+
+        def load(client_key):
+            cache.invalidate(client_key)
+            return u'stale'
+        cache.get(u'key', load)
+        self.assertFalse(u'key' in cache.records)
+
+
+class NegativeCacheTest(LoaderMixin, unittest.TestCase):
+
+    def test_misses_are_remembered(self):
+        cache = NegativeCache(10, 60)
+        load = self.loader(None)
+        cache.get(u'key', load)
+        self.assertEqual(cache.get(u'key', load), None)
+        self.assertEqual(self.loads, 1)
+
+    def test_hits_are_not_remembered(self):
+        cache = NegativeCache(10, 60)
+        load = self.loader(u'record')
+        cache.get(u'key', load)
+        self.assertEqual(cache.get(u'key', load), u'record')
+        self.assertEqual(self.loads, 2)
+
+    def test_forget(self):
+        cache = NegativeCache(10, 60)
+        cache.get(u'key', self.loader(None))
+        cache.forget(u'key')
+        self.assertEqual(cache.get(u'key', self.loader(u'record')), u'record')
+
+    def test_bounded(self):
+        cache = NegativeCache(2, 60)
+        for key in (u'a', u'b', u'c'):
+            cache.get(key, self.loader(None))
+        self.assertEqual(list(cache.expires), [u'b', u'c'])
+
+
+class NonceCacheTests(object):
+
+    def test_replay(self):
+        cache = self.make_cache()
+        now = int(time.time())
+        self.assertTrue(cache.add(u'client', now, u'nonce'))
+        self.assertFalse(cache.add(u'client', now, u'nonce'))
+        self.assertTrue(cache.add(u'client', now, u'other'))
+        self.assertTrue(cache.add(u'other', now, u'nonce'))
+        self.assertTrue(cache.add(u'client', now + 1, u'nonce'))
+
+    def test_expired_timestamp(self):
+        cache = self.make_cache()
+        self.assertFalse(cache.add(u'client', int(time.time()) - 700,
+                                   u'nonce'))
+
+
+class NonceCacheTest(NonceCacheTests, unittest.TestCase):
+
+    def make_cache(self):
+        return NonceCache(600, 1000)
+
+    def test_full_cache_rejects_old_buckets(self):
+        cache = NonceCache(600, 2, granularity=10)
+        now = int(time.time()) // 10 * 10
+        cache.add(u'client', now - 100, u'a')
+        cache.add(u'client', now, u'b')
+        cache.add(u'client', now, u'c')
+        # The oldest bucket was dropped, its timestamps may be replays
+        self.assertFalse(cache.add(u'client', now - 100, u'd'))
+        self.assertTrue(cache.add(u'client', now, u'd'))
+
+
+class SharedNonceCacheTest(TemporaryDirectory, NonceCacheTests,
+                           unittest.TestCase):
+
+    def make_cache(self):
+        return SharedNonceCache(os.path.join(self.path, u'nonces'), 600, 1000)
+
+    def test_shared_by_instances(self):
+        cache = self.make_cache()
+        other = self.make_cache()
+        now = int(time.time())
+        self.assertTrue(cache.add(u'client', now, u'nonce'))
+        self.assertFalse(other.add(u'client', now, u'nonce'))
+
+    def test_shared_with_forked_processes(self):
+        cache = self.make_cache()
+        now = int(time.time())
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if cache.add(u'client', now, u'nonce') else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertFalse(cache.add(u'client', now, u'nonce'))
+
+    def test_full_stripe_rejects(self):
+        cache = SharedNonceCache(os.path.join(self.path, u'nonces'), 600, 4,
+                                 stripe_size=4)
+        now = int(time.time())
+        added = [cache.add(u'client', now, u'%d' % i) for i in range(5)]
+        self.assertEqual(added, [True] * 4 + [False])
+
+
+class BloomFilterTest(TemporaryDirectory, unittest.TestCase):
+
+    def make_filter(self):
+        return BloomFilter(os.path.join(self.path, u'bloom'), 1000, 0.01)
+
+    def test_unpopulated_filter_contains_everything(self):
+        bloom = self.make_filter()
+        self.assertTrue(bloom.may_contain(u'client', u'key'))
+
+    def test_populate(self):
+        bloom = self.make_filter()
+        bloom.populate([(u'client', u'key')])
+        self.assertTrue(bloom.may_contain(u'client', u'key'))
+        self.assertFalse(bloom.may_contain(u'client', u'other'))
+        self.assertFalse(bloom.may_contain(u'access_token', u'key'))
+        # Only populated once
+        bloom.populate([(u'client', u'other')])
+        self.assertFalse(bloom.may_contain(u'client', u'other'))
+
+    def test_shared_by_instances(self):
+        bloom = self.make_filter()
+        bloom.populate([])
+        self.make_filter().add(u'client', u'key')
+        self.assertTrue(bloom.may_contain(u'client', u'key'))
+
+    def test_false_positive_rate(self):
+        bloom = self.make_filter()
+        bloom.populate((u'client', u'%d' % i) for i in range(1000))
+        false = sum(bloom.may_contain(u'client', u'x%d' % i)
+                    for i in range(10000))
+        self.assertTrue(false < 300, false)
+
+
+class LookupTimerTest(unittest.TestCase):
+
+    def test_moving_average(self):
+        timer = LookupTimer(weight=0.5)
+        timer.observe(u'client', 0.01)
+        self.assertEqual(timer.averages[u'client'], 0.01)
+        timer.observe(u'client', 0.03)
+        self.assertAlmostEqual(timer.averages[u'client'], 0.02)
+
+    def test_wait(self):
+        timer = LookupTimer()
+        start = time.time()
+        timer.wait(u'client')
+        self.assertTrue(time.time() - start < 0.01)
+        timer.observe(u'client', 0.02)
+        timer.wait(u'client')
+        self.assertTrue(time.time() - start >= 0.02)
+
+
+class TokenBucketTests(object):
+
+    def test_burst_then_wait(self):
+        buckets = self.make_buckets()
+        for i in range(3):
+            self.assertEqual(buckets.take(u'key', 1, 3), 0)
+        wait = buckets.take(u'key', 1, 3)
+        self.assertTrue(0 < wait <= 1, wait)
+
+    def test_keys_are_separate(self):
+        buckets = self.make_buckets()
+        buckets.take(u'key', 1, 1)
+        self.assertEqual(buckets.take(u'other', 1, 1), 0)
+
+    def test_refill(self):
+        buckets = self.make_buckets()
+        buckets.take(u'key', 100, 1)
+        time.sleep(0.05)
+        self.assertEqual(buckets.take(u'key', 100, 1), 0)
+
+
+class TokenBucketsTest(TokenBucketTests, unittest.TestCase):
+
+    def make_buckets(self):
+        return TokenBuckets(100)
+
+    def test_least_recently_used_is_reset(self):
+        buckets = TokenBuckets(1)
+        buckets.take(u'key', 1, 1)
+        buckets.take(u'other', 1, 1)
+        self.assertEqual(buckets.take(u'key', 1, 1), 0)
+
+
+class SharedTokenBucketsTest(TemporaryDirectory, TokenBucketTests,
+                             unittest.TestCase):
+
+    def make_buckets(self):
+        return SharedTokenBuckets(os.path.join(self.path, u'rates'), 100)
+
+    def test_shared_by_instances(self):
+        buckets = self.make_buckets()
+        buckets.take(u'key', 1, 1)
+        self.assertTrue(self.make_buckets().take(u'key', 1, 1) > 0)
+
+
+class TokenPoolTest(unittest.TestCase):
+
+    def test_tokens(self):
+        pool = TokenPool(64)
+        tokens = [pool.token(30) for i in range(100)]
+        self.assertEqual(len(set(tokens)), 100)
+        for token in tokens:
+            self.assertEqual(len(token), 30)
+            self.assertTrue(set(token) <= set(UNICODE_ASCII_CHARACTER_SET))
+
+    def test_forked_processes_have_pools_of_their_own(self):
+        pool = TokenPool(4096)
+        pool.token(30)
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(write, pool.token(30).encode(u'ascii'))
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertNotEqual(os.read(read, 30).decode(u'ascii'),
+                            pool.token(30))
+
+
+class TokenSealerTest(unittest.TestCase):
+
+    def test_seal(self):
+        sealer = TokenSealer(u'master key')
+        expires_at = datetime.utcnow().replace(microsecond=0) + \
+            timedelta(hours=1)
+        token = sealer.seal(u'client', u'secret', 42, expires_at)
+        self.assertTrue(sealer.looks_sealed(token))
+        claims = sealer.unseal(token)
+        self.assertEqual((claims.client_key, claims.realm,
+                          claims.resource_owner, claims.expires_at),
+                         (u'client', u'secret', 42, expires_at))
+        self.assertEqual(claims.secret, sealer.secret(token))
+        self.assertEqual(len(claims.secret), 30)
+
+    def test_forged(self):
+        sealer = TokenSealer(u'master key')
+        token = sealer.seal(u'client', None, 42)
+        self.assertEqual(TokenSealer(u'other key').unseal(token), None)
+        tampered = token[:-5] + (u'A' if token[-5] != u'A' else u'B') + \
+            token[-4:]
+        self.assertEqual(sealer.unseal(tampered), None)
+        self.assertEqual(sealer.unseal(u'not-base62!'), None)
+
+    def without_pycrypto(self, sealer):
+        sealer.aes = None
+        sealer.version = sealer.keystream_version
+        return sealer
+
+    @unittest.skipUnless(have(u'Crypto'), u'requires PyCrypto')
+    def test_sealed_with_aes(self):
+        sealer = TokenSealer(u'master key')
+        token = sealer.seal(u'client', None, 42)
+        self.assertEqual(sealer.decode(token)[:1], sealer.aes_version)
+        self.assertEqual(sealer.unseal(token).client_key, u'client')
+        # Refused rather than misread without PyCrypto
+        fallback = self.without_pycrypto(TokenSealer(u'master key'))
+        self.assertEqual(fallback.unseal(token), None)
+
+    def test_sealed_without_pycrypto(self):
+        sealer = self.without_pycrypto(TokenSealer(u'master key'))
+        token = sealer.seal(u'client', None, 42)
+        self.assertEqual(sealer.decode(token)[:1], sealer.keystream_version)
+        self.assertEqual(sealer.unseal(token).client_key, u'client')
+        self.assertEqual(TokenSealer(u'master key').unseal(token).client_key,
+                         u'client')
+        # Secrets do not depend on the cipher
+        self.assertEqual(sealer.secret(token),
+                         TokenSealer(u'master key').secret(token))
+
+    def test_initialization_vectors(self):
+        sealer = TokenSealer(u'master key')
+        sealed = [sealer.decode(sealer.seal(u'client', None, 42))
+                  for i in range(100)]
+        claims = json.dumps([u'client', None, 42, 0])
+        # Version, 16 byte IV, claims and tag
+        self.assertEqual(set(map(len, sealed)), set([33 + len(claims)]))
+        self.assertEqual(len(set(token[1:17] for token in sealed)), 100)
+
+
+class MetricsTest(TemporaryDirectory, unittest.TestCase):
+
+    def test_render(self):
+        metrics = Metrics()
+        metrics.inc(u'requests_total', {u'outcome': u'valid'})
+        metrics.inc(u'requests_total', {u'outcome': u'valid'})
+        metrics.observe(u'duration_seconds', {}, 0.02)
+        text = metrics.render()
+        self.assertTrue(u'requests_total{outcome="valid"} 2' in text)
+        self.assertTrue(u'duration_seconds_bucket{le="0.025"} 1' in text)
+        self.assertTrue(u'duration_seconds_count 1' in text)
+
+    def test_processes_are_summed(self):
+        metrics = Metrics(self.path, interval=0)
+        metrics.inc(u'requests_total', {})
+        pid = os.fork()
+        if pid == 0:
+            metrics.inc(u'requests_total', {}, 2)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertTrue(u'requests_total 3' in metrics.render())
+
+    def run_threads(self, target, count=8):
+        threads = [Thread(target=target) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_dumped_once_per_interval(self):
+        metrics = Metrics(self.path, interval=60)
+        metrics.dumped = 0
+        dumps = []
+        metrics.dump = lambda: dumps.append(1)
+        self.run_threads(lambda: metrics.inc(u'requests_total', {}))
+        self.assertEqual(len(dumps), 1)
+
+    def test_concurrent_dumps(self):
+        metrics = Metrics(self.path, interval=0)
+        failures = []
+        handler = logging.Handler()
+        handler.emit = failures.append
+        logger = logging.getLogger(u'flask_oauthprovider')
+        logger.addHandler(handler)
+        try:
+            self.run_threads(lambda: [metrics.inc(u'requests_total', {})
+                                      for i in range(50)])
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(failures, [])
+        # The last dump holds every count, snapshots being taken in order
+        with open(metrics.filename(os.getpid())) as f:
+            self.assertEqual(json.load(f)[u'counters'],
+                             [[u'requests_total', [], 400]])
+
+
+class RSAVerifierPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = RSAVerifierPool(1, 1, 0.2)
+
+    def tearDown(self):
+        if self.pool.pool is not None:
+            self.pool.pool.terminate()
+
+    @unittest.skipUnless(have(u'Crypto'), u'requires PyCrypto')
+    def test_verify(self):
+        from Crypto.PublicKey import RSA
+        from Crypto.Signature import PKCS1_v1_5
+        from Crypto.Hash import SHA
+        private, public = rsa_keypair()
+        sig = PKCS1_v1_5.new(RSA.importKey(private)).sign(SHA.new(b'message'))
+        self.assertTrue(self.pool.verify(u'client', public, b'message', sig))
+        self.assertFalse(self.pool.verify(u'client', public, b'other', sig))
+
+    def test_errors_are_raised(self):
+        self.assertRaises(ValueError, self.pool.call, int, u'x')
+        self.assertEqual(self.pool.pending, 0)
+
+    def test_single_timeout(self):
+        self.pool.start()
+        other = Thread(target=self.pool.call, args=(time.sleep, 0.15))
+        other.start()
+        time.sleep(0.01)
+        # A spot is free after 0.15s and the result ready after 0.25s,
+        # each within but both together beyond the timeout of 0.2s
+        try:
+            self.assertRaises(ServiceUnavailable, self.pool.call,
+                              time.sleep, 0.1)
+        finally:
+            other.join()
+
+    def test_spot_held_until_finished(self):
+        self.assertRaises(ServiceUnavailable, self.pool.call, time.sleep, 0.6)
+        # The job given up on still runs and holds the only spot
+        self.assertEqual(self.pool.pending, 1)
+        self.assertRaises(ServiceUnavailable, self.pool.call, abs, -1)
+        time.sleep(0.6)
+        self.assertEqual(self.pool.pending, 0)
+        self.assertEqual(self.pool.call(abs, -1), 1)
+
+
+class WriteBehindQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.failures = 0
+        self.dropped = []
+
+    def flush(self, writes):
+        if self.failures:
+            self.failures -= 1
+            raise IOError()
+        if (u'token', u'bad') in writes:
+            raise ValueError()
+        self.batches.append(writes)
+
+    def queue(self, batch_size=2, delay=0.01, retries=5):
+        return WriteBehindQueue(self.flush, batch_size, delay, retries,
+                                self.dropped.extend)
+
+    def wait_for(self, done):
+        deadline = time.time() + 2
+        while not done() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_batches(self):
+        queue = self.queue(delay=5)
+        queue.put(u'token', u'a', key=u'a')
+        queue.put(u'token', u'b')
+        self.wait_for(lambda: self.batches)
+        self.assertEqual(self.batches, [[(u'token', u'a'), (u'token', u'b')]])
+        self.assertEqual(queue.get(u'a'), None)
+        queue.stop()
+
+    def test_failed_batch_is_retried(self):
+        self.failures = 2
+        queue = self.queue()
+        queue.put(u'token', u'a', key=u'a')
+        self.assertEqual(queue.get(u'a'), u'a')
+        self.wait_for(lambda: self.batches)
+        self.assertEqual(self.batches, [[(u'token', u'a')]])
+        self.assertEqual(self.dropped, [])
+        queue.stop()
+
+    def test_dropped_after_retries(self):
+        self.failures = 10
+        queue = self.queue(retries=1)
+        queue.put(u'token', u'a', key=u'a')
+        self.wait_for(lambda: self.dropped)
+        self.assertEqual(self.dropped, [(u'token', u'a')])
+        self.assertEqual(queue.get(u'a'), None)
+        queue.stop()
+
+    def test_only_failing_writes_are_dropped(self):
+        queue = self.queue(retries=3)
+        queue.put(u'token', u'bad')
+        for i in range(30):
+            queue.put(u'token', i)
+        self.wait_for(lambda: self.dropped and
+                      sum(map(len, self.batches)) == 30)
+        self.assertEqual(self.dropped, [(u'token', u'bad')])
+        self.assertEqual(sorted(record for batch in self.batches
+                                for kind, record in batch), range(30))
+        queue.stop()
+
+    def test_stop_flushes(self):
+        queue = self.queue(batch_size=100, delay=60)
+        queue.put(u'token', u'a')
+        queue.stop()
+        self.assertFalse(queue.thread.is_alive())
+        self.assertEqual(self.batches, [[(u'token', u'a')]])
+
+    def test_quiet_exit(self):
+        # The thread used to be torn down along with the interpreter
+        # mid-batch, printing a traceback most of the time
+        script = (u'from flask_oauthprovider import WriteBehindQueue\n'
+                  u'queue = WriteBehindQueue(lambda writes: None, 1, 0.001)\n'
+                  u'for i in range(2000):\n'
+                  u'    queue.put(u"token", i)\n')
+        for i in range(3):
+            process = subprocess.Popen([sys.executable, u'-c', script],
+                    stderr=subprocess.PIPE, cwd=os.path.dirname(
+                        os.path.abspath(flask_oauthprovider.__file__)))
+            self.assertEqual(process.communicate()[1], b'')
+            self.assertEqual(process.returncode, 0)
+
+
+class WithoutFcntlTest(unittest.TestCase):
+
+    def test_importable(self):
+        # As on Windows, which lacks fcntl
+        sys.modules[u'fcntl'] = None
+        try:
+            module = imp.load_source(u'flask_oauthprovider_without_fcntl',
+                    flask_oauthprovider.__file__.replace(u'.pyc', u'.py'))
+        finally:
+            del sys.modules[u'fcntl']
+        cache = module.NonceCache(600, 10)
+        self.assertTrue(cache.add(u'client', int(time.time()), u'nonce'))
@@ -0,0 +1,192 @@
+"""
+The three legged flow and protected resources, end to end, for every
+signature method.
+"""
+import shutil
+import tempfile
+import time
+import unittest
+
+from oauthlib.oauth1.rfc5849 import SIGNATURE_HMAC, SIGNATURE_RSA
+from oauthlib.oauth1.rfc5849 import SIGNATURE_PLAINTEXT
+
+from tests.helpers import MemoryStore, Flow, create_app, register_client
+from tests.helpers import sqlalchemy_store, mongo_store, have
+from tests.helpers import CLIENT_KEY, CALLBACK
+
+
+class FlowTests(object):
+    """Mixed into a TestCase with the store and signature method to test."""
+
+    method = SIGNATURE_HMAC
+    settings = {}
+
+    def make_store(self):
+        return MemoryStore()
+
+    def setUp(self):
+        self.store = self.make_store()
+        register_client(self.store, self.method)
+        self.app, self.provider = create_app(self.store, **self.settings)
+        self.flow = Flow(self.app, self.method)
+
+    def test_flow(self):
+        response, (token, secret) = self.flow.request_token()
+        self.assertEqual(response.status_code, 200)
+        verifier = self.flow.authorize(token)
+        response, access = self.flow.access_token(token, secret, verifier)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.flow.get(u'/protected', access)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, CLIENT_KEY)
+
+    def test_request_token_for_realm(self):
+        response, (token, secret) = self.flow.request_token(realm=u'secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.provider.get_realm(CLIENT_KEY, token),
+                         u'secret')
+
+    def test_request_token_for_realm_in_query(self):
+        # As requested by examples/client.py, the realm is then signed
+        response = self.flow.open(self.flow.credentials(callback_uri=CALLBACK),
+                u'/request_token?realm=secret', u'POST')
+        self.assertEqual(response.status_code, 200)
+        token = self.flow.token(response)[0]
+        self.assertEqual(self.provider.get_realm(CLIENT_KEY, token),
+                         u'secret')
+
+    def test_request_token_for_unknown_realm(self):
+        response, token = self.flow.request_token(realm=u'unknown')
+        self.assertEqual(response.status_code, 400)
+
+    def test_realm_of_access_token(self):
+        access = self.flow.authorized_access_token(realm=u'secret')
+        self.assertEqual(self.flow.get(u'/secret', access).status_code, 200)
+        self.assertEqual(self.flow.get(u'/trolling', access).status_code, 401)
+        self.assertEqual(self.flow.get(u'/either', access).status_code, 200)
+
+    def test_multiple_realms(self):
+        access = self.flow.authorized_access_token(realm=u'secret trolling')
+        self.assertEqual(self.flow.get(u'/secret', access).status_code, 200)
+        self.assertEqual(self.flow.get(u'/trolling', access).status_code, 200)
+
+    def test_replayed_request(self):
+        access = self.flow.authorized_access_token()
+        headers = self.flow.sign(self.flow.credentials(
+                resource_owner_key=access[0], resource_owner_secret=access[1]),
+                u'/protected')
+        self.assertEqual(self.flow.send(u'/protected', u'GET',
+                                        headers).status_code, 200)
+        self.assertEqual(self.flow.send(u'/protected', u'GET',
+                                        headers).status_code, 401)
+
+    def test_rejected_request_does_not_claim_nonce(self):
+        access = self.flow.authorized_access_token()
+        nonce = {u'nonce': u'unclaimednoncexxxxxx',
+                 u'timestamp': u'%d' % time.time()}
+        response = self.flow.open(self.flow.credentials(
+                resource_owner_key=u'unknownaccesstokenxxxxxxxxxxx',
+                resource_owner_secret=u'x' * 30, **nonce), u'/protected')
+        self.assertEqual(response.status_code, 401)
+        response = self.flow.open(self.flow.credentials(
+                resource_owner_key=access[0], resource_owner_secret=access[1],
+                **nonce), u'/protected')
+        self.assertEqual(response.status_code, 200)
+
+    def test_unknown_access_token(self):
+        self.flow.authorized_access_token()
+        response = self.flow.get(u'/protected',
+                (u'unknownaccesstokenxxxxxxxxxxx', u'x' * 30))
+        self.assertEqual(response.status_code, 401)
+
+    def test_wrong_token_secret(self):
+        access = self.flow.authorized_access_token()
+        response = self.flow.get(u'/protected',
+                (access[0], u'wrongsecretxxxxxxxxxxxxxxxxxxx'))
+        if self.method == SIGNATURE_RSA:
+            # Token secrets are not part of RSA-SHA1 signatures
+            self.assertEqual(response.status_code, 200)
+        else:
+            self.assertEqual(response.status_code, 401)
+
+    def test_unknown_client(self):
+        flow = Flow(self.app, self.method,
+                    client_key=u'unknownclientkeyxxxx')
+        response, token = flow.request_token()
+        self.assertEqual(response.status_code, 401)
+
+    def test_wrong_verifier(self):
+        response, (token, secret) = self.flow.request_token()
+        self.flow.authorize(token)
+        response, access = self.flow.access_token(token, secret,
+                u'wrongverifierxxxxxxxxxxxxxxxxx')
+        self.assertEqual(response.status_code, 401)
+
+
+class HMACFlowTest(FlowTests, unittest.TestCase):
+    method = SIGNATURE_HMAC
+
+
+class PlaintextFlowTest(FlowTests, unittest.TestCase):
+    method = SIGNATURE_PLAINTEXT
+
+
+@unittest.skipUnless(have(u'Crypto'), u'requires PyCrypto')
+class RSAFlowTest(FlowTests, unittest.TestCase):
+    method = SIGNATURE_RSA
+
+
+@unittest.skipUnless(have(u'sqlalchemy'), u'requires SQLAlchemy')
+class SQLAlchemyFlowTest(FlowTests, unittest.TestCase):
+
+    def make_store(self):
+        return sqlalchemy_store()
+
+
+@unittest.skipUnless(have(u'mongomock'), u'requires mongomock')
+class MongoFlowTest(FlowTests, unittest.TestCase):
+
+    def make_store(self):
+        return mongo_store()
+
+
+class CachedFlowTest(FlowTests, unittest.TestCase):
+    """Every cache and pool of a single process enabled at once."""
+
+    settings = {u'client_cache_size': 100, u'nonce_cache_size': 1000,
+                u'negative_cache_size': 100, u'prefetch_pool_size': 2,
+                u'token_pool_size': 4096}
+
+
+class SharedFlowTest(FlowTests, unittest.TestCase):
+    """The caches shared by processes through files enabled at once."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.settings = {u'nonce_cache_size': 1000,
+                u'nonce_cache_path': self.path + u'/nonces',
+                u'bloom_filter_path': self.path + u'/bloom',
+                u'bloom_filter_capacity': 1000,
+                u'rate_limits': {(None, None): (100, 100)},
+                u'rate_limit_path': self.path + u'/rates',
+                u'metrics_url': u'/metrics',
+                u'metrics_path': self.path}
+        FlowTests.setUp(self)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+class SealedFlowTest(FlowTests, unittest.TestCase):
+    """Self-contained access tokens."""
+
+    settings = {u'token_master_key': u'not very secret'}
+
+
+@unittest.skipUnless(have(u'Crypto'), u'requires PyCrypto')
+class RSAPoolFlowTest(FlowTests, unittest.TestCase):
+    """RSA-SHA1 signatures verified in a process pool."""
+
+    method = SIGNATURE_RSA
+    settings = {u'rsa_pool_size': 1}
@@ -0,0 +1,406 @@
+"""
+Optional features of OAuthProvider, through the flow of a test client.
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from flask_oauthprovider import Record, Metrics, phase_timed, writes_dropped
+from flask_oauthprovider import signals_available
+
+from tests.helpers import MemoryStore, Flow, FlowProvider, create_app
+from tests.helpers import register_client, sqlalchemy_store, have
+from tests.helpers import CLIENT_KEY, CLIENT_SECRET, CALLBACK
+
+
+class ProviderTestCase(unittest.TestCase):
+
+    settings = {}
+
+    def setUp(self):
+        self.store = MemoryStore()
+        register_client(self.store)
+        self.app, self.provider = create_app(self.store, **self.settings)
+        self.flow = Flow(self.app)
+
+
+class DefaultsTest(ProviderTestCase):
+
+    def test_optimizations_are_opt_in(self):
+        for name in (u'client_cache', u'negative_cache', u'bloom_filter',
+                     u'nonce_store', u'prefetch_pool', u'rsa_pool',
+                     u'rate_buckets', u'write_queue', u'token_pool',
+                     u'token_sealer', u'metrics', u'profiler', u'reaper'):
+            self.assertEqual(getattr(self.provider, name), None, name)
+
+
+class ExpiryTest(ProviderTestCase):
+
+    settings = {u'request_token_lifetime': 60, u'verifier_lifetime': 30,
+                u'access_token_lifetime': 60}
+
+    def test_expiry_is_saved(self):
+        access = self.flow.authorized_access_token()
+        token = self.store.access_tokens[access[0]]
+        self.assertTrue(token.created_at < token.expires_at)
+        self.assertTrue(token.expires_at <= datetime.utcnow() +
+                        timedelta(seconds=60))
+
+    def test_expired_access_token(self):
+        access = self.flow.authorized_access_token()
+        self.assertEqual(self.flow.get(u'/protected', access).status_code, 200)
+        self.store.access_tokens[access[0]].expires_at = \
+            datetime.utcnow() - timedelta(seconds=1)
+        self.assertEqual(self.flow.get(u'/protected', access).status_code, 401)
+
+    def test_expired_request_token(self):
+        response, (token, secret) = self.flow.request_token()
+        verifier = self.flow.authorize(token)
+        self.store.request_tokens[token].expires_at = \
+            datetime.utcnow() - timedelta(seconds=1)
+        response, access = self.flow.access_token(token, secret, verifier)
+        self.assertEqual(response.status_code, 401)
+
+    def test_authorizing_expired_request_token(self):
+        response, (token, secret) = self.flow.request_token()
+        self.store.request_tokens[token].expires_at = \
+            datetime.utcnow() - timedelta(seconds=1)
+        response = self.flow.client.get(u'/authorize?oauth_token=' + token)
+        self.assertEqual(response.status_code, 400)
+        response = self.flow.client.get(u'/authorize?oauth_token=unknown')
+        self.assertEqual(response.status_code, 400)
+
+    def test_verifier_shortens_request_token(self):
+        response, (token, secret) = self.flow.request_token()
+        self.flow.authorize(token)
+        self.assertTrue(self.store.request_tokens[token].expires_at <=
+                        datetime.utcnow() + timedelta(seconds=30))
+
+
+class TimestampTest(ProviderTestCase):
+
+    def test_future_timestamp(self):
+        response = self.flow.open(self.flow.credentials(
+                timestamp=u'%d' % (time.time() + 3600)),
+                u'/request_token', u'POST')
+        self.assertEqual(response.status_code, 400)
+
+    def test_old_timestamp(self):
+        response = self.flow.open(self.flow.credentials(
+                timestamp=u'%d' % (time.time() - 3600)),
+                u'/request_token', u'POST')
+        self.assertEqual(response.status_code, 400)
+
+
+class RateLimitTest(ProviderTestCase):
+
+    settings = {u'rate_limits': {(None, None): (0.01, 2),
+                                 (u'secret', None): (0.01, 1),
+                                 (None, u'secret'): (0.01, 1)}}
+
+    def test_limited(self):
+        access = self.flow.authorized_access_token()
+        self.assertEqual(self.flow.get(u'/secret', access).status_code, 200)
+        response = self.flow.get(u'/secret', access)
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response.headers[u'Retry-After']) > 0)
+        # Endpoints have buckets of their own
+        self.assertEqual(self.flow.get(u'/protected', access).status_code, 200)
+
+    def test_view_requiring_several_realms(self):
+        access = self.flow.authorized_access_token()
+        self.assertEqual(self.flow.get(u'/either', access).status_code, 200)
+        self.assertEqual(self.flow.get(u'/either', access).status_code, 429)
+
+    def test_requesting_several_realms(self):
+        self.assertEqual(self.flow.request_token(
+                realm=u'trolling secret')[0].status_code, 200)
+        self.assertEqual(self.flow.request_token(
+                realm=u'secret')[0].status_code, 429)
+
+
+class SealedTokenTest(ProviderTestCase):
+
+    settings = {u'token_master_key': u'not very secret'}
+
+    def test_never_stored(self):
+        access = self.flow.authorized_access_token()
+        self.assertEqual(self.store.access_tokens, {})
+        self.assertEqual(self.flow.get(u'/secret', access).status_code, 200)
+        self.assertEqual(self.flow.get(u'/trolling', access).status_code, 401)
+
+    def test_revoked(self):
+        access = self.flow.authorized_access_token()
+        self.provider.access_token_revoked = lambda token: True
+        self.assertEqual(self.flow.get(u'/secret', access).status_code, 401)
+
+
+class ClientCacheTest(ProviderTestCase):
+
+    settings = {u'client_cache_size': 10}
+
+    def test_clients_are_loaded_once(self):
+        access = self.flow.authorized_access_token()
+        self.flow.get(u'/protected', access)
+        lookups = self.store.lookups
+        self.flow.get(u'/protected', access)
+        # Only the access token
+        self.assertEqual(self.store.lookups, lookups + 1)
+
+    def test_invalidate_client(self):
+        access = self.flow.authorized_access_token()
+        self.flow.get(u'/protected', access)
+        self.store.save_client(CLIENT_KEY, callbacks=[CALLBACK],
+                secret=u'changedsecretxxxxxxxxxxxxxxxxx')
+        self.assertEqual(self.flow.get(u'/protected', access).status_code, 200)
+        self.provider.invalidate_client(CLIENT_KEY)
+        self.assertEqual(self.flow.get(u'/protected', access).status_code, 401)
+
+
+class NegativeCacheTest(ProviderTestCase):
+
+    settings = {u'negative_cache_size': 10}
+
+    def test_unknown_keys_are_looked_up_once(self):
+        flow = Flow(self.app, client_key=u'unknownclientkeyxxxx')
+        self.assertEqual(flow.request_token()[0].status_code, 401)
+        lookups = self.store.lookups
+        self.assertEqual(flow.request_token()[0].status_code, 401)
+        self.assertEqual(self.store.lookups, lookups)
+
+    def test_issued_tokens_are_forgotten(self):
+        access = self.flow.authorized_access_token()
+        self.assertEqual(self.flow.get(u'/protected', access).status_code, 200)
+
+    def test_known_misses_take_as_long_as_lookups(self):
+        flow = Flow(self.app, client_key=u'unknownclientkeyxxxx')
+        self.assertEqual(flow.request_token()[0].status_code, 401)
+        self.assertTrue(u'client' in self.provider.lookup_timer.averages)
+        self.provider.lookup_timer.averages[u'client'] = 0.05
+        start = time.time()
+        self.assertEqual(flow.request_token()[0].status_code, 401)
+        self.assertTrue(time.time() - start >= 0.05)
+
+
+class BloomFilterTest(ProviderTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.settings = {u'bloom_filter_capacity': 1000,
+                u'bloom_filter_path': os.path.join(self.path, u'bloom')}
+        ProviderTestCase.setUp(self)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_unknown_keys_are_not_looked_up(self):
+        # Populated before the first request
+        access = self.flow.authorized_access_token()
+        lookups = self.store.lookups
+        flow = Flow(self.app, client_key=u'unknownclientkeyxxxx')
+        self.assertEqual(flow.request_token()[0].status_code, 401)
+        self.assertEqual(self.store.lookups, lookups)
+        self.assertEqual(self.flow.get(u'/protected', access).status_code, 200)
+
+    def test_client_registered_after_startup(self):
+        self.flow.authorized_access_token()
+        self.provider.save_client(u'laterclientkeyxxxxxx',
+                secret=CLIENT_SECRET, callbacks=[CALLBACK])
+        flow = Flow(self.app, client_key=u'laterclientkeyxxxxxx')
+        self.assertEqual(flow.request_token()[0].status_code, 200)
+
+    def test_unknown_keys_take_as_long_as_lookups(self):
+        self.flow.authorized_access_token()
+        self.assertTrue(u'client' in self.provider.lookup_timer.averages)
+        self.provider.lookup_timer.averages[u'client'] = 0.05
+        flow = Flow(self.app, client_key=u'unknownclientkeyxxxx')
+        start = time.time()
+        self.assertEqual(flow.request_token()[0].status_code, 401)
+        self.assertTrue(time.time() - start >= 0.05)
+
+
+class NonceCacheTest(ProviderTestCase):
+
+    settings = {u'nonce_cache_size': 1000}
+
+    def test_nonces_are_not_stored(self):
+        access = self.flow.authorized_access_token()
+        self.assertEqual(self.flow.get(u'/protected', access).status_code, 200)
+        self.assertEqual(self.store.nonces, set())
+
+    def test_rejected_requests_are_not_remembered(self):
+        flow = Flow(self.app, client_key=u'unknownclientkeyxxxx')
+        for i in range(3):
+            self.assertEqual(flow.request_token()[0].status_code, 401)
+        self.assertEqual(self.provider.nonce_store.count, 0)
+
+
+@unittest.skipUnless(signals_available, u'requires blinker')
+class InstrumentationTest(ProviderTestCase):
+
+    settings = {u'metrics_url': u'/metrics'}
+
+    def test_metrics(self):
+        access = self.flow.authorized_access_token()
+        self.flow.get(u'/protected', access)
+        self.flow.get(u'/trolling', access)
+        text = self.app.test_client().get(u'/metrics').data.decode(u'utf-8')
+        self.assertTrue(u'oauth_requests_total{endpoint="protected",'
+                        u'outcome="valid",signature_method="HMAC-SHA1"} 1'
+                        in text, text)
+        self.assertTrue(u'oauth_requests_total{endpoint="trolling",'
+                        u'outcome="unauthorized",'
+                        u'signature_method="HMAC-SHA1"} 1' in text, text)
+        self.assertTrue(u'oauth_phase_calls_total{phase="verify_signature"}'
+                        in text, text)
+
+    def test_phase_timed(self):
+        phases = []
+
+        def receiver(sender, phase, duration):
+            phases.append(phase)
+        phase_timed.connect(receiver, sender=self.provider)
+        try:
+            self.flow.request_token()
+        finally:
+            phase_timed.disconnect(receiver, sender=self.provider)
+        for phase in (u'verify_request', u'parse_request', u'check_request',
+                      u'validate_request', u'verify_signature',
+                      u'validate_client_key', u'save_request_token', u'view'):
+            self.assertTrue(phase in phases, phase)
+
+
+class ProfilerTest(ProviderTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.settings = {u'profile_path': self.path,
+                         u'profile_sample_rate': 1,
+                         u'profile_interval': 0.0001}
+        ProviderTestCase.setUp(self)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_profiles_are_written(self):
+        @self.app.route(u'/slow')
+        @self.provider.require_oauth()
+        def slow():
+            time.sleep(0.05)
+            return u'slow'
+
+        access = self.flow.authorized_access_token()
+        for name in os.listdir(self.path):
+            os.remove(os.path.join(self.path, name))
+        self.assertEqual(self.flow.get(u'/slow', access).status_code, 200)
+        profiles = os.listdir(self.path)
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].endswith(u'.folded'))
+
+
+class RSAPoolTest(ProviderTestCase):
+
+    settings = {u'rsa_pool_size': 1}
+
+    def tearDown(self):
+        self.provider.rsa_pool.pool.terminate()
+
+    def test_started_with_the_app(self):
+        self.assertNotEqual(self.provider.rsa_pool.pool, None)
+
+
+class WriteBehindProvider(FlowProvider):
+    """Saves tokens through write_behind rather than the store."""
+
+    @property
+    def write_batch_size(self):
+        return 100
+
+    @property
+    def write_batch_delay(self):
+        return 60
+
+    def save_request_token(self, client_key, request_token, callback,
+            realm=None, secret=None, **kwargs):
+        self.write_behind(u'request_token', Record(client_key=client_key,
+                token=request_token, secret=secret, realm=realm,
+                callback=callback, verifier=None, resource_owner=None,
+                expires_at=None), key=(u'request_token', request_token))
+
+    def load_request_token(self, client_key, request_token):
+        token = self.pending_write((u'request_token', request_token))
+        if token is not None:
+            return token
+        return self.store.load_request_token(client_key, request_token)
+
+    def flush_writes(self, writes):
+        for kind, token in writes:
+            self.store.request_tokens[token.token] = token
+
+
+class WriteBehindTest(unittest.TestCase):
+
+    def test_pending_writes_are_readable(self):
+        store = MemoryStore()
+        register_client(store)
+        app, provider = create_app(store)
+        provider = WriteBehindProvider(None, store=store)
+        app.view_functions[u'request_token'] = provider.request_token
+        app.view_functions[u'authorize'] = provider.authorize
+        app.view_functions[u'access_token'] = provider.access_token
+        flow = Flow(app)
+
+        response, (token, secret) = flow.request_token()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(store.request_tokens, {})
+        self.assertEqual(provider.get_request_token(CLIENT_KEY, token).token,
+                         token)
+        provider.write_queue.flush()
+        self.assertEqual(store.request_tokens[token].token, token)
+        self.assertEqual(provider.pending_write((u'request_token', token)),
+                         None)
+        provider.write_queue.stop()
+
+    @unittest.skipUnless(signals_available, u'requires blinker')
+    def test_dropped_writes_are_counted(self):
+        store = MemoryStore()
+        register_client(store)
+        provider = WriteBehindProvider(None, store=store)
+        provider.metrics = Metrics(None)
+        writes_dropped.connect(provider.count_dropped_writes, sender=provider)
+
+        def fail(writes):
+            raise IOError()
+        provider.write_queue.flush_writes = fail
+        provider.write_behind(u'request_token', Record(token=u'token'))
+        provider.write_queue.flush()
+        writes_dropped.disconnect(provider.count_dropped_writes,
+                                  sender=provider)
+        self.assertTrue(u'oauth_writes_dropped_total{kind="request_token"} 1'
+                        in provider.metrics.render())
+        provider.write_queue.stop()
+
+
+@unittest.skipUnless(have(u'sqlalchemy'), u'requires SQLAlchemy')
+class UnitOfWorkTest(unittest.TestCase):
+
+    def test_rolled_back_with_the_view(self):
+        store = sqlalchemy_store()
+        register_client(store)
+        app, provider = create_app(store)
+
+        @app.route(u'/failing')
+        @provider.require_oauth()
+        def failing():
+            store.save_client(u'rolled back')
+            raise RuntimeError()
+
+        flow = Flow(app)
+        access = flow.authorized_access_token()
+        app.testing = False
+        self.assertEqual(flow.get(u'/failing', access).status_code, 500)
+        self.assertEqual(store.load_client(u'rolled back'), None)
+        self.assertEqual(flow.get(u'/protected', access).status_code, 200)
@@ -0,0 +1,252 @@
+"""
+TokenStore backends on their own, and a resource server asking an
+authorization server through a RemoteStore.
+"""
+import unittest
+from datetime import datetime, timedelta
+from threading import Thread
+
+from flask import Flask, request
+from flask_oauthprovider import RemoteStore
+
+from tests.helpers import MemoryStore, Flow, create_app, register_client
+from tests.helpers import sqlalchemy_store, mongo_store, have, provider_class
+from tests.helpers import CLIENT_KEY
+
+
+class StoreTests(object):
+    """Mixed into a TestCase with make_store returning the store to test."""
+
+    def setUp(self):
+        self.store = self.make_store()
+        self.store.save_client(u'client', secret=u'secret',
+                callbacks=[u'http://a', u'http://b'])
+
+    def issue(self, expires_at=None):
+        self.store.save_request_token(u'client', u'request', u'http://a',
+                realm=u'secret', secret=u'request secret',
+                expires_at=expires_at)
+        self.store.save_verifier(u'request', u'verifier', u'owner')
+        self.store.save_access_token(u'client', u'access', u'request',
+                secret=u'access secret', expires_at=expires_at)
+
+    def test_client(self):
+        client = self.store.load_client(u'client')
+        self.assertEqual((client.client_key, client.secret, client.callbacks),
+                         (u'client', u'secret', [u'http://a', u'http://b']))
+        self.assertEqual(self.store.load_client(u'unknown'), None)
+
+    def test_tokens(self):
+        self.issue()
+        token = self.store.load_request_token(u'client', u'request')
+        self.assertEqual((token.client_key, token.secret, token.realm,
+                          token.callback, token.verifier,
+                          token.resource_owner),
+                         (u'client', u'request secret', u'secret', u'http://a',
+                          u'verifier', u'owner'))
+        self.assertEqual(self.store.load_request_token(None, u'request').token,
+                         u'request')
+        token = self.store.load_access_token(u'client', u'access')
+        self.assertEqual((token.client_key, token.secret, token.realm,
+                          token.resource_owner),
+                         (u'client', u'access secret', u'secret', u'owner'))
+
+    def test_tokens_of_another_client(self):
+        self.store.save_client(u'other')
+        self.issue()
+        self.assertEqual(self.store.load_request_token(u'other', u'request'),
+                         None)
+        self.assertEqual(self.store.load_access_token(u'other', u'access'),
+                         None)
+        self.assertEqual(self.store.load_access_token(u'client', u'unknown'),
+                         None)
+
+    def test_access_token_of_unknown_request_token(self):
+        self.assertRaises(ValueError, self.store.save_access_token,
+                u'client', u'access', u'unknown')
+        self.assertEqual(self.store.load_access_token(u'client', u'access'),
+                         None)
+
+    def test_nonce(self):
+        self.assertTrue(self.store.add_nonce(u'client', 1234567890, u'nonce'))
+        self.assertFalse(self.store.add_nonce(u'client', 1234567890, u'nonce'))
+        self.assertTrue(self.store.add_nonce(u'client', 1234567891, u'nonce'))
+
+    def test_known_keys(self):
+        self.issue()
+        self.assertEqual(sorted(self.store.known_keys()),
+                         [(u'access_token', u'access'), (u'client', u'client'),
+                          (u'request_token', u'request')])
+
+
+class MemoryStoreTest(StoreTests, unittest.TestCase):
+
+    def make_store(self):
+        return MemoryStore()
+
+
+@unittest.skipUnless(have(u'sqlalchemy'), u'requires SQLAlchemy')
+class SQLAlchemyStoreTest(StoreTests, unittest.TestCase):
+
+    def make_store(self):
+        return sqlalchemy_store()
+
+    def test_purge_expired(self):
+        past = datetime.utcnow() - timedelta(hours=1)
+        for i in range(5):
+            self.store.save_request_token(u'client', u'request%d' % i,
+                    u'http://a', expires_at=past)
+        self.store.save_request_token(u'client', u'current', u'http://a',
+                expires_at=datetime.utcnow() + timedelta(hours=1))
+        self.assertEqual(self.store.purge_expired(u'request_token',
+                                                  datetime.utcnow(), 3), 3)
+        self.assertEqual(self.store.purge_expired(u'request_token',
+                                                  datetime.utcnow(), 3), 2)
+        self.assertEqual(self.store.purge_expired(u'request_token',
+                                                  datetime.utcnow(), 3), 0)
+        self.assertNotEqual(self.store.load_request_token(u'client',
+                                                          u'current'), None)
+
+    def test_purge_expired_without_subquery(self):
+        from sqlalchemy import event
+        statements = []
+        event.listen(self.store.engine, u'before_cursor_execute',
+                lambda conn, cursor, statement, *args:
+                    statements.append(statement))
+        self.store.save_request_token(u'client', u'request', u'http://a',
+                expires_at=datetime.utcnow() - timedelta(hours=1))
+        self.assertEqual(self.store.purge_expired(u'request_token',
+                                                  datetime.utcnow(), 3), 1)
+        # MySQL refuses a LIMIT in the subquery of an IN
+        self.assertFalse([statement for statement in statements
+                          if u'DELETE' in statement and
+                             u'SELECT' in statement])
+
+    def test_purge_expired_nonces(self):
+        self.store.add_nonce(u'client', 1000000000, u'old')
+        self.store.add_nonce(u'client', 2000000000, u'new')
+        self.assertEqual(self.store.purge_expired(u'nonce',
+                datetime.utcfromtimestamp(1500000000), 10), 1)
+
+    def test_transaction_rolls_back(self):
+        try:
+            with self.store.transaction():
+                self.store.save_client(u'rolled back')
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(self.store.load_client(u'rolled back'), None)
+
+    def test_nested_transactions_join(self):
+        with self.store.transaction() as outer:
+            with self.store.transaction() as inner:
+                self.assertTrue(outer is inner)
+
+
+@unittest.skipUnless(have(u'mongomock'), u'requires mongomock')
+class MongoStoreTest(StoreTests, unittest.TestCase):
+
+    def make_store(self):
+        return mongo_store()
+
+    def test_indexes(self):
+        indexes = self.store.access_tokens.index_information()
+        self.assertTrue(any(index.get(u'unique') and
+                            index[u'key'] == [(u'token', 1)]
+                            for index in indexes.values()))
+        # mongomock does not report expireAfterSeconds
+        self.assertTrue(any(index[u'key'] == [(u'expires_at', 1)]
+                            for index in indexes.values()))
+        indexes = self.store.nonces.index_information()
+        self.assertTrue(any(index.get(u'unique') and
+                            index[u'key'] == [(u'client_key', 1),
+                                (u'timestamp', 1), (u'nonce', 1)]
+                            for index in indexes.values()))
+
+
+class RemoteStoreTest(unittest.TestCase):
+
+    secret = u'introspection secret'
+
+    def setUp(self):
+        self.store = MemoryStore()
+        register_client(self.store)
+        self.auth_app, self.auth = create_app(self.store,
+                introspection_url=u'/introspect',
+                introspection_secret=self.secret)
+        auth_client = self.auth_app.test_client()
+        self.introspections = 0
+
+        def transport(url, body, headers):
+            self.introspections += 1
+            response = auth_client.post(url, data=body, headers=headers)
+            return response.status_code, response.data
+
+        self.remote = RemoteStore(u'/introspect', self.secret,
+                                  transport=transport)
+        self.app = Flask(__name__)
+        self.app.testing = True
+        provider = provider_class()(None, store=self.remote)
+
+        @self.app.route(u'/secret')
+        @provider.require_oauth(realm=u'secret')
+        def secret():
+            return request.oauth.client_key
+
+    def test_protected_resource(self):
+        access = Flow(self.auth_app).authorized_access_token(realm=u'secret')
+        flow = Flow(self.app)
+        response = flow.get(u'/secret', access)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, CLIENT_KEY)
+        # Answers are cached
+        introspections = self.introspections
+        self.assertEqual(flow.get(u'/secret', access).status_code, 200)
+        self.assertEqual(self.introspections, introspections)
+
+    def test_batched_lookups(self):
+        access = Flow(self.auth_app).authorized_access_token()
+        self.remote.batch_delay = 0.05
+        results = []
+        threads = [Thread(target=lambda key: results.append(
+                           self.remote.lookup(key)), args=(key,))
+                   for key in ((CLIENT_KEY, None), (CLIENT_KEY, access[0]),
+                               (u'unknown', None))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.introspections, 1)
+        self.assertEqual(len(results), 3)
+
+    def test_batches_are_split(self):
+        self.remote.batch_delay = 0.05
+        results = []
+        threads = [Thread(target=lambda key: results.append(
+                           self.remote.lookup(key)), args=(key,))
+                   for key in ((CLIENT_KEY, u'token%d' % i)
+                               for i in range(150))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 150)
+        self.assertTrue(self.introspections >= 2)
+
+    def test_failed_introspection(self):
+        access = Flow(self.auth_app).authorized_access_token()
+        self.remote.secret = u'wrong'
+        self.assertEqual(Flow(self.app).get(u'/secret', access).status_code,
+                         503)
+
+    def test_unknown_token(self):
+        Flow(self.auth_app).authorized_access_token()
+        response = Flow(self.app).get(u'/secret',
+                (u'unknownaccesstokenxxxxxxxxxxx', u'x' * 30))
+        self.assertEqual(response.status_code, 401)
+
+    def test_wrong_secret(self):
+        response = self.auth_app.test_client().post(u'/introspect',
+                data=u'{"lookups": []}',
+                headers={u'Authorization': u'Bearer wrong'})
+        self.assertEqual(response.status_code, 401)